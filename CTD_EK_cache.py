@@ -0,0 +1,209 @@
+'''
+On-disk cache of Sv processed data objects so .raw files only need to be decoded by pyEcholab once. Each cached
+Sv is stored in its own folder with every numpy array attribute saved as a .npy file (loaded back memory-mapped)
+and the rest of the object pickled next to it. Entries are keyed by a hash of the contents of the .raw files, the
+frequency, and the calibration parameters that were changed from the values stored in the .raw files (i.e. the
+transducer offset). The cache has a size cap - the least recently used entries are deleted first.
+
+Hollings Scholarship Research Project
+'''
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import copy
+import numpy as np
+
+CACHE_VERSION = 1 # bump if the way Sv is calculated changes so old entries are not used
+
+
+class SvCache:
+    '''
+    SvCache: content addressed cache of Sv and calibration objects stored at cache_path
+    Inputs: cache_path (string) - folder to keep the cache in - created if it does not exist
+            max_gb (float) - maximum size of the cache in gigabytes - least recently used entries are deleted past this
+    '''
+
+    def __init__(self, cache_path, max_gb = 20):
+        self.cache_path = os.path.normpath(cache_path)
+        self.max_bytes = int(max_gb * 1024**3)
+        self.hash_file = os.path.join(self.cache_path, "raw_hashes.json")
+        os.makedirs(self.cache_path, exist_ok=True)
+
+    def raw_hash(self, raw_file):
+        '''
+        raw_hash: returns sha256 hash of the contents of a .raw file - hashes are remembered by path, size, and modification
+                  time so each .raw file is only read for hashing once
+        Input: raw_file (string) - path and filename of .raw file
+        Output: (string) hex digest of the file contents
+        '''
+        raw_file = os.path.abspath(raw_file)
+        stat = os.stat(raw_file)
+        hashes = self.read_json(self.hash_file, {})
+        known = hashes.get(raw_file)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+
+        file_hash = hashlib.sha256()
+        with open(raw_file, 'rb') as raw:
+            for block in iter(lambda: raw.read(2**20), b""):
+                file_hash.update(block)
+        hashes = self.read_json(self.hash_file, {}) # re-read in case another process added hashes in the meantime
+        hashes[raw_file] = [stat.st_size, stat.st_mtime_ns, file_hash.hexdigest()]
+        self.write_json(self.hash_file, hashes)
+        return file_hash.hexdigest()
+
+    def key(self, raw_files, fq, cal_params):
+        '''
+        key: creates the cache key for one frequency of Sv data
+        Inputs: raw_files (string list) - .raw files the Sv data is calculated from, in the order they are read
+                fq (integer) - frequency of the Sv data
+                cal_params (dictionary) - calibration parameters set on top of the .raw file calibration,
+                                          i.e. {"transducer_offset_z": 5}
+        Output: (string) key - also the name of the folder the entry is saved in
+        '''
+        if isinstance(raw_files, str):
+            raw_files = [raw_files]
+        key_info = {"version": CACHE_VERSION, "raw": [self.raw_hash(raw) for raw in raw_files], "frequency": int(fq),
+                    "calibration": {name: cal_params[name] for name in sorted(cal_params)}}
+        return hashlib.sha256(json.dumps(key_info, sort_keys=True).encode()).hexdigest()
+
+    def get(self, raw_files, fq, cal_params):
+        '''
+        get: loads Sv and calibration objects from the cache
+        Inputs: see key()
+        Outputs: (Sv object, calibration object) if the entry exists, otherwise None
+        Note: arrays are memory-mapped copy-on-write, so changing them in memory never changes the cache
+        '''
+        entry_path = os.path.join(self.cache_path, self.key(raw_files, fq, cal_params))
+        meta = self.read_json(os.path.join(entry_path, "meta.json"), None)
+        if meta is None:
+            return None
+        try:
+            with open(os.path.join(entry_path, "objects.pkl"), 'rb') as objects:
+                Sv, cal = pickle.load(objects)
+            for name in meta["arrays"]:
+                setattr(Sv, name, np.load(os.path.join(entry_path, name + ".npy"), mmap_mode='c'))
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError): # entry was evicted while reading or is broken
+            return None
+        os.utime(os.path.join(entry_path, "meta.json")) # modification time of meta.json is the last use time
+        return Sv, cal
+
+    def put(self, raw_files, fq, cal_params, Sv, cal):
+        '''
+        put: saves Sv and calibration objects to the cache and evicts old entries if the cache is too big
+        Inputs: see key(); Sv (Sv processed data object) - Sv to save; cal (calibration object) - calibration used for Sv
+        '''
+        key = self.key(raw_files, fq, cal_params)
+        entry_path = os.path.join(self.cache_path, key)
+        if os.path.isdir(entry_path):
+            return
+
+        # big arrays are saved as .npy files so they can be memory-mapped, everything else is pickled
+        arrays = {name: value for name, value in vars(Sv).items()
+                  if isinstance(value, np.ndarray) and not value.dtype.hasobject}
+        skeleton = copy.copy(Sv)
+        for name in arrays:
+            setattr(skeleton, name, None)
+
+        # write to a temporary folder and rename so other processes never see half written entries
+        tmp_path = tempfile.mkdtemp(dir=self.cache_path, prefix=".tmp_")
+        for name, value in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), value)
+        with open(os.path.join(tmp_path, "objects.pkl"), 'wb') as objects:
+            pickle.dump((skeleton, cal), objects)
+        size = sum(os.path.getsize(os.path.join(tmp_path, f)) for f in os.listdir(tmp_path))
+        self.write_json(os.path.join(tmp_path, "meta.json"), {"arrays": list(arrays.keys()), "frequency": int(fq),
+                        "raw_files": [os.path.basename(raw) for raw in np.atleast_1d(raw_files)], "size": size})
+        try:
+            os.rename(tmp_path, entry_path)
+        except OSError: # another process saved the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+
+    def get_pyramid(self, raw_files, fq, cal_params, min_size = 256):
+        '''
+        get_pyramid: loads the Sv pyramid (see CTD_EK_processing.Sv_pyramid) of a cached entry - the pyramid is calculated and saved
+                     in the entry's folder (pyramid_1.npy, pyramid_2.npy, ...) the first time it is asked for
+        Inputs: see key(); min_size (integer) - see Sv_pyramid - only used when the pyramid is first calculated
+        Output: list of Sv objects (level 0 is the full resolution Sv) with memory-mapped data, or None if the Sv is not cached
+        '''
+        import CTD_EK_processing as process # imported here so using the cache alone doesn't load pyEcholab and matplotlib
+        cached = self.get(raw_files, fq, cal_params)
+        if cached is None:
+            return None
+        entry_path = os.path.join(self.cache_path, self.key(raw_files, fq, cal_params))
+        meta_file = os.path.join(entry_path, "meta.json")
+        meta = self.read_json(meta_file, {})
+        if "pyramid_levels" in meta:
+            try:
+                level_data = [np.load(os.path.join(entry_path, "pyramid_" + str(level) + ".npy"), mmap_mode='c')
+                              for level in range(1, meta["pyramid_levels"] + 1)]
+                return process.Sv_pyramid(cached[0], level_data=level_data)
+            except (OSError, ValueError): # entry was evicted while reading - calculate it again below
+                pass
+
+        pyramid = process.Sv_pyramid(cached[0], min_size)
+        try:
+            size = 0
+            for level in range(1, len(pyramid)):
+                level_file = os.path.join(entry_path, "pyramid_" + str(level) + ".npy")
+                np.save(level_file + ".tmp.npy", pyramid[level].data)
+                os.replace(level_file + ".tmp.npy", level_file)
+                size += os.path.getsize(level_file)
+            meta["pyramid_levels"] = len(pyramid) - 1
+            meta["size"] = meta.get("size", 0) + size
+            self.write_json(meta_file, meta)
+        except OSError: # entry was evicted while writing - the pyramid is still returned
+            pass
+        return pyramid
+
+    def evict(self, keep = ""):
+        '''
+        evict: deletes least recently used entries until the cache is under its maximum size
+        Input: keep (string) - key of an entry that should not be deleted (i.e. the one just saved)
+        '''
+        entries = []
+        for key in os.listdir(self.cache_path):
+            meta_file = os.path.join(self.cache_path, key, "meta.json")
+            meta = self.read_json(meta_file, None)
+            if meta is not None:
+                entries.append((os.path.getmtime(meta_file), key, meta["size"]))
+        total = sum(entry[2] for entry in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                shutil.rmtree(os.path.join(self.cache_path, key), ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        '''
+        clear: deletes every entry in the cache
+        '''
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+        os.makedirs(self.cache_path, exist_ok=True)
+
+    @staticmethod
+    def read_json(path, default):
+        '''
+        read_json: reads a .json file, returning default if it does not exist or can't be read
+        '''
+        try:
+            with open(path, 'r') as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return default
+
+    @staticmethod
+    def write_json(path, values):
+        '''
+        write_json: writes a .json file by writing a temporary file and replacing the old one
+        '''
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, 'w') as outfile:
+            json.dump(values, outfile)
+        os.replace(tmp_path, path)
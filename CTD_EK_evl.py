@@ -0,0 +1,82 @@
+'''
+In-process cache of CTD traces read from .evl files, so a script that uses the same cast several times (segmenting it,
+plotting its profile, overlaying it on echograms...) only parses each .evl file with line.read_evl once:
+
+    x, y = evl.evl_trace(evl_file)  # numpy datetime64 times and float depths, read-only
+    depth_line = evl.evl_line(evl_file)  # the same trace as a pyEcholab line object (i.e. for Echogram.plot_line)
+
+Traces are keyed by the path, modification time, and size of the .evl file, so a file that is written again (i.e. by
+asc_to_evl) is parsed again. The least recently used traces are dropped once more than EVL_CACHE_SIZE are kept. The arrays
+are shared by every caller, so they are read-only - copy them before changing them. Each process has its own cache.
+
+Hollings Scholarship Research Project
+'''
+
+import os
+from collections import OrderedDict
+import numpy as np
+from echolab2.processing import line
+
+EVL_CACHE_SIZE = 64 # most traces kept at once - a trace of a few hours at 1 Hz is well under a megabyte
+evl_cache = OrderedDict() # (path, mtime, size) as keys and line objects as values, least recently used first
+evl_cache_stats = {"hits": 0, "misses": 0}
+
+
+def evl_key(evl_file):
+    '''
+    evl_key: cache key of a .evl file - (real path, modification time in nanoseconds, size in bytes) - the real path so the
+             same file reached by different paths (i.e. "//data/ctd001.evl" from plot_evl) is only parsed once
+    '''
+    evl_file = os.path.realpath(evl_file)
+    stat = os.stat(evl_file)
+    return (evl_file, stat.st_mtime_ns, stat.st_size)
+
+def evl_line(evl_file):
+    '''
+    evl_line: CTD trace of a .evl file as a pyEcholab line object - parsed with line.read_evl the first time and kept afterwards
+    Input: evl_file (string) - path and filename of .evl file
+    Output: pyEcholab line object shared with other callers - its ping_time and data arrays are read-only
+    '''
+    key = evl_key(evl_file)
+    if key in evl_cache:
+        evl_cache.move_to_end(key)
+        evl_cache_stats["hits"] += 1
+        return evl_cache[key]
+
+    evl_cache_stats["misses"] += 1
+    depth_line = line.read_evl(key[0])
+    for name in ["ping_time", "data"]:
+        values = np.asarray(getattr(depth_line, name))
+        values.flags.writeable = False
+        setattr(depth_line, name, values)
+    for old_key in [k for k in evl_cache if k[0] == key[0]]: # older versions of the same file
+        del evl_cache[old_key]
+    evl_cache[key] = depth_line
+    while len(evl_cache) > EVL_CACHE_SIZE:
+        evl_cache.popitem(last=False)
+    return depth_line
+
+def evl_trace(evl_file):
+    '''
+    evl_trace: CTD trace of a .evl file as arrays (see evl_line)
+    Input: evl_file (string) - path and filename of .evl file
+    Outputs: (1) read-only numpy datetime64 array of times, (2) read-only numpy float array of depths
+    '''
+    depth_line = evl_line(evl_file)
+    return depth_line.ping_time, depth_line.data
+
+def cached_evl_trace(evl_file):
+    '''
+    cached_evl_trace: same as evl_trace, but None if the trace is not already cached - the file is never parsed
+    '''
+    key = evl_key(evl_file)
+    if key not in evl_cache:
+        return None
+    return evl_trace(evl_file)
+
+def clear_evl_cache():
+    '''
+    clear_evl_cache: drops every cached trace and resets the hit/miss counts
+    '''
+    evl_cache.clear()
+    evl_cache_stats.update({"hits": 0, "misses": 0})
@@ -0,0 +1,320 @@
+'''
+Incremental pipeline that runs the whole process of raw_overlay_ctd.py, segment_subsets_mfi.py, and mfi_masks_ABC.py for a
+cruise (or every leg of a survey) without user input. Each cast is a chain of stages, each depending on the one before it:
+
+    evl (.asc to .evl) -> raw_match -> segments -> subsets -> mfi -> abc (MFI mask and ABC)
+
+Every stage has a key made from the hashes of the contents of its inputs (the .asc file, the .raw files, the outputs of the
+stage before it) and the parameters it uses. Keys are saved per cast in output_path/pipeline/, and a stage is skipped if its
+key has not changed and its outputs still exist - so if one .asc file changes, only that cast is re-run, and if the MFI
+parameters change, segments and subsets are not recalculated. Casts run in parallel on a process pool and an error in one
+cast (i.e. a broken .raw file) only stops that cast - it is recorded in the pipeline summary and the other casts carry on.
+
+Outputs for each leg are saved at output_path: the .evl files, segments/cast.npz (see CTD_EK_segments.py), the subset store (see CTD_EK_store.py),
+subset_manifest.json, abc.json, abc_classes.csv, and pipeline/summary.json with the status of every stage of every cast.
+
+Hollings Scholarship Research Project
+'''
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import CTD_EK_processing as process
+import CTD_EK_segments as seg_table
+import CTD_EK_store as store
+import CTD_EK_trace as trace
+from CTD_EK_cache import SvCache
+
+PIPELINE_VERSION = 3 # bump if a stage changes how it calculates its outputs so every stage is re-run
+
+
+def default_pipeline_config(raw_path, ctd_path, edna_file, output_path, ctd_list = "CTDtoEVL.list", name = ""):
+    '''
+    default_pipeline_config: settings for one leg of a cruise - change any of the values before passing it to run_pipeline
+    Inputs: raw_path (string) - folder with the .raw files
+            ctd_path (string) - folder with the .asc files and the CTD list file (see asc_to_evl)
+            edna_file (string) - path and filename of the eDNA cast file (see read_casts)
+            output_path (string) - folder to save everything to - created if it does not exist
+            ctd_list (string) - name of the CTD list file in ctd_path
+            name (string) - name of the leg, used in the summary - defaults to output_path
+    Output: config dictionary - paths above plus:
+                "transducer_offset" (float) - depth of the transducer in meters
+                "raw_duration" (integer) - see match_raw_evl
+                "atol_depths" (float list) - see auto_segment_maker
+                "subset_policy" (dictionary) - see default_subset_policy
+                "mfi" (dictionary) - "delta", "bad_fq", and "global_norm" arguments of calc_MFI_batch
+                "mask_ranges" (list) - MFI ranges kept by mask_mfi
+                "abc_fq" (string) - frequency ABC is calculated from
+                "dtype" (string) - type Sv, MFI, and the linear values for ABC are calculated in - "float32" halves the memory of
+                                   every stage, "float64" (default) gives the same results as earlier runs - ABC sums are
+                                   always float64
+                "sv_cache_gb" (float) - size of the Sv cache at output_path/Sv_cache (see SvCache)
+                "export_json" (boolean) - if True the store is also exported to the .json files used by the R code
+                "trace_file" (string) - optional JSON-lines file to record the time and memory of every stage in (see
+                                        CTD_EK_trace.py) - a summary is saved next to it as a .csv file - not traced if empty
+    '''
+    return {"name": name if len(name) != 0 else output_path, "raw_path": raw_path, "ctd_path": ctd_path, "ctd_list": ctd_list,
+            "edna_file": edna_file, "output_path": output_path, "transducer_offset": 5, "raw_duration": 60,
+            "atol_depths": [2, 3, 4], "subset_policy": process.default_subset_policy(),
+            "mfi": {"delta": 40, "bad_fq": [200000], "global_norm": False}, "mask_ranges": [[0, 0.4], [0.8, 1]],
+            "abc_fq": "38000", "dtype": "float64", "sv_cache_gb": 20, "export_json": True,
+            "trace_file": ""}
+
+def file_hash(path):
+    '''
+    file_hash: sha256 hash of the contents of a file
+    '''
+    hash = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(2**20), b""):
+            hash.update(block)
+    return hash.hexdigest()
+
+def value_hash(value):
+    '''
+    value_hash: sha256 hash of any value that can be saved to .json (i.e. parameters or the outputs of a stage)
+    '''
+    value = json.loads(json.dumps(value, default=str)) # keys turned into strings so they can be sorted
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+def read_casts_list(config):
+    '''
+    read_casts_list: finds the casts of one leg from its CTD list file and eDNA cast file
+    Input: config (dictionary) - see default_pipeline_config
+    Output: list of cast dictionaries with "cast" (cast number), "asc" (path of .asc file), "toffset" (seconds), "evl" (name of
+            .evl file), and "eDNA_depths" (see read_casts) - casts without eDNA depths are left out
+    '''
+    eDNA_cast_dic = process.read_casts(config["edna_file"])
+    with open(os.path.normpath(config["ctd_path"] + "/" + config["ctd_list"]), 'r') as infile:
+        ctd_list = [line for line in infile.readlines() if len(line.strip()) != 0]
+    casts = []
+    for line in ctd_list:
+        asc_fn, toffset = line.split(',')
+        asc_fn = asc_fn.strip()
+        cast = int(os.path.basename(asc_fn).replace("ctd", "").replace(".asc", "")) # i.e. ctd001.asc is cast 1
+        if cast in eDNA_cast_dic:
+            casts.append({"cast": cast, "asc": os.path.normpath(config["ctd_path"] + "/" + asc_fn), "toffset": int(toffset),
+                          "evl": os.path.basename(asc_fn).replace("asc", "evl"), "eDNA_depths": eDNA_cast_dic[cast]})
+    return casts
+
+# each stage takes (config, cast_info, outputs of the stages so far) and returns (outputs, output files) - outputs must be able
+# to be saved to .json and are passed on to the stages after it
+def stage_evl(config, cast_info, done):
+    evl_file = os.path.normpath(config["output_path"] + "/" + cast_info["evl"])
+    process.asc_file_to_evl(cast_info["asc"], cast_info["toffset"], evl_file)
+    return {"evl_file": evl_file}, [evl_file]
+
+def stage_raw_match(config, cast_info, done):
+    evl_raw_dic = process.match_raw_evl([done["evl"]["evl_file"]], cast_info["raw_files"], raw_duration=config["raw_duration"])
+    raw_files = [os.path.normpath(config["raw_path"] + "/" + raw) for raw in evl_raw_dic[os.path.basename(done["evl"]["evl_file"])]]
+    if len(raw_files) == 0:
+        raise ValueError("no .raw files overlap " + cast_info["evl"])
+    return {"raw_files": raw_files}, []
+
+def stage_segments(config, cast_info, done):
+    segments, report = process.auto_segment_maker(cast_info["eDNA_depths"], done["evl"]["evl_file"], config["transducer_offset"],
+                                                  config["atol_depths"], as_table=True)
+    segment_file = os.path.normpath(config["output_path"] + "/segments/" + str(cast_info["cast"]) + ".npz")
+    os.makedirs(os.path.dirname(segment_file), exist_ok=True)
+    seg_table.save_segments(segment_file, segments)
+    return {"segment_file": segment_file, "report": report}, [segment_file]
+
+def stage_subsets(config, cast_info, done):
+    segments = seg_table.load_segments(done["segments"]["segment_file"]) # .json segment files of earlier runs load too
+    sv_cache = SvCache(os.path.normpath(config["output_path"] + "/Sv_cache"), config["sv_cache_gb"])
+    policy = dict(config["subset_policy"], dtype=config.get("dtype", "float64"))
+    subset_dic, manifest = process.policy_subset_maker(segments, done["raw_match"]["raw_files"], config["transducer_offset"],
+                                                       policy, sv_cache, cast_info["cast"])
+    store_path = os.path.normpath(config["output_path"] + "/subset_store")
+    shutil.rmtree(os.path.join(store_path, str(cast_info["cast"])), ignore_errors=True) # so old depths are not left behind
+    store.save_cast_subsets(store_path, cast_info["cast"], subset_dic)
+    cast_path = os.path.join(store_path, str(cast_info["cast"]))
+    return {"depths": list(subset_dic.keys()), "manifest": manifest}, [os.path.join(cast_path, fn) for fn in os.listdir(cast_path)]
+
+def stage_mfi(config, cast_info, done):
+    store_path = os.path.normpath(config["output_path"] + "/subset_store")
+    dtype = config.get("dtype", "float64")
+    subset_dic = {depth: store.load_subset(store_path, cast_info["cast"], depth, dtype=dtype) for depth in done["subsets"]["depths"]}
+    mfi_dic = process.calc_MFI_batch(subset_dic, dtype=dtype, **config["mfi"])
+    store.save_cast_subsets(store_path, cast_info["cast"], subset_dic, mfi_dic) # Sv is saved as float32, so it is not changed
+    cast_path = os.path.join(store_path, str(cast_info["cast"]))
+    return {"mfi_depths": [depth for depth in mfi_dic if mfi_dic[depth].data is not None]}, \
+           [os.path.join(cast_path, fn) for fn in os.listdir(cast_path)]
+
+def stage_abc(config, cast_info, done):
+    store_path = os.path.normpath(config["output_path"] + "/subset_store")
+    dtype = config.get("dtype", "float64")
+    subsets = {}
+    no_abc_fq = [] # depths whose abc_fq was dropped by the subset policy - the other depths of the cast still get ABC
+    for depth in done["mfi"]["mfi_depths"]:
+        with store.load_subset_arrays(store_path, cast_info["cast"], depth) as arrays:
+            has_abc_fq = str(config["abc_fq"]) in store.store_frequencies(arrays)
+        if not has_abc_fq:
+            no_abc_fq.append(depth)
+            continue
+        subsets[(cast_info["cast"], depth)] = (store.load_mfi(store_path, cast_info["cast"], depth, dtype),
+                                               store.load_subset(store_path, cast_info["cast"], depth, [config["abc_fq"]],
+                                                                 dtype)[str(config["abc_fq"])])
+    # ABC of the mask ranges and of every MFI class in one pass
+    classes = dict(process.MFI_CLASSES, mask=config["mask_ranges"])
+    table = process.class_ABC_table(subsets, classes, dtype)
+    abc_dic = {depth: abc for depth, name, abc in zip(table["depth"], table["class"], table["abc"]) if name == "mask"}
+    return {"abc": abc_dic, "classes": table, "no_abc_fq": no_abc_fq}, []
+
+# stages in the order they are run - (name, function, stages it depends on, function returning the inputs/parameters of the
+# stage that are not outputs of other stages)
+STAGES = [("evl", stage_evl, [], lambda config, cast_info: {"asc": file_hash(cast_info["asc"]), "toffset": cast_info["toffset"]}),
+          ("raw_match", stage_raw_match, ["evl"], lambda config, cast_info: {"raw_files": sorted(cast_info["raw_files"]),
+                                                                            "raw_duration": config["raw_duration"]}),
+          ("segments", stage_segments, ["evl"], lambda config, cast_info: {"eDNA_depths": cast_info["eDNA_depths"],
+                                                                           "transducer_offset": config["transducer_offset"],
+                                                                           "atol_depths": config["atol_depths"]}),
+          ("subsets", stage_subsets, ["raw_match", "segments"], lambda config, cast_info: {"policy": config["subset_policy"],
+                                                                         "transducer_offset": config["transducer_offset"],
+                                                                         "dtype": config.get("dtype", "float64")}),
+          ("mfi", stage_mfi, ["subsets"], lambda config, cast_info: {"mfi": config["mfi"], "dtype": config.get("dtype", "float64")}),
+          ("abc", stage_abc, ["mfi"], lambda config, cast_info: {"mask_ranges": config["mask_ranges"], "abc_fq": config["abc_fq"],
+                                                                 "dtype": config.get("dtype", "float64")})]
+
+def run_cast(config, cast_info, force = []):
+    '''
+    run_cast: runs every stage of one cast that is out of date - used by run_survey in each worker process
+    Inputs: config (dictionary) - see default_pipeline_config
+            cast_info (dictionary) - one cast from read_casts_list, with "raw_files" (all .raw filenames of the leg) added
+            force (string list) - names of stages to re-run even if they are up to date - stages after them are only re-run if
+                                  the outputs changed
+    Output: cast state dictionary - stage names as keys and dictionaries with "status" ("run", "skipped", "failed", or "blocked"),
+            "key", "outputs", "files", and "error" (traceback if the stage failed) as values - also saved at
+            output_path/pipeline/cast.json
+    '''
+    if len(config.get("trace_file", "")) != 0 and trace.trace_state["file"] != os.path.abspath(config["trace_file"]):
+        trace.enable_trace(config["trace_file"]) # legs can have their own trace files
+    state_file = os.path.normpath(config["output_path"] + "/pipeline/" + str(cast_info["cast"]) + ".json")
+    old_state = SvCache.read_json(state_file, {})
+    state = {}
+    done = {} # outputs of the stages run (or skipped) so far
+    for name, stage, depends, stage_inputs in STAGES:
+        if any(state[dep]["status"] in ["failed", "blocked"] for dep in depends):
+            state[name] = {"status": "blocked", "key": None, "outputs": None, "files": [], "error": None}
+            continue
+        try:
+            inputs = stage_inputs(config, cast_info)
+            if name == "subsets": # Sv depends on the contents of the .raw files, not just their names
+                sv_cache = SvCache(os.path.normpath(config["output_path"] + "/Sv_cache"), config["sv_cache_gb"])
+                inputs["raw"] = [sv_cache.raw_hash(raw) for raw in done["raw_match"]["raw_files"]]
+            key = value_hash({"version": PIPELINE_VERSION, "stage": name, "inputs": inputs,
+                              "depends": {dep: state[dep]["output_hash"] for dep in depends}})
+            old = old_state.get(name, {})
+            up_to_date = old.get("status") in ["run", "skipped"] and old.get("key") == key and \
+                         all(os.path.exists(fn) for fn in old.get("files", []))
+            if up_to_date and name not in force:
+                state[name] = dict(old, status="skipped")
+            else:
+                with trace.span(name, cast=cast_info["cast"], leg=config["name"]):
+                    outputs, files = stage(config, cast_info, done)
+                state[name] = {"status": "run", "key": key, "outputs": outputs, "files": files, "error": None,
+                               "output_hash": value_hash([outputs] + [file_hash(fn) for fn in sorted(files)])}
+            done[name] = state[name]["outputs"]
+        except Exception: # only this cast stops - other casts keep running
+            state[name] = {"status": "failed", "key": None, "outputs": None, "files": [], "error": traceback.format_exc()}
+
+        SvCache.write_json(state_file, state) # save after every stage so finished stages are kept if the run is stopped
+    return state
+
+def run_survey(configs, processes = None, casts = None, force = []):
+    '''
+    run_survey: runs the pipeline for every cast of one or more legs of a survey on one process pool, so casts of all legs are
+                run at the same time
+    Inputs: configs (list of dictionaries) - one config per leg (see default_pipeline_config)
+            processes (integer) - number of worker processes - defaults to the number of CPUs
+            casts (integer list) - optional list of cast numbers to run - all casts are run if None
+            force (string list) - names of stages to re-run even if they are up to date (see run_cast)
+    Outputs: list of summary dictionaries, one per leg, with cast numbers as keys and cast states (see run_cast) as values - each
+             is also saved at output_path/pipeline/summary.json along with abc.json, subset_manifest.json, and (if
+             config["export_json"]) the .json files used by the R code
+    Note: if the script calling this is run on macOS or Windows, call it under if __name__ == "__main__":
+    '''
+    trace_files = list(dict.fromkeys(config.get("trace_file", "") for config in configs if len(config.get("trace_file", "")) != 0))
+    jobs = []
+    for leg, config in enumerate(configs):
+        os.makedirs(os.path.normpath(config["output_path"] + "/pipeline"), exist_ok=True)
+        raw_files = [os.path.basename(raw) for raw in glob.glob(os.path.normpath(config["raw_path"] + "/*.raw"))]
+        for cast_info in read_casts_list(config):
+            if casts is None or cast_info["cast"] in casts:
+                cast_info["raw_files"] = raw_files
+                jobs.append((leg, cast_info))
+
+    summaries = [{} for _ in configs]
+    if len(trace_files) != 0: # turned on before the pool starts so every worker traces (see CTD_EK_trace.py)
+        trace.enable_trace(trace_files[0])
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(run_cast, configs[leg], cast_info, force) for leg, cast_info in jobs]
+        for (leg, cast_info), future in zip(jobs, futures):
+            try:
+                summaries[leg][cast_info["cast"]] = future.result()
+            except Exception: # the worker itself died (i.e. crashed while decoding a .raw file)
+                summaries[leg][cast_info["cast"]] = {"worker": {"status": "failed", "error": traceback.format_exc()}}
+
+    for config, summary in zip(configs, summaries):
+        save_leg_outputs(config, summary)
+        failed = [cast for cast in summary if any(stage["status"] == "failed" for stage in summary[cast].values())]
+        print(config["name"] + ": " + str(len(summary)) + " casts, " + str(len(failed)) + " failed " + str(failed))
+    if len(trace_files) != 0:
+        trace.disable_trace()
+    for trace_file in trace_files:
+        table = trace.trace_summary(trace_file, by=["leg"])
+        trace.print_summary(table)
+        process.table_to_csv(table, os.path.splitext(trace_file)[0] + "_summary.csv")
+    return summaries
+
+def run_pipeline(config, processes = None, casts = None, force = []):
+    '''
+    run_pipeline: runs the pipeline for one leg - see run_survey
+    Output: summary dictionary with cast numbers as keys and cast states (see run_cast) as values
+    '''
+    return run_survey([config], processes, casts, force)[0]
+
+def save_leg_outputs(config, summary):
+    '''
+    save_leg_outputs: saves the files that combine every cast of a leg - the pipeline summary, abc.json (same format as
+                      mfi_masks_ABC.py), subset_manifest.json (see policy_subset_casts - its "no_abc" list holds the subsets
+                      without ABC because abc_fq was removed from them), and the .json files of the store
+    Inputs: config (dictionary) - see default_pipeline_config
+            summary (dictionary) - cast numbers as keys and cast states as values (see run_cast)
+    '''
+    output_path = config["output_path"]
+    with open(os.path.normpath(output_path + "/pipeline/summary.json"), 'w') as outfile:
+        json.dump({str(cast): {name: {"status": stage["status"], "error": stage["error"]} for name, stage in summary[cast].items()}
+                   for cast in summary}, outfile, indent=1)
+
+    # casts that did not finish keep their results from earlier runs
+    abc_dic = SvCache.read_json(os.path.normpath(output_path + "/abc.json"), {})
+    entries, no_abc = [], []
+    for cast in summary:
+        state = summary[cast]
+        if state.get("abc", {}).get("status") in ["run", "skipped"]:
+            abc_dic[str(cast)] = state["abc"]["outputs"]["abc"]
+            no_abc += [[cast, depth] for depth in state["abc"]["outputs"].get("no_abc_fq", [])]
+        if state.get("subsets", {}).get("status") in ["run", "skipped"]:
+            entries += state["subsets"]["outputs"]["manifest"]
+    with open(os.path.normpath(output_path + "/abc.json"), 'w') as outfile:
+        json.dump(abc_dic, outfile)
+    tables = [state["abc"]["outputs"]["classes"] for state in summary.values() if state.get("abc", {}).get("status") in ["run", "skipped"]]
+    if len(tables) != 0:
+        process.table_to_csv({column: sum([table[column] for table in tables], []) for column in tables[0]},
+                             os.path.normpath(output_path + "/abc_classes.csv"))
+    policy = config["subset_policy"]
+    with open(os.path.normpath(output_path + "/subset_manifest.json"), 'w') as outfile:
+        json.dump({"policy": {key: (value if key != "quality" else {str(fq): value[fq] for fq in value}) for key, value in policy.items()},
+                   "subsets": entries, "review": [[entry["cast"], entry["depth"]] for entry in entries if entry["review"]],
+                   "no_abc": no_abc},
+                  outfile, indent=1)
+
+    ran = any(stage["status"] == "run" for state in summary.values() for stage in state.values())
+    store_path = os.path.normpath(output_path + "/subset_store")
+    if config["export_json"] and ran and os.path.isdir(store_path):
+        store.store_to_json(store_path, output_path)
@@ -9,16 +9,20 @@ Hollings Scholarship Research Project
 '''
 
 
-from echolab2.processing import line
 import os
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from echolab2.plotting.matplotlib import echogram
 import numpy as np
+import CTD_EK_evl as evl_traces
 import CTD_EK_processing as process
+import CTD_EK_segments as seg_table
+import CTD_EK_trace as trace
 import math
 import matplotlib.colors as mcolors
 import matplotlib.ticker as ticker
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 def plot_evl(ax, evl_infile, evl_path="", title = ""):
     '''
@@ -33,11 +37,10 @@ def plot_evl(ax, evl_infile, evl_path="", title = ""):
             After running function plt.show(), plt.savefig(), or plt.close() can all be run
     '''
     print("Plotting: " + evl_infile)
-    evl_line = line.read_evl(os.path.normpath(evl_path + "/" + evl_infile))
-    dt = evl_line.ping_time
-    depth = evl_line.data
+    with trace.span("plot_evl", evl=os.path.basename(evl_infile)):
+        dt, depth = evl_traces.evl_trace(os.path.normpath(evl_path + "/" + evl_infile))
 
-    ax.plot(dt, depth)
+        ax.plot(dt, depth)
     # title
     if len(title) ==0:
         title = os.path.basename(evl_infile) + ": CTD Profile"
@@ -55,17 +58,103 @@ def plot_evl(ax, evl_infile, evl_path="", title = ""):
     ax.xaxis.set_major_locator(mdates.MinuteLocator(interval=min_int)) # to get a tick every min_int
     ax.invert_yaxis()
 
-def plot_echo(ax, ek, fq, fq_thresholds = [-90, -20], transducer_offset = 0.0, title = ""):
+def prepare_echogram(ax, Sv, time_lim = None, depth_lim = None, method = "mean", decimate = True):
+    '''
+    prepare_echogram: clips Sv to the part that will be shown and reduces it to the pixels of the axes, so the echogram doesn't
+                      draw millions of cells that never reach the saved image
+    Inputs: ax (matplotlib.pyplot axes object) - axes the echogram will be drawn on - its size and the figure/savefig dpi set the
+                                                 number of pixels
+            Sv (processed data object from pyEcholab) - Sv data object
+            time_lim (numpy datetime64 list) - optional [start time, end time] that will be shown
+            depth_lim (float list) - optional [top, bottom] depths (either order) that will be shown
+            method (string) - "mean" (linear domain average, for layers) or "max" (for small targets) - see decimate_Sv
+            decimate (boolean) - if False Sv is only clipped
+    Outputs: clipped (and decimated) Sv data object - Sv itself is not changed
+    '''
+    ping_time = np.asarray(Sv.ping_time)
+    depth = np.asarray(Sv.depth)
+    x_idx = [0, len(ping_time) - 1]
+    y_idx = [0, len(depth) - 1]
+    if time_lim is not None:
+        time_lim = np.array(time_lim, dtype=ping_time.dtype)
+        x_idx = [np.searchsorted(ping_time, time_lim.min(), "right") - 1, np.searchsorted(ping_time, time_lim.max(), "left")]
+    if depth_lim is not None: # one sample past each limit so the edges of the plot are covered
+        y_idx = [np.searchsorted(depth, min(depth_lim), "right") - 1, np.searchsorted(depth, max(depth_lim), "left")]
+    x_idx = np.clip(x_idx, 0, len(ping_time) - 1)
+    y_idx = np.clip(y_idx, 0, len(depth) - 1)
+    clipped = process.crop_Sv(Sv, x_idx, y_idx)
+    if not decimate:
+        return clipped
+
+    pixels = axes_pixels(ax)
+    block = [math.ceil(clipped.data.shape[0]/pixels[0]), math.ceil(clipped.data.shape[1]/pixels[1])]
+    if block == [1, 1]: # already fewer pings and samples than pixels
+        return clipped
+    return process.decimate_Sv(clipped, block, method)
+
+def axes_pixels(ax):
+    '''
+    axes_pixels: [width, height] of an axes in pixels of the saved image (savefig dpi, or the figure dpi if it is "figure")
+    '''
+    dpi_scale = 1.0
+    savefig_dpi = plt.rcParams["savefig.dpi"]
+    if savefig_dpi != "figure":
+        dpi_scale = float(savefig_dpi)/ax.figure.dpi
+    bbox = ax.get_window_extent()
+    return [max(int(bbox.width*dpi_scale), 1), max(int(bbox.height*dpi_scale), 1)]
+
+def pyramid_level(ax, pyramid, time_lim = None, depth_lim = None):
+    '''
+    pyramid_level: picks the coarsest level of an Sv pyramid that still has at least one ping and sample per pixel of the axes
+                   within the limits, so the view looks the same as at full resolution
+    Inputs: ax (matplotlib.pyplot axes object) - axes the echogram will be drawn on
+            pyramid (list) - Sv pyramid, see CTD_EK_processing.Sv_pyramid
+            time_lim, depth_lim - optional limits of the view - see prepare_echogram
+    Output: Sv data object of the chosen level
+    '''
+    pixels = axes_pixels(ax)
+    for Sv in reversed(pyramid):
+        ping_time = np.asarray(Sv.ping_time)
+        depth = np.asarray(Sv.depth)
+        n_pings, n_samples = len(ping_time), len(depth)
+        if time_lim is not None:
+            time_lim = np.array(time_lim, dtype=ping_time.dtype)
+            n_pings = np.searchsorted(ping_time, time_lim.max(), "right") - np.searchsorted(ping_time, time_lim.min(), "left")
+        if depth_lim is not None:
+            n_samples = np.searchsorted(depth, max(depth_lim), "right") - np.searchsorted(depth, min(depth_lim), "left")
+        if n_pings >= pixels[0] and n_samples >= pixels[1]:
+            return Sv
+    return pyramid[0]
+
+def trace_limits(depth_line, time_offset = [2, 0]):
+    '''
+    trace_limits: time and depth limits to zoom in on a CTD trace (see plot_evl_trace)
+    Inputs: depth_line (pyEcholab line object) - CTD trace read with line.read_evl or CTD_EK_evl.evl_line
+            time_offset (integer list) - minutes to show before and after the trace
+    Outputs: ([start time, end time], [bottom depth, 0])
+    '''
+    return [min(depth_line.ping_time) - np.timedelta64(time_offset[0], 'm'), max(depth_line.ping_time) + np.timedelta64(time_offset[1], 'm')], \
+           [max(depth_line.data) * 1.35, 0]
+
+def plot_echo(ax, ek, fq, fq_thresholds = [-90, -20], transducer_offset = 0.0, title = "", time_lim = None, depth_lim = None,
+              decimate = None, method = "mean"):
     '''
     plot_echo: plots an echogram with a given EK80 object from pyEcholab, option of adding a CTD trace overlay, zooming
                in on the trace, and saving/showing the file
     Input: ek (EK80 object from pyEcholab) - ek object - must have already read in the raw file to the ek object
+                  - can also be a dictionary returned by raw_files_to_Sv so Sv is not recalculated (i.e. from an SvCache)
+                  or by raw_files_to_pyramid so the lowest resolution that looks the same is drawn
            ax (matplotlib.pyplot axes object) - axes object created from matplotlib.pyplot.subplots() call
            fq (integer) - frequency of the raw data to plot - 18000, 38000, 70000, 120000, 200000 are frequent options
            fq_thresholds (two element integer list) - [lower dB threshold, upper dB threshold] defines the range of decible
                                                     that are not considered noise
            transducer_offset (double) - optional transducer offset in meters
            title (string) - title to be displayed at the top of plot - default is frequency Hz
+           time_lim, depth_lim - optional time and depth limits - only this part of Sv is drawn (see prepare_echogram)
+           decimate (boolean) - if True Sv is reduced to the pixels of the axes before drawing (see prepare_echogram) - if None
+                                (default) only when time_lim or depth_lim is given, since the pixels of the whole cast look
+                                blocky if the axes are zoomed in afterwards (i.e. with set_ylim or plot_evl_trace)
+           method (string) - how Sv is reduced - "mean" or "max" (see decimate_Sv)
     Outputs: Returns echogram object - plot_evl-trace takes in this object
              After running function plt.show(), plt.savefig(), or plt.close() can all be run
     '''
@@ -75,8 +164,87 @@ def plot_echo(ax, ek, fq, fq_thresholds = [-90, -20], transducer_offset = 0.0, t
     ax.set_title(title)
     ax.tick_params(axis='x', labelrotation=15)
    
-    Sv, _ = process.raw_to_Sv(ek, fq, transducer_offset)
-    echo_plot = echogram.Echogram(ax, Sv, threshold=[fq_thresholds[0],fq_thresholds[1]])
+    if isinstance(ek, dict):
+        Sv, _ = ek[fq]
+        if isinstance(Sv, list): # Sv pyramid (see raw_files_to_pyramid)
+            Sv = pyramid_level(ax, Sv, time_lim, depth_lim)
+    else:
+        with trace.span("get_Sv", frequency=fq):
+            Sv, _ = process.raw_to_Sv(ek, fq, transducer_offset)
+    if decimate is None:
+        decimate = time_lim is not None or depth_lim is not None
+    if decimate or time_lim is not None or depth_lim is not None:
+        with trace.span("prepare_echogram", frequency=fq, pings=Sv.n_pings):
+            Sv = prepare_echogram(ax, Sv, time_lim, depth_lim, method, decimate)
+    with trace.span("plot_echo", frequency=fq, pings=Sv.n_pings):
+        echo_plot = echogram.Echogram(ax, Sv, threshold=[fq_thresholds[0],fq_thresholds[1]])
+    return echo_plot
+
+def plot_echo_pyramid(ax, pyramid, fq_thresholds = [-90, -20], title = "", time_lim = None, depth_lim = None, method = "mean"):
+    '''
+    plot_echo_pyramid: plots an echogram from an Sv pyramid that is redrawn from the best level whenever the view changes (zooming
+                       or panning in an interactive window), so only about one cell per pixel is ever drawn
+    Inputs: ax (matplotlib.pyplot axes object) - axes object created from matplotlib.pyplot.subplots() call
+            pyramid (list) - Sv pyramid of one frequency, see CTD_EK_processing.Sv_pyramid and raw_files_to_pyramid
+            fq_thresholds (two element integer list), title (string) - see plot_echo
+            time_lim, depth_lim - optional limits of the first view - the whole cast is shown if not given
+            method (string) - how Sv is reduced to the pixels within a level - see decimate_Sv
+    Outputs: echogram object of the first view - plot_evl_trace takes in this object
+    Note: the echogram is drawn for half a view more on every side than is shown, so small pans are not redrawn
+    '''
+    unit = np.datetime_data(np.asarray(pyramid[0].ping_time).dtype)[0]
+    drawn = {"Sv": None, "time": None, "depth": None, "busy": False}
+
+    def draw(time_lim, depth_lim):
+        '''
+        draw: draws the best level for a view, with a margin of half a view on every side
+        '''
+        Sv = pyramid_level(ax, pyramid, time_lim, depth_lim)
+        if time_lim is not None:
+            time_lim = np.array(time_lim, dtype=np.asarray(Sv.ping_time).dtype)
+            margin = (time_lim.max() - time_lim.min())/2
+            time_lim = [time_lim.min() - margin, time_lim.max() + margin]
+        if depth_lim is not None:
+            margin = (max(depth_lim) - min(depth_lim))/2
+            depth_lim = [max(min(depth_lim) - margin, 0), max(depth_lim) + margin]
+        view = prepare_echogram(ax, Sv, time_lim, depth_lim, method, decimate=False) # levels are already close to the pixels
+        for image in list(ax.images):
+            image.remove()
+        echo_plot = echogram.Echogram(ax, view, threshold=[fq_thresholds[0], fq_thresholds[1]])
+        drawn.update({"Sv": Sv, "time": (view.ping_time[0], view.ping_time[-1]), "depth": (view.depth[0], view.depth[-1])})
+        return echo_plot
+
+    def on_view_change(ax):
+        '''
+        on_view_change: redraws if the view needs a different level or goes past what was drawn
+        '''
+        if drawn["busy"]:
+            return
+        xlim, ylim = ax.get_xlim(), ax.get_ylim()
+        time_lim = [np.datetime64(int(round(x)), unit) for x in xlim]
+        depth_lim = [min(ylim), max(ylim)]
+        inside = drawn["time"][0] <= min(time_lim) and max(time_lim) <= drawn["time"][1] and \
+                 drawn["depth"][0] <= max(depth_lim[0], 0) and depth_lim[1] <= drawn["depth"][1]
+        if inside and pyramid_level(ax, pyramid, time_lim, depth_lim) is drawn["Sv"]:
+            return
+        drawn["busy"] = True # changing the limits back below would call this again
+        with trace.span("pyramid_redraw"):
+            draw(time_lim, depth_lim)
+            ax.set_xlim(xlim)
+            ax.set_ylim(ylim)
+        drawn["busy"] = False
+        ax.figure.canvas.draw_idle()
+
+    if len(title) != 0:
+        ax.set_title(title)
+    ax.tick_params(axis='x', labelrotation=15)
+    echo_plot = draw(time_lim, depth_lim)
+    if time_lim is not None:
+        ax.set_xlim([np.datetime64(t, unit).astype('float') for t in sorted(time_lim)])
+    if depth_lim is not None:
+        ax.set_ylim(max(depth_lim), min(depth_lim))
+    ax.callbacks.connect("xlim_changed", on_view_change)
+    ax.callbacks.connect("ylim_changed", on_view_change)
     return echo_plot
 
 def plot_evl_trace(ax, echo_plot, trace_infn, trace_path = "", zoom = True, time_offset = [2, 0], lwidth = 2.5):
@@ -95,14 +263,12 @@ def plot_evl_trace(ax, echo_plot, trace_infn, trace_path = "", zoom = True, time
     '''
     print("Adding CTD profile: " + trace_infn)
     trace_infn = os.path.normpath(trace_path + "/" + trace_infn)
-    depth_line = line.read_evl(trace_infn)
+    depth_line = evl_traces.evl_line(trace_infn) # shared with plot_evl, trace_limits, and the segment makers
     echo_plot.plot_line(depth_line, linewidth=lwidth, color = "black")
     if zoom:
-        echo_bottom = max(depth_line.data) * 1.35
-        x_lims = ((min(depth_line.ping_time) - np.timedelta64(time_offset[0], 'm')).astype('float'), 
-                 (max(depth_line.ping_time) + np.timedelta64(time_offset[1], 'm')).astype('float'))
-        ax.set_ylim(echo_bottom, 0)
-        ax.set_xlim(x_lims[0], x_lims[1])
+        time_lim, depth_lim = trace_limits(depth_line, time_offset)
+        ax.set_ylim(depth_lim[0], depth_lim[1])
+        ax.set_xlim(time_lim[0].astype('float'), time_lim[1].astype('float'))
     return echo_plot
 
 
@@ -110,7 +276,8 @@ def plot_segments(segments, title = "CTD Profile Segments", show = True):
     '''
     plot_segments: plotting function designed for verification of segment seperation success after running 
                    create_segments_dic() or mark_usable_depth() 
-    Inputs: segments (nested dictionary) - segment dictionary created by create_segments_dic function
+    Inputs: segments (nested dictionary) - segment dictionary created by create_segments_dic function, or a segment table
+                                           (see CTD_EK_segments.py)
             title (string) - optional string title for graph
             show (boolean) - if True, show segments - needed for interactive segment finder
     Outputs: shows a graph with ascents and decents marked in red, plateaus in blue, and usable segments
@@ -118,14 +285,12 @@ def plot_segments(segments, title = "CTD Profile Segments", show = True):
     Note: This is used in CTD_EK_processing.py for segment creation vertification
     '''
     fig, ax = plt.subplots()
-    for num in segments:
+    for num, bottle, usable, _, x_seg, y_seg in seg_table.segment_rows(segments):
         style = 'r-'
-        if segments[num]["bottle"]:
+        if bottle:
             style = 'b-'
-            if segments[num]["usable"]:
+            if usable:
                 style = 'b:'
-        x_seg, y_seg = zip(*segments[num]["points"])
-        x_seg = [np.datetime64(date) for date in x_seg]
         ax.plot(x_seg, y_seg, style)
         ax.xaxis.set_major_locator(mdates.MinuteLocator(interval=3))
 
@@ -176,8 +341,9 @@ def plot_MFI(ax, mfi, title = "", label_size = 14):
     yticks = mfi.depth
     xticks = mfi.ping_time.astype('float')
     # plot
-    mfi_image = ax.imshow(mfi_data, cmap=cmap, norm = norm, aspect='auto', interpolation='none', 
-                extent=[xticks[0], xticks[-1], yticks[-1], yticks[0]], origin='upper')
+    with trace.span("plot_MFI", pings=len(xticks)):
+        mfi_image = ax.imshow(mfi_data, cmap=cmap, norm = norm, aspect='auto', interpolation='none', 
+                    extent=[xticks[0], xticks[-1], yticks[-1], yticks[0]], origin='upper')
 
     # axis aesthetics
     ax.xaxis.set_major_formatter(ticker.FuncFormatter(format_datetime))
@@ -206,3 +372,105 @@ def plot_MFI(ax, mfi, title = "", label_size = 14):
         print(y)
         cbar.ax.text(x,y,label, size = label_size)
     return mfi_image
+
+
+# Batch rendering - figures are described by job dictionaries holding already calculated Sv/MFI, so they can be drawn by worker
+# processes with a non-interactive backend while the main process keeps calculating
+
+def render_profile(job):
+    '''
+    render_profile: saves the CTD profile figure of one cast (see plot_evl)
+    Inputs: job (dictionary) - "outfile" (path and filename of the .png), "evl_file" (path and filename of the .evl file), and
+                               optional "title"
+    '''
+    fig, ax = plt.subplots(figsize = (10,8))
+    plot_evl(ax, job["evl_file"], title=job.get("title", ""))
+    plt.savefig(job["outfile"])
+    plt.close(fig)
+
+def render_echograms(job):
+    '''
+    render_echograms: saves a grid of echograms (one per frequency) with the CTD profile overlayed (see plot_echo and plot_evl_trace)
+    Inputs: job (dictionary) - "outfile" (path and filename of the .png), "Sv" (dictionary with frequencies as keys and Sv objects
+                               as values, i.e. from raw_files_to_Sv), and optional "evl_file" (.evl file to overlay), "title",
+                               "fq_thresholds", "grid" (rows, columns - default (2, 2)), "figsize", and "method" (see decimate_Sv)
+    '''
+    rows, columns = job.get("grid", (2, 2))
+    fig, axs = plt.subplots(rows, columns, figsize=job.get("figsize", (12,10)), constrained_layout = True, squeeze=False)
+    fig.suptitle(job.get("title", ""))
+    Sv_dic = {fq: (Sv, None) for fq, Sv in job["Sv"].items()} # format plot_echo takes, so Sv is not recalculated
+    time_lim, depth_lim = None, None
+    if len(job.get("evl_file", "")) != 0: # only the part of Sv around the trace is drawn
+        time_lim, depth_lim = trace_limits(evl_traces.evl_line(job["evl_file"]))
+    for fq, ax in zip(job["Sv"], axs.ravel()):
+        echo_plot = plot_echo(ax, Sv_dic, fq, job.get("fq_thresholds", [-90, -20]), time_lim=time_lim, depth_lim=depth_lim,
+                              method=job.get("method", "mean"))
+        if len(job.get("evl_file", "")) != 0:
+            plot_evl_trace(ax, echo_plot, job["evl_file"])
+    plt.savefig(job["outfile"])
+    plt.close(fig)
+
+def render_mfi(job):
+    '''
+    render_mfi: saves the MFI figure of one subset (see plot_MFI)
+    Inputs: job (dictionary) - "outfile" (path and filename of the .png), "mfi" (MFI processed data object, see calc_MFI), and
+                               optional "title" and "figsize"
+    '''
+    fig, ax = plt.subplots(figsize=job.get("figsize", (18,4)))
+    plot_MFI(ax, job["mfi"], job.get("title", ""))
+    plt.savefig(job["outfile"])
+    plt.close(fig)
+
+RENDERERS = {"profile": render_profile, "echograms": render_echograms, "mfi": render_mfi}
+
+def init_render_worker(rc_params):
+    '''
+    init_render_worker: sets up a worker process of render_figures - non-interactive backend and the plot aesthetics of the script
+    '''
+    plt.switch_backend("Agg")
+    plt.rcParams.update(rc_params)
+
+def render_job(job):
+    '''
+    render_job: draws and saves one figure job in a worker process
+    Output: (outfile, error) - error is None if the figure was saved, otherwise the traceback (one bad figure doesn't stop the rest)
+    '''
+    try:
+        with trace.span("render_" + job["kind"], outfile=os.path.basename(job["outfile"])):
+            RENDERERS[job["kind"]](job)
+        return job["outfile"], None
+    except Exception:
+        plt.close("all")
+        return job["outfile"], traceback.format_exc()
+
+def render_figures(jobs, processes = None, rc_params = None, max_pending = None):
+    '''
+    render_figures: draws and saves figures on a pool of worker processes using a non-interactive backend
+    Inputs: jobs (iterable of dictionaries) - each has "kind" ("profile", "echograms", or "mfi") and the keys of its render function
+                                              (see render_profile, render_echograms, render_mfi) - can be a generator, so Sv for the
+                                              next cast can be calculated while the figures of earlier casts are drawn
+            processes (integer) - number of worker processes - defaults to the number of CPUs
+            rc_params (dictionary) - matplotlib rcParams to use in the workers - defaults to the rcParams of this process (i.e.
+                                     font sizes set by the script)
+            max_pending (integer) - most jobs waiting for a worker at once, which limits the memory held by their Sv - defaults to
+                                    twice the number of processes
+    Output: list of (outfile, error) for every job in the order they finished - error is None if the figure was saved
+    Note: if the script calling this is run on macOS or Windows, call it under if __name__ == "__main__":
+    '''
+    if rc_params is None:
+        rc_params = {key: value for key, value in plt.rcParams.items() if key != "backend"}
+    if max_pending is None:
+        max_pending = 2*(processes if processes is not None else os.cpu_count())
+    results = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_render_worker, initargs=(rc_params,)) as pool:
+        pending = set()
+        for job in jobs:
+            if len(pending) >= max_pending: # wait for a figure to finish before sending more data to the workers
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                results.extend(future.result() for future in finished)
+            pending.add(pool.submit(render_job, job))
+        results.extend(future.result() for future in wait(pending)[0])
+    for outfile, error in results:
+        if error is not None:
+            print("Could not plot " + outfile + ":\n" + error)
+    return results
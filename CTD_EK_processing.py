@@ -10,7 +10,7 @@ Hollings Scholarship Research Project
 '''
 
 from echolab2.plotting.matplotlib import echogram
-from echolab2.processing import line, processed_data
+from echolab2.processing import processed_data
 from echolab2.instruments import EK80
 from datetime import datetime, timedelta
 from statistics import mean
@@ -20,16 +20,23 @@ import math
 from math import isclose
 from scipy.signal import savgol_filter
 import matplotlib.pyplot as plt
+from matplotlib.patches import Rectangle
 from numpy.ma import sort
 import json
 import CTD_EK_plotting as plotting
+import CTD_EK_evl as evl_traces
+import CTD_EK_rawindex as rawindex
+import CTD_EK_segments as seg_table
+import CTD_EK_sv as dual_sv
+import CTD_EK_trace as trace
 import glob
-from itertools import combinations
+from itertools import islice
 import warnings
 import copy
+from concurrent.futures import ProcessPoolExecutor
 
 
-def asc_to_evl(ctd_list_fn, infile_path, outfile_path, echoview_version = "EVBD 3 9.0.298.34146"):
+def asc_to_evl(ctd_list_fn, infile_path, outfile_path, echoview_version = "EVBD 3 9.0.298.34146", chunk_size = 100000):
     '''
     asc_to_evl: takes a file with a list of .asc files and time offsets for cast relative to acoustic data and writes .evl files;
                 each .evl file has sample times, mean depth, and status of the data (3 if good, 2 if depth is negative of NaN)
@@ -50,6 +57,9 @@ def asc_to_evl(ctd_list_fn, infile_path, outfile_path, echoview_version = "EVBD
                 Format: EVBD 3 echoview_version
                 Example: EVBD 3 9.0.298.34146
 
+            chunk_size (integer) - optional number of .asc lines parsed at once - only the per second sums are kept between chunks
+                                   so memory does not grow with the number of scans in a cast
+
     Outputs: a .evl file for each .asc file saved at outfile_path that takes into account the time offset of cast and acoustics
              and denotes good/bad data points with 3 or 2 respectivly. It has the following format, with one line per data point:
 
@@ -58,7 +68,7 @@ def asc_to_evl(ctd_list_fn, infile_path, outfile_path, echoview_version = "EVBD
             
             Note there are also 2 headers, needed for reading into Echoview: an Echoview version and the number of data points
     '''
-    
+
     ctd_list_path = os.path.normpath(infile_path + '/'+ ctd_list_fn) # list is assumed to exist
 
     # read the entire file as a list of lines
@@ -72,45 +82,94 @@ def asc_to_evl(ctd_list_fn, infile_path, outfile_path, echoview_version = "EVBD
         toffset = int(toffset)
 
         print('Doing: ', asc_infn_path, 'with toffset: ', toffset)
-
-        # open each .asc file and read data
-        with open(asc_infn_path, 'r', encoding = "ISO-8859-1") as asc_file: # encoding allows reading of epsilons in header
-            ctd_data = asc_file.readlines()
-
-        data = {}
-        for sample in ctd_data[1:]: # first line is header for each column
-            sample.rstrip()
-            # there are more than 7 data types, but we only need data/time/depth
-            (Scan, date, time, lat, lon, PrDM, depth, tmpvars) = sample.split(maxsplit=7)
-            (month, day, year) = str.split(date, sep='/')
-            (hour, minute, second) = str.split(time, sep=':')
-            # create date time object for each sample
-            sample_dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))+timedelta(seconds=toffset)
-
-            # same the depths recorded for each time in a dictionary
-            if sample_dt in data:
-                data[sample_dt].append(float(depth)) # more than one depth saved for a single time
-            else:
-                data[sample_dt] = [float(depth)]
-
-        # Preparing outfile for writing
         evl_outfn = os.path.normpath(outfile_path + "/" + asc_infn.strip().replace("asc", "evl"))
-        outfile = open(evl_outfn, 'w')
-        headerline = echoview_version # the first output header line is EVBD 3, then the Echoview version
-        outfile.write(headerline+'\n')
-        outfile.write(str(len(data))+'\n') # second header is the number of data points - number of time stamps
-
-        for sample_dt, sample_depths in sorted(data.items()):
-            depth_mean = mean(sample_depths) # mean depth for any one time
-            sample_status = 3 # good data
-            if depth_mean < 0 or depth_mean is math.nan:
-                sample_status = 2 # bad data
-            outfile.write(sample_dt.strftime('%Y%m%d %H%M%S'+'0000 ')+\
-                      str(round(depth_mean, 1))+ ' ' + str(sample_status) + '\n')
-        
-        outfile.close() # close outfile
+        with trace.span("asc_to_evl", cast=asc_infn.strip()):
+            asc_file_to_evl(asc_infn_path, toffset, evl_outfn, echoview_version, chunk_size)
             
 
+def asc_file_to_evl(asc_infn_path, toffset, evl_outfn, echoview_version = "EVBD 3 9.0.298.34146", chunk_size = 100000):
+    '''
+    asc_file_to_evl: writes the .evl file of one .asc file - see asc_to_evl, which calls this for every cast in CTDtoEVL.list
+    Inputs: asc_infn_path (string) - path and filename of the .asc file
+            toffset (integer) - time offset in seconds for the cast relative to the acoustic data
+            evl_outfn (string) - path and filename of the .evl file to write
+            echoview_version (string), chunk_size (integer) - see asc_to_evl
+    Outputs: .evl file saved at evl_outfn (see asc_to_evl for format)
+    '''
+    # only the date, time, and depth columns of the .asc file are read
+    asc_dtype = np.dtype([("date", "U16"), ("time", "U16"), ("depth", float)])
+
+    def read_asc_chunks(asc_infn_path, toffset):
+        '''
+        read_asc_chunks: generator that reads an .asc file chunk_size lines at a time
+        Inputs: asc_infn_path (string) - path and filename of .asc file
+                toffset (integer) - time offset in seconds for the cast relative to the acoustic data
+        Outputs: yields (seconds, depths) numpy arrays for each chunk - seconds are integer seconds since epoch with toffset applied
+        '''
+        with open(asc_infn_path, 'r', encoding = "ISO-8859-1") as asc_file: # encoding allows reading of epsilons in header
+            asc_file.readline() # first line is header for each column
+            while True:
+                lines = list(islice(asc_file, chunk_size))
+                if len(lines) == 0:
+                    break
+                # there are more than 7 data types, but we only need data/time/depth
+                chunk = np.loadtxt(lines, dtype=asc_dtype, usecols=(1, 2, 6), comments=None, ndmin=1)
+                # samples are taken many times a second, so only parse each unique date/time once
+                stamps, stamp_idx = np.unique(np.char.add(np.char.add(chunk["date"], " "), chunk["time"]), return_inverse=True)
+                stamp_secs = np.array([asc_seconds(stamp) for stamp in stamps], dtype=np.int64) + toffset
+                yield stamp_secs[stamp_idx], chunk["depth"]
+
+    def asc_seconds(stamp):
+        '''
+        asc_seconds: turns a "month/day/year hour:minute:second" string from an .asc file into integer seconds since epoch
+        '''
+        date, time = stamp.split()
+        (month, day, year) = str.split(date, sep='/')
+        (hour, minute, second) = str.split(time, sep=':')
+        return int((datetime(int(year), int(month), int(day), int(hour), int(minute), int(second)) - datetime(1970, 1, 1)).total_seconds())
+
+    def near_rounding_edge(depth_means):
+        '''
+        near_rounding_edge: boolean mask of means that are close enough to a rounding edge at one decimal that the summation
+                            order of a vectorized mean could change the rounded value
+        '''
+        tenths = depth_means * 10
+        return np.abs(tenths - np.floor(tenths) - 0.5) < 1e-9 * np.maximum(1, np.abs(tenths))
+
+    # sum the depths recorded for each second in each chunk, then combine the chunks
+    chunk_secs, chunk_sums, chunk_counts = [np.empty(0, dtype=np.int64)], [np.empty(0)], [np.empty(0)]
+    for secs, depths in read_asc_chunks(asc_infn_path, toffset):
+        uniq_secs, secs_idx = np.unique(secs, return_inverse=True)
+        chunk_secs.append(uniq_secs)
+        chunk_sums.append(np.bincount(secs_idx, weights=depths))
+        chunk_counts.append(np.bincount(secs_idx).astype(float))
+    sample_secs, secs_idx = np.unique(np.concatenate(chunk_secs), return_inverse=True) # sorted by time
+    depth_means = np.bincount(secs_idx, weights=np.concatenate(chunk_sums), minlength=len(sample_secs)) / \
+                  np.bincount(secs_idx, weights=np.concatenate(chunk_counts), minlength=len(sample_secs))
+
+    # means that land on a rounding edge are recomputed exactly so output matches a plain mean of the samples
+    edge_idx = np.flatnonzero(near_rounding_edge(depth_means))
+    if len(edge_idx) != 0:
+        edge_depths = {sec: [] for sec in sample_secs[edge_idx].tolist()}
+        for secs, depths in read_asc_chunks(asc_infn_path, toffset):
+            in_edge = np.isin(secs, sample_secs[edge_idx])
+            for sec, depth in zip(secs[in_edge].tolist(), depths[in_edge].tolist()):
+                edge_depths[sec].append(depth)
+        depth_means[edge_idx] = [mean(edge_depths[sec]) for sec in sample_secs[edge_idx].tolist()]
+
+    # build the whole .evl file and write it once
+    sample_dts = np.datetime_as_string(sample_secs.astype("datetime64[s]"))
+    evl_lines = [echoview_version, str(len(sample_secs))] # headers are the Echoview version and the number of data points
+    for sample_dt, depth_mean in zip(sample_dts.tolist(), depth_means.tolist()):
+        sample_status = 3 # good data
+        if depth_mean < 0 or depth_mean is math.nan:
+            sample_status = 2 # bad data
+        evl_lines.append(sample_dt[0:4] + sample_dt[5:7] + sample_dt[8:10] + ' ' + sample_dt[11:13] + sample_dt[14:16] + \
+                         sample_dt[17:19] + '0000 ' + str(round(depth_mean, 1)) + ' ' + str(sample_status))
+
+    with open(evl_outfn, 'w') as outfile:
+        outfile.write('\n'.join(evl_lines) + '\n')
+
 def asc_from_list(ctd_list_fn):
     '''
     asc_from_list: takes a file with a list of .asc files and time offsets for cast relative to acoustic data and
@@ -156,7 +215,45 @@ def cast_new_extension(ctd_file_list, old_extension, new_extension, descriptor="
         new_files.append(file)
     return new_files
 
-def match_raw_evl(evl_files_list, raw_files_list, outfile_path = "", evl_inpath = "", raw_inpath = ""):
+def evl_time_bounds(evl_file):
+    '''
+    evl_time_bounds: reads only the first and last data points of a .evl file to get the start and end time of a CTD cast
+    Input: evl_file (string) - path and filename of .evl file
+    Output: (numpy datetime64 tuple) - (start time, end time) of the CTD trace
+    Note: .evl files written by asc_to_evl have points in time order, so the first and last data lines are the start and
+          end of the cast - the rest of the file is not read (or nothing is read if the trace is already cached, see CTD_EK_evl.py)
+    '''
+    cached = evl_traces.cached_evl_trace(evl_file)
+    if cached is not None:
+        return cached[0][0], cached[0][-1]
+
+    def evl_time(evl_point):
+        '''
+        evl_time: turns one .evl data line (Format: sample_date sample_time sample_mean_depth sample_status) into a datetime64
+        '''
+        date, time = evl_point.split()[0:2]
+        return np.datetime64(date[0:4] + "-" + date[4:6] + "-" + date[6:8] + "T" + time[0:2] + ":" + time[2:4] + ":" +
+                             time[4:6] + "." + time[6:9])
+
+    with open(evl_file, 'rb') as evl:
+        evl.readline() # Echoview version header
+        evl.readline() # number of points header
+        first_point = evl.readline().decode()
+        # read back from the end of the file until a full last line has been read
+        file_size = evl.seek(0, os.SEEK_END)
+        tail_size = 256
+        while True:
+            tail_start = max(0, file_size - tail_size)
+            evl.seek(tail_start)
+            tail_lines = evl.read().splitlines()
+            tail_lines = [l for l in tail_lines if len(l.strip()) != 0]
+            if tail_start == 0 or len(tail_lines) > 1:
+                break
+            tail_size *= 2
+        last_point = tail_lines[-1].decode()
+    return evl_time(first_point), evl_time(last_point)
+
+def match_raw_evl(evl_files_list, raw_files_list, outfile_path = "", evl_inpath = "", raw_inpath = "", raw_duration = 60):
     '''
     match_raw_evl: matches acoustic (raw) files to CTD casts (evl)file by time
     Inputs: evl_files_list (string list) - list of .evl filenames - if they don't have a path within the filename
@@ -166,8 +263,10 @@ def match_raw_evl(evl_files_list, raw_files_list, outfile_path = "", evl_inpath
             outfile_path (string) - path where the list of pairs of evl files and raw files is printed
             evl_inpath (string) - path to evl files, ONLY use if the filenames in evl_files_list don't have a path
             raw_inpath Istring) - path to raw files, ONLY use if the filenames in raw_files_list don't have a path
-    Outputs: evl_raw_dic (string dictionary) - keys are .evl files and the values are lists of .raw files that overlap
-             with that .evl file within a 30 minute time delay
+            raw_duration (integer) - maximum length of a .raw file in minutes - a .raw file is assumed to run until the next
+                                     .raw file starts, or for raw_duration minutes if there is a gap before the next file
+    Outputs: evl_raw_dic (string dictionary) - keys are .evl files and the values are lists of .raw files whose recording
+             time overlaps with the time of that .evl file
 
              if outfile_path is not empty - file with list of .evl files and .raw files 
 
@@ -175,32 +274,34 @@ def match_raw_evl(evl_files_list, raw_files_list, outfile_path = "", evl_inpath
                 Example: ctd017.evl GU19_05-D20191027-T140551.raw GU19_05-D20191027-T143423.raw
 
              There is one line per CTD cast
+    Note: .raw files are sorted into an index of (start time, end time) intervals that is binary searched for each cast
     '''
-    evl_dates_dic={}
-    for file in evl_files_list:
-        evl_line = line.read_evl(os.path.normpath(evl_inpath+ "/" + file))
-        date_time = evl_line.ping_time
-        date_time = np.sort(date_time)
-        evl_dates_dic[os.path.basename(file)] = (date_time[0], date_time[-1])
-    
-    date_raw_dic={}
+    evl_names = [os.path.basename(file) for file in evl_files_list]
+    evl_bounds = [evl_time_bounds(os.path.normpath(evl_inpath+ "/" + file)) for file in evl_files_list]
+    evl_starts = np.array([bounds[0] for bounds in evl_bounds], dtype="datetime64[ms]")
+    evl_ends = np.array([bounds[1] for bounds in evl_bounds], dtype="datetime64[ms]")
+
+    raw_names = []
+    raw_starts = []
     for file in raw_files_list:
         file = os.path.basename(file)
         cruise, date, time = file.replace(".raw", "").split("-") # Break apart .raw filename to get cruise, date, and time
-        start_dt = np.datetime64(datetime.strptime(date[1:] + time[1:], "%Y%m%d%H%M%S")) # Start of acoustic data collection for file
-        date_raw_dic[start_dt] = file # Dictionary of start times and .raw files
-
+        raw_starts.append(np.datetime64(datetime.strptime(date[1:] + time[1:], "%Y%m%d%H%M%S"))) # Start of acoustic data collection for file
+        raw_names.append(file)
+
+    # interval index of .raw files - sorted by start time, each file ends when the next starts (or after raw_duration)
+    raw_order = np.argsort(np.array(raw_starts, dtype="datetime64[ms]"), kind="stable")
+    raw_names = [raw_names[i] for i in raw_order]
+    raw_starts = np.array(raw_starts, dtype="datetime64[ms]")[raw_order]
+    raw_ends = raw_starts + np.timedelta64(raw_duration, 'm')
+    raw_ends[:-1] = np.minimum(raw_ends[:-1], raw_starts[1:])
+    # starts and ends are both sorted so overlapping files are one contiguous slice of the index
+    first_idx = np.searchsorted(raw_ends, evl_starts, side="right") # first file that ends after the cast starts
+    last_idx = np.searchsorted(raw_starts, evl_ends, side="right") # one past the last file that starts before the cast ends
 
     evl_raw_dic = {}
-    start_delay = np.timedelta64(30, 'm') # Time delay for starting CTD data collection after acoustics 
-    for evl_file in evl_dates_dic:
-        (stime, etime) = evl_dates_dic[evl_file]
-        raw_list = []
-        for date in date_raw_dic:
-            # If acoustic start is between CDT times or start_delay before, record that raw file
-            if (date > stime and date < etime) or abs(date - stime) < start_delay:
-                raw_list.append(date_raw_dic[date])
-        evl_raw_dic[evl_file] = raw_list
+    for evl_file, first, last in zip(evl_names, first_idx, last_idx):
+        evl_raw_dic[evl_file] = raw_names[first:last]
     
     if len(outfile_path) != 0:
         outfile_path = os.path.normpath(outfile_path + "/evl_raw_matches.list")
@@ -263,6 +364,69 @@ def read_casts(infile):
     return cast_dic
 
 
+def trace_slopes(x, y):
+    '''
+    trace_slopes: smooths a CTD trace and calculates the slope between each pair of neighbouring points
+    Inputs: x (list or array of numpy64 datetime objects) - times in the CTD trace
+            y (list or array of floats) - depths of the CTD trace over time
+    Outputs: numpy float array with len(x)-1 slopes - can be calculated once and passed to segment_slopes for many atol_zero values
+    '''
+    x_hat = np.asarray(x).astype("float") # turns numpy64 datetime objects into floats
+    y_hat = savgol_filter(y, 21, 1) # smooths the data into somewhat linear segments
+    return np.diff(y_hat)/np.diff(x_hat)
+
+def segment_slopes(slopes, atol_zero, min_points = 5):
+    '''
+    segment_slopes: splits a CTD trace into plateaus and ascents/descents from the slopes of the trace - same segments as 
+                    create_segments_dic, but as arrays of indices into the trace rather than a dictionary of points
+    Inputs: slopes (numpy float array) - slopes of the smoothed CTD trace created by trace_slopes
+            atol_zero (float) - magnitude of the the minimum absolute tolerance when determining if a slope is approimatly zero
+            min_points (integer) - segments with this many points or fewer are noise and are merged into the segment before them
+                                   along with the segment after them
+    Outputs: segment array dictionary with keys:
+                "start" (integer array) - index into the trace of the first point of each segment
+                "stop" (integer array) - index into the trace one past the last point of each segment
+                "bottle" (boolean array) - True if the segment is a plateau (slope approximatly 0)
+             Segments are in time order and cover every point of the trace - point i of the trace is in segment j if
+             start[j] <= i < stop[j]
+    '''
+    bottle = np.abs(slopes) <= atol_zero # slope of each point to the next is approximatly 0
+
+    # run length encode the plateau/not plateau labels
+    run_starts = np.concatenate(([0], np.flatnonzero(bottle[1:] != bottle[:-1]) + 1))
+    run_lengths = np.diff(np.append(run_starts, len(bottle)))
+
+    # a short run is merged into the segment before it, and the run after it (the same type as the segment before it) is
+    # merged too - in a row of short runs every second one starts a merge, since the one after it has already been merged
+    short = run_lengths <= min_points
+    short[0] = False # nothing before the first segment to merge into
+    short[-1] = False # last segment is kept no matter how short
+    run_idx = np.arange(len(short))
+    first_short = short & ~np.concatenate(([False], short[:-1]))
+    short_offset = run_idx - np.maximum.accumulate(np.where(first_short, run_idx, 0))
+    merge = short & (short_offset % 2 == 0)
+    merged = merge | np.concatenate(([False], merge[:-1]))
+
+    starts = run_starts[~merged]
+    return {"start": starts, "stop": np.append(starts[1:], len(bottle) + 1), "bottle": bottle[starts]}
+
+def segments_to_dic(x, y, segment_arrays):
+    '''
+    segments_to_dic: turns the segment arrays from segment_slopes into a segment dictionary (see create_segments_dic)
+    Inputs: x (list or array of numpy64 datetime objects) - times in the CTD trace
+            y (list or array of floats) - depths of the CTD trace over time
+            segment_arrays (dictionary) - segment arrays created by segment_slopes
+    Outputs: segment dictionary - same format as create_segments_dic (see CTD_EK_segments.segment_table for a segment table)
+    '''
+    x_str = np.datetime_as_string(np.asarray(x)).tolist()
+    y_float = np.asarray(y, dtype=float).tolist()
+    segments = {}
+    for seg_num, (start, stop, bottle) in enumerate(zip(segment_arrays["start"].tolist(), segment_arrays["stop"].tolist(),
+                                                        segment_arrays["bottle"].tolist())):
+        segments[str(seg_num)] = {'bottle': bottle, "depth": math.nan, "usable": False,
+                                  "points" : list(zip(x_str[start:stop], y_float[start:stop]))}
+    return segments
+
 def create_segments_dic(x, y, atol_zero):
     '''
     create_segments_dic: takes depth (y) over time (x) data from a CTD trace and splits it into segments by slope to
@@ -281,69 +445,30 @@ def create_segments_dic(x, y, atol_zero):
                                   -The 'usable' keys are all set to false here - they can be set to mark eDNA sample locations with the 
                                    mark_usable_segments function below
                                   -The 'points' key is followed by tuples of time/depth points (x,y) that are in the segment
+    Note: segmentation is done with trace_slopes and segment_slopes, which are much faster to call directly when trying many atol_zero
+          values since they skip building the dictionary
     '''
-
-    def calc_slope(x1, y1, x2, y2):
-        '''
-        calc_slope: calculate and return the slope from two x and two y values representing two points
-        Inputs: x1 (float/int): x value of first point; y1 (float/int) - y value of first point
-                x2 (float/int): x value of second point; y2 (float/int) - y value of second point
-        Outputs: float slope between the two points
-        Warning: Assumers that the x values of the two points are different to avoid divide by 0 error
-        '''
-        return (y2 - y1)/(x2 - x1)
-
-    def new_segment(segments, seg_num, bottle):
-        ''' 
-        new_segment: adds a new segment to the segment dictionary
-        Inputs: segments (nested dictionary of segments) - current dictionary
-                seg_num (int) - number of new segment; will be the key for new segment
-                bottle (boolean) - True if slope of new segment is approximatly 0, False otherwise
-        Outputs: segments - updated segment dictionary with new added segment
-        '''
-        segments[str(seg_num)] = {'bottle': bottle, "depth": math.nan, "usable": False, "points" : []}
-        return segments
-
-    # create_segments_dic starts here
-    x_hat = [num.astype("float") for num in x] # turns numpy64 datetime objects into floats
-    y_hat = savgol_filter(y, 21, 1) # smooths the data into somewhat linear segments
-
-    seg_num = 0
-    segments = {}
-    current_slope = calc_slope(x_hat[0], y_hat[0], x_hat[1], y_hat[1])
-    segments = new_segment(segments, seg_num, isclose(current_slope, 0, abs_tol= atol_zero))
-
-    for j in range(len(x)-1):
-        x_j = np.datetime_as_string(x[j])
-        y_j = float(y[j])
-        new_slope = calc_slope(x_hat[j], y_hat[j], x_hat[j+1], y_hat[j+1])
-        new_bottle = isclose(new_slope, 0, abs_tol= atol_zero)
-        if segments[str(seg_num)]["bottle"] == new_bottle: # we are still on the same segment - be that plateau or otherwise
-            segments[str(seg_num)]["points"].append((x_j, y_j)) # add in current point
-        else: # we have now switched to a new type of segment
-            if len(segments[str(seg_num)]["points"]) > 5: # if the previous segment is more than 2 points long
-                seg_num += 1
-                segments = new_segment(segments, seg_num, new_bottle) # makes empty new segment
-                segments[str(seg_num)]["points"].append((x_j, y_j)) # Adds current point to new segment
-            else: # short previous segment - due to noise (too short to be actual segment)
-                segments[str(seg_num-1)]["points"] += segments[str(seg_num)]["points"] # add glitch points to previous segment
-                segments[str(seg_num-1)]["points"].append((x_j, y_j)) # add new point to previous segment 
-                # since we only switch segments when they are diff type, previous and current must be same type with "glitch" inbetween 
-                del segments[str(seg_num)] # delete "glitch segment"
-                seg_num -= 1
-    segments[str(seg_num)]["points"].append((np.datetime_as_string(x[-1]), float(y[-1]))) # add the last point to last segment
-    return segments
+    return segments_to_dic(x, y, segment_slopes(trace_slopes(x, y), atol_zero))
 
 def mark_usable_depth(segments, cast_depths, transducer_depth, atol_depth = 2):
     '''
     mark_usable_segments: given a segment dictionary and a list of depths of eDNA samples for each cast, mark the 'usable' tag in the
                           segment dictionary True if a segment is at an eDNA sample depth and leave it as false otherwise
-    Inputs: segments (nested dictionary) - segment dictionary created by create_segments_dic function
+    Inputs: segments (nested dictionary) - segment dictionary created by create_segments_dic function, or a segment table
+                                           (see CTD_EK_segments.py)
             casts (numeric list) - list of depths eDNA samples were taken at during current cast
             atol_depth (float) - the minimum absolute difference in meters that the mean depth of the segment can differ from the depth
                                  specified in the cast file
-    Outputs: segment dictionary with "usable" tags updated and "depth" 
+    Outputs: segment dictionary with "usable" tags updated and "depth" (segment table with "usable" and "mean_depth" updated)
     '''
+    if seg_table.is_segment_table(segments):
+        bottle = segments["bottle"]
+        depths = np.add.reduceat(np.asarray(segments["depth"], dtype=float), segments["start"]) / (segments["stop"] - segments["start"])
+        segments["mean_depth"] = np.where(bottle, depths, segments["mean_depth"])
+        for sample_depth in cast_depths: # same test as isclose, for every segment at once
+            close = np.abs(depths - sample_depth) <= np.maximum(1E-9*np.maximum(np.abs(depths), abs(sample_depth)), atol_depth)
+            segments["usable"] = segments["usable"] | (bottle & close & (depths >= transducer_depth) & (sample_depth >= transducer_depth))
+        return segments
     for num in segments:
         seg = segments[num]
         if seg["bottle"]: # only segments with water samples taken could be a eDNA sample site
@@ -355,7 +480,7 @@ def mark_usable_depth(segments, cast_depths, transducer_depth, atol_depth = 2):
     return segments
 
 
-def interactive_segment_maker(eDNA_cast_depths, ctd_evl_file, transducer_depth, outfile_path=""):
+def interactive_segment_maker(eDNA_cast_depths, ctd_evl_file, transducer_depth, outfile_path="", atol_zero = None, atol_depth = 2):
     '''
     interactive_segment_maker: interactive script that walks user through creating .json of segments (also denotes which are usable)
                                for a single cast - if minimum absolute tolerance variables are wrong, script allows you to adjust and 
@@ -363,7 +488,10 @@ def interactive_segment_maker(eDNA_cast_depths, ctd_evl_file, transducer_depth,
     Inputs: eDNA_cast_depths (integer list) - list of depths eDNA data was collected at for cast
             ctd_evl_file (string) - filename and path to CTD trace .evl file
             transducer_depth (float) - depth of transducer in meters
-            outfile_path (string) - optional filename and path to save resultant .json file to
+            outfile_path (string) - optional filename and path to save resultant .json file to - a .npz filename saves a
+                                    compact segment table instead (see CTD_EK_segments.save_segments)
+            atol_zero (float) - optional starting value for atol_zero - the fit line below is used if None
+            atol_depth (float) - starting value for atol_depth (see mark_usable_depth)
     Outputs: segment dictionary - dictionary for a single cast - outermost key is segment number (i.e. 0, 1, 2) while inner keys are:
                                     Format: 'bottle': True/False, "depth": float/math.nan, "usable": False, "points" : [all points]
             If outfile_path is provided, the .json file is saved to the outfile path
@@ -372,6 +500,7 @@ def interactive_segment_maker(eDNA_cast_depths, ctd_evl_file, transducer_depth,
                 atol_zero = max(y)*3.16E-7 + 9.6E-5
              This might need to be updated for new datasets - manually find good values for atol_zero using create_segments_dic by trying 
              values for a few casts -  make a graph of atol_zero vs maximum depth of cast and use the fit line
+             (or use auto_segment_maker/auto_atol_zero, which search for atol_zero without user input)
     '''
     def get_atol(atol):
         '''
@@ -442,13 +571,12 @@ Do the number of segments above match the total number of ascents/descents/plate
 
     # interactive_segment_maker starts here
     plt.ion()
-    depth_data = line.read_evl(ctd_evl_file)
-    x=depth_data.ping_time
-    y=depth_data.data
+    x, y = evl_traces.evl_trace(ctd_evl_file) # parsed once per process, shared with plotting
 
     print("***Analyzing " + os.path.basename(ctd_evl_file).replace(".evl", "") + "***")
     print("SEGMENTATION")
-    atol_zero = max(y)*3.16E-7 + 9.6E-5 # might need to adjust for best results
+    if atol_zero is None:
+        atol_zero = max(y)*3.16E-7 + 9.6E-5 # might need to adjust for best results
     print("Absolute Tolerance (maximum absolute distance a slope can be from 0 to be classified as a plateau): ")
     print(round(atol_zero, 5))
 
@@ -456,7 +584,6 @@ Do the number of segments above match the total number of ascents/descents/plate
     segments = check_segments_dic(segments, x, y) # check segments
 
     print("\nSAMPLE DEPTHS")
-    atol_depth = 2
     print("Absolute tolerance of eDNA sample depths (maximim distance plateau's mean depth differ \
 from recorded sample depth to be classified as sample site): ")
     print(atol_depth)
@@ -465,34 +592,329 @@ from recorded sample depth to be classified as sample site): ")
     segments = check_usable_segments(segments, eDNA_cast_depths) # check samples
     
     if len(outfile_path) != 0: # if we have an outfile, save outfile
-        print("Saving .json file with segment classification.\n")
-        with open(outfile_path, 'w') as outfile:
-            json.dump(segments, outfile)
+        print("Saving " + os.path.splitext(outfile_path)[1] + " file with segment classification.\n")
+        seg_table.save_segments(outfile_path, segments) # .json as before, .npz as a segment table
 
     return segments
 
+def auto_atol_zero(x, y, eDNA_cast_depths, transducer_depth, atol_depth = 2, atol_range = (1E-6, 1E-3), n_grid = 64, n_bisect = 12):
+    '''
+    auto_atol_zero: finds a value of atol_zero for create_segments_dic without user input - the plateaus found with each atol_zero
+                    are scored against the depths eDNA samples were taken at, a log spaced grid of atol_zero values is searched, and
+                    the edges of the widest range of best scoring values are found by bisection - the middle of that range is chosen
+    Inputs: x (list or array of numpy64 datetime objects) - times in the CTD trace
+            y (list or array of floats) - depths of the CTD trace over time
+            eDNA_cast_depths (float list) - list of depths eDNA data was collected at for cast (see read_casts)
+            transducer_depth (float) - depth of transducer in meters
+            atol_depth (float) - see mark_usable_depth
+            atol_range (float tuple) - smallest and largest atol_zero values to try
+            n_grid (integer) - number of atol_zero values in the grid search
+            n_bisect (integer) - number of bisection steps used to find each edge of the best range
+    Outputs: dictionary with:
+                "atol_zero" (float) - chosen atol_zero
+                "atol_zero_range" (float list) - smallest and largest atol_zero with the same score
+                "matched_depths" (dictionary) - eDNA depths with a plateau within atol_depth as keys and plateau mean depths as values
+                "missing_depths" (float list) - eDNA depths (below the transducer) without a plateau
+                "duplicate_depths" (float list) - eDNA depths with more than one plateau within atol_depth
+                "n_segments" / "n_plateaus" (integer) - number of segments / plateaus found with the chosen atol_zero
+    Note: if there are no eDNA depths below the transducer, nothing can be scored and the fit line from interactive_segment_maker
+          (max(y)*3.16E-7 + 9.6E-5) is used
+    '''
+    y = np.asarray(y, dtype=float)
+    slopes = trace_slopes(x, y)
+    expected = np.array([d for d in eDNA_cast_depths if not math.isnan(d) and d >= transducer_depth], dtype=float)
+
+    def plateau_depths(atol_zero):
+        '''
+        plateau_depths: segments the trace and returns the segment arrays and the mean depths of the plateaus below the transducer
+        '''
+        seg = segment_slopes(slopes, atol_zero)
+        means = np.add.reduceat(y, seg["start"]) / (seg["stop"] - seg["start"]) # mean depth of every segment
+        means = means[seg["bottle"]]
+        return seg, means[means >= transducer_depth]
 
-def raw_to_Sv(ek, fq, transducer_offset):
+    def score(atol_zero):
+        '''
+        score: (number of eDNA depths matched by a plateau, -number of eDNA depths matched by more than one plateau)
+        '''
+        _, means = plateau_depths(atol_zero)
+        n_close = np.sum(np.abs(means[:, np.newaxis] - expected[np.newaxis, :]) <= atol_depth, axis=0)
+        return (int(np.sum(n_close > 0)), -int(np.sum(n_close > 1)))
+
+    if len(expected) == 0:
+        atol_zero = max(y)*3.16E-7 + 9.6E-5
+        atol_zero_range = [atol_zero, atol_zero]
+    else:
+        grid = np.geomspace(atol_range[0], atol_range[1], n_grid)
+        scores = [score(atol) for atol in grid]
+        best = max(scores)
+        # widest run of neighbouring grid values with the best score - ties go to the run closest to the fit line
+        fit_atol = max(y)*3.16E-7 + 9.6E-5
+        runs = []
+        i = 0
+        while i < n_grid:
+            if scores[i] == best:
+                j = i
+                while j + 1 < n_grid and scores[j+1] == best:
+                    j += 1
+                runs.append((j - i, -abs(math.log(math.sqrt(grid[i]*grid[j])/fit_atol)), i, j))
+                i = j
+            i += 1
+        _, _, lo_idx, hi_idx = max(runs)
+
+        def bisect_edge(inside, outside):
+            '''
+            bisect_edge: finds the edge of the best scoring range between an atol_zero inside it and one outside of it
+            '''
+            for _ in range(n_bisect):
+                middle = math.sqrt(inside*outside)
+                if score(middle) == best:
+                    inside = middle
+                else:
+                    outside = middle
+            return inside
+
+        lo = grid[lo_idx] if lo_idx == 0 else bisect_edge(grid[lo_idx], grid[lo_idx-1])
+        hi = grid[hi_idx] if hi_idx == n_grid-1 else bisect_edge(grid[hi_idx], grid[hi_idx+1])
+        atol_zero = math.sqrt(lo*hi)
+        if score(atol_zero) != best: # range was not continuous, use the best grid value in the middle of the run
+            atol_zero = grid[(lo_idx + hi_idx)//2]
+        atol_zero_range = [lo, hi]
+
+    seg, means = plateau_depths(atol_zero)
+    matched, missing, duplicate = {}, [], []
+    for depth in expected.tolist():
+        close = means[np.abs(means - depth) <= atol_depth]
+        if len(close) == 0:
+            missing.append(depth)
+        else:
+            matched[depth] = close[np.argmin(np.abs(close - depth))].item()
+            if len(close) > 1:
+                duplicate.append(depth)
+    return {"atol_zero": float(atol_zero), "atol_zero_range": [float(atol) for atol in atol_zero_range], "matched_depths": matched,
+            "missing_depths": missing, "duplicate_depths": duplicate, "n_segments": len(seg["start"]),
+            "n_plateaus": int(np.sum(seg["bottle"]))}
+
+def auto_segment_maker(eDNA_cast_depths, ctd_evl_file, transducer_depth, atol_depths = [2, 3, 4], min_range_ratio = 1.2,
+                       as_table = False):
+    '''
+    auto_segment_maker: non-interactive version of interactive_segment_maker - atol_zero is found with auto_atol_zero, trying each 
+                        atol_depth until every eDNA depth is matched by exactly one plateau
+    Inputs: eDNA_cast_depths (float list) - list of depths eDNA data was collected at for cast
+            ctd_evl_file (string) - filename and path to CTD trace .evl file
+            transducer_depth (float) - depth of transducer in meters
+            atol_depths (float list) - atol_depth values to try, in order (see mark_usable_depth)
+            min_range_ratio (float) - the cast is flagged as ambiguous if the largest atol_zero with the chosen score is less than
+                                      this many times the smallest (the result is sensitive to atol_zero)
+            as_table (boolean) - if True segments are returned as a segment table (see CTD_EK_segments.py), which skips making
+                                 a time string for every point
+    Outputs: (1) segment dictionary - same format as interactive_segment_maker, with usable segments marked (or segment table)
+             (2) report dictionary - auto_atol_zero output plus "evl", "atol_depth", "expected_depths", and "ambiguous" keys - a cast
+                 is ambiguous if an eDNA depth is missing or matched more than once, or the atol_zero range is too narrow
+    '''
+    x, y = evl_traces.evl_trace(ctd_evl_file)
+
+    report = None
+    for atol_depth in atol_depths:
+        with trace.span("auto_atol_zero", evl=os.path.basename(ctd_evl_file), atol_depth=atol_depth):
+            found = auto_atol_zero(x, y, eDNA_cast_depths, transducer_depth, atol_depth)
+        found["atol_depth"] = atol_depth
+        found["ambiguous"] = len(found["missing_depths"]) != 0 or len(found["duplicate_depths"]) != 0 or \
+                             found["atol_zero_range"][1] < min_range_ratio*found["atol_zero_range"][0]
+        if report is None or (len(found["matched_depths"]), -len(found["duplicate_depths"])) > \
+                             (len(report["matched_depths"]), -len(report["duplicate_depths"])):
+            report = found
+        if not found["ambiguous"]:
+            report = found
+            break
+
+    report["evl"] = os.path.basename(ctd_evl_file)
+    report["expected_depths"] = [d for d in eDNA_cast_depths if not math.isnan(d) and d >= transducer_depth]
+    if as_table:
+        segments = seg_table.segment_table(x, y, segment_slopes(trace_slopes(x, y), report["atol_zero"]))
+    else:
+        segments = create_segments_dic(x, y, report["atol_zero"])
+    segments = mark_usable_depth(segments, eDNA_cast_depths, transducer_depth, report["atol_depth"])
+    return segments, report
+
+def auto_segment_casts(eDNA_cast_dic, evl_files, transducer_depth, report_file = "", interactive_fallback = True, processes = None):
+    '''
+    auto_segment_casts: runs auto_segment_maker for many casts, one cast per worker process, and falls back on
+                        interactive_segment_maker for casts flagged as ambiguous
+    Inputs: eDNA_cast_dic (dictionary) - cast numbers as keys and lists of eDNA depths as values (see read_casts)
+            evl_files (dictionary) - cast numbers as keys and .evl filenames (with paths) as values
+            transducer_depth (float) - depth of transducer in meters
+            report_file (string) - optional path and filename to save a .json report of the chosen tolerances and matched depths
+            interactive_fallback (boolean) - if True, ambiguous casts are checked with interactive_segment_maker (starting from the
+                                             tolerances found automatically), otherwise the automatic segments are kept
+            processes (integer) - number of worker processes - defaults to the number of CPUs
+    Outputs: (1) dictionary with cast numbers as keys and segment dictionaries as values
+             (2) dictionary with cast numbers as keys and report dictionaries as values (see auto_segment_maker)
+    '''
+    casts = [cast for cast in eDNA_cast_dic if cast in evl_files]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        results = list(pool.map(auto_segment_maker, [eDNA_cast_dic[cast] for cast in casts], [evl_files[cast] for cast in casts],
+                                [transducer_depth]*len(casts)))
+    segments_dic = {cast: result[0] for cast, result in zip(casts, results)}
+    report_dic = {cast: result[1] for cast, result in zip(casts, results)}
+
+    for cast in casts:
+        report = report_dic[cast]
+        print("Cast " + str(cast) + ": atol_zero " + str(round(report["atol_zero"], 7)) + ", atol_depth " + str(report["atol_depth"]) +
+              ", matched " + str(len(report["matched_depths"])) + "/" + str(len(report["expected_depths"])) + " eDNA depths" +
+              (" - AMBIGUOUS" if report["ambiguous"] else ""))
+        if report["ambiguous"] and interactive_fallback:
+            segments_dic[cast] = interactive_segment_maker(eDNA_cast_dic[cast], evl_files[cast], transducer_depth,
+                                                           atol_zero=report["atol_zero"], atol_depth=report["atol_depth"])
+            report["interactive"] = True
+
+    if len(report_file) != 0:
+        with open(report_file, 'w') as outfile:
+            json.dump({str(cast): report_dic[cast] for cast in casts}, outfile, indent=1)
+    return segments_dic, report_dic
+
+
+def raw_to_Sv(ek, fq, transducer_offset, dtype = np.float64):
     '''
     raw_to_Sv: function takes an ek object and returns the Sv processed data object and
                the calibration object for the specified frequency and transducer offset
     Inputs: ek (EK80 data object) - see Rick Towler's pyEcholab code for more details
             fq (integer) - frequency for desired data
             transducer_offset (double) - offset of transducer from water surface in meters
+            dtype (numpy dtype) - type of the Sv data - np.float32 halves the memory of Sv and everything calculated from it
     Outputs: Sv object - Sv data object for given frequency and EK object
              Calibration object - calibration object with given transducer offset set
     Note: for more details on Sv and Calibration objects see Rick Towler's pyEcholab code
     '''
     raw_data_list = ek.get_channel_data(frequencies=fq)
-    raw_data = raw_data_list[fq][0] 
-    for file in raw_data_list[fq][1:]:
-        raw_data.append(file)
+    return raw_data_to_Sv(concat_raw_data(raw_data_list[fq]), transducer_offset, dtype)
+
+def raw_data_to_Sv(raw_data, transducer_offset, dtype = np.float64):
+    '''
+    raw_data_to_Sv: Sv processed data object and calibration object of one pyEcholab raw data object - see raw_to_Sv
+    '''
     cal_obj = raw_data.get_calibration()
     cal_obj.transducer_offset_z = transducer_offset
-    return raw_data.get_Sv(calibration=cal_obj, return_depth=True), cal_obj
+    Sv = raw_data.get_Sv(calibration=cal_obj, return_depth=True)
+    Sv.data = np.asarray(Sv.data, dtype=dtype) # not copied if it is already this type
+    return Sv, cal_obj
 
+def concat_raw_data(raw_data_parts):
+    '''
+    concat_raw_data: joins pyEcholab raw data objects of one channel (i.e. one per .raw file, in time order) into the first one -
+                     the arrays are resized once to hold every ping and then filled, rather than reallocated by every append
+    Inputs: raw_data_parts (list) - raw data objects from get_channel_data, in time order
+    Output: raw data object with the pings of every part - this is raw_data_parts[0], which is changed
+    Note: if the raw data objects can't be resized (older pyEcholab), the parts are appended one at a time instead
+    '''
+    raw_data = raw_data_parts[0]
+    if len(raw_data_parts) == 1:
+        return raw_data
+    if not (hasattr(raw_data, "resize") and hasattr(raw_data, "_data_attributes")):
+        for part in raw_data_parts[1:]:
+            raw_data.append(part)
+        return raw_data
+
+    start = raw_data.n_pings
+    n_pings = sum(part.n_pings for part in raw_data_parts)
+    n_samples = max(part.n_samples for part in raw_data_parts)
+    raw_data.resize(n_pings, n_samples) # one reallocation - new samples are filled with NaN
+    for part in raw_data_parts[1:]:
+        for name in raw_data._data_attributes:
+            values = getattr(part, name, None)
+            buffer = getattr(raw_data, name, None)
+            if isinstance(values, np.ndarray) and isinstance(buffer, np.ndarray) and values.ndim > 0:
+                # ping dimension first, then samples (and sectors for complex data) up to the size of this part
+                buffer[(slice(start, start + part.n_pings),) + tuple(slice(0, size) for size in values.shape[1:])] = values
+        start += part.n_pings
+    return raw_data
+
+def decode_raw_file(raw_file, frequencies):
+    '''
+    decode_raw_file: reads one .raw file with pyEcholab in a worker process of read_raw_parallel
+    Output: dictionary with frequencies as keys and lists of raw data objects as values
+    '''
+    ek80 = EK80.EK80()
+    ek80.read_raw(raw_file, frequencies=frequencies)
+    return {fq: list(raw_data) for fq, raw_data in ek80.get_channel_data(frequencies=frequencies).items()}
 
-def crop_Sv(Sv, xlim, ylim):
+def read_raw_parallel(raw_files, frequencies, processes = None):
+    '''
+    read_raw_parallel: decodes each .raw file of a cast in its own worker process and joins the raw data of each frequency with
+                       concat_raw_data
+    Inputs: raw_files (string list) - .raw filenames (with paths) of one cast, in time order
+            frequencies (integer list) - frequencies to read
+            processes (integer) - number of worker processes - defaults to one per .raw file (up to the number of CPUs)
+    Output: dictionary with frequencies as keys and one raw data object (every ping of the cast) as values
+    Note: if the script calling this is run on macOS or Windows, call it under if __name__ == "__main__":
+    '''
+    if processes is None:
+        processes = min(len(raw_files), os.cpu_count())
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        decoded = list(pool.map(decode_raw_file, raw_files, [frequencies]*len(raw_files))) # results stay in file order
+    return {fq: concat_raw_data([raw_data for file_data in decoded for raw_data in file_data.get(fq, [])]) for fq in frequencies}
+
+
+def raw_files_to_Sv(raw_files, frequencies, transducer_offset, sv_cache = None, time_window = None, index_path = "", processes = 1,
+                    dtype = np.float64):
+    '''
+    raw_files_to_Sv: reads .raw files and returns the Sv processed data objects and calibration objects for each
+                     frequency - if an SvCache is given, Sv already in the cache is loaded from disk and the .raw files are only
+                     decoded if at least one frequency is missing from the cache
+    Inputs: raw_files (string list) - list of .raw filenames (with paths) for one cast
+            frequencies (integer list) - frequencies to get Sv data for
+            transducer_offset (double) - offset of transducer from water surface in meters
+            sv_cache (SvCache object) - optional cache created with CTD_EK_cache.SvCache()
+            time_window (numpy datetime64 tuple) - optional (start time, end time) - if given only the pings in this window are
+                                                   decoded, using the ping time index of the .raw files (see CTD_EK_rawindex.py)
+            index_path (string) - optional folder the .raw file indexes are saved in - next to the .raw files if not given
+            processes (integer) - if not 1, a cast with several .raw files is decoded one file per worker process (see
+                                  read_raw_parallel) - None uses one process per file - leave at 1 when this is already called
+                                  from worker processes (i.e. policy_subset_casts or the pipeline)
+            dtype (numpy dtype) - type of the Sv data - see raw_to_Sv
+    Outputs: dictionary with frequencies as keys and (Sv object, calibration object) tuples as values - see raw_to_Sv - empty
+             if time_window is given and there are no pings in it
+    '''
+    cal_params = {"transducer_offset_z": transducer_offset} # calibration values set on top of the .raw file calibration
+    if time_window is not None: # windows of the same files are cached seperately
+        cal_params["time_window"] = np.datetime_as_string(np.array(time_window, dtype="datetime64[ms]")).tolist()
+    if np.dtype(dtype) != np.float64: # so float32 Sv is never loaded for a float64 run (float64 keys are the same as before)
+        cal_params["dtype"] = np.dtype(dtype).name
+    Sv_dic = {}
+    if sv_cache is not None:
+        for fq in frequencies:
+            with trace.span("sv_cache_get", frequency=fq):
+                cached = sv_cache.get(raw_files, fq, cal_params)
+            if cached is not None:
+                Sv_dic[fq] = cached
+
+    missing_fq = [fq for fq in frequencies if fq not in Sv_dic]
+    if len(missing_fq) != 0:
+        if time_window is None and processes != 1 and len(raw_files) > 1:
+            with trace.span("read_raw_parallel", files=len(raw_files)):
+                raw_data_dic = read_raw_parallel(raw_files, missing_fq, processes)
+            for fq in missing_fq:
+                with trace.span("get_Sv", frequency=fq):
+                    Sv_dic[fq] = raw_data_to_Sv(raw_data_dic[fq], transducer_offset, dtype)
+        else:
+            with trace.span("read_raw", files=len(raw_files), windowed=time_window is not None):
+                if time_window is None:
+                    ek80 = EK80.EK80()
+                    ek80.read_raw(raw_files)
+                else:
+                    ek80 = rawindex.read_raw_window(raw_files, time_window[0], time_window[1], index_path)
+            if ek80 is None: # no pings in the window
+                return {}
+            for fq in missing_fq:
+                with trace.span("get_Sv", frequency=fq):
+                    Sv_dic[fq] = raw_to_Sv(ek80, fq, transducer_offset, dtype)
+        if sv_cache is not None:
+            for fq in missing_fq:
+                sv_cache.put(raw_files, fq, cal_params, *Sv_dic[fq])
+    return Sv_dic
+
+
+def crop_Sv(Sv, xlim, ylim, copy_data = False):
         '''
         crop_Sv: given x and y index limits, subset an Sv processed data object from pyEcholab
         Inputs: Sv (processed data object from pyEcholab) - run get_Sv (pyEcholab) or raw_to_Sv (see above)
@@ -500,24 +922,581 @@ def crop_Sv(Sv, xlim, ylim):
                                       subsets inclusive of both of these limits 
                 ylim (integer list) - [lower limit y index, higher limit y index] 
                                       subsets inclusive of both of these limits 
-        Outputs: cropped Sv data object with all major data attributes (data, ping_time, deoth, 
-                 transducer_offset, n_pings, heave) cropped to given limits
+                copy_data (boolean) - if True the cropped arrays are copied, otherwise they are views of the arrays in Sv
+        Outputs: new cropped Sv data object with all major data attributes (data, ping_time, depth, 
+                 transducer_offset, n_pings, heave) cropped to given limits - Sv itself is not changed
+        Note: by default the cropped object shares memory with Sv (numpy slicing), so cropping a long cast is free but changing
+              values in the crop also changes them in Sv - use copy_data = True if the crop will be edited or Sv should be freed
         '''
-        # data has dims (ping_time, depth) - rows are ping_time, columns are depth
-        Sv.data = Sv.data[xlim[0]:xlim[1]+1, ylim[0]:ylim[1]+1] 
-        Sv.ping_time = Sv.ping_time[xlim[0]:xlim[1]+1]
-        Sv.depth = Sv.depth[ylim[0]:ylim[1]+1]
-        Sv.transducer_offset = Sv.transducer_offset[xlim[0]:xlim[1]+1]
-        Sv.n_pings = len(Sv.ping_time)
-        Sv.heave = Sv.heave[xlim[0]:xlim[1]+1]
-        return Sv # is there a better way to resize this so that everything gets resized?
+        x_slice = slice(int(xlim[0]), int(xlim[1])+1)
+        y_slice = slice(int(ylim[0]), int(ylim[1])+1)
+        n_pings = len(Sv.ping_time)
+        cropped = copy.copy(Sv) # new object, but attributes still point to Sv's arrays
+
+        # every attribute with one value per ping is cropped in x - data has dims (ping_time, depth)
+        ping_attributes = ["ping_time", "transducer_offset", "heave"] + list(getattr(Sv, "_data_attributes", []))
+        for name in dict.fromkeys(ping_attributes):
+            value = getattr(Sv, name, None)
+            if isinstance(value, np.ndarray) and value.ndim > 0 and value.shape[0] == n_pings:
+                setattr(cropped, name, value[x_slice])
+        cropped.data = Sv.data[x_slice, y_slice]
+        for name in ["depth", "range"]: # vertical axis
+            if isinstance(getattr(Sv, name, None), np.ndarray):
+                setattr(cropped, name, getattr(Sv, name)[y_slice])
+
+        if copy_data: # the attributes of a DualSv are those of the Sv object it wraps
+            attributes = vars(cropped.Sv if isinstance(cropped, dual_sv.DualSv) else cropped)
+            for name, value in list(attributes.items()):
+                if isinstance(value, np.ndarray) and value is not getattr(Sv, name, None):
+                    setattr(cropped, name, np.array(value))
+        cropped.n_pings = len(cropped.ping_time)
+        if hasattr(Sv, "n_samples"):
+            cropped.n_samples = cropped.data.shape[1]
+        if hasattr(Sv, "shape"):
+            cropped.shape = cropped.data.shape
+        return cropped
+
+def concat_Sv(Sv_parts):
+    '''
+    concat_Sv: joins Sv processed data objects of one channel that follow each other in time (i.e. the pieces of a long box from
+               stream_boxes_Sv) into a new Sv object
+    Inputs: Sv_parts (list) - Sv objects in time order, all with the same depths
+    Output: new Sv object with the pings of every part - the parts are not changed
+    '''
+    first = Sv_parts[0]
+    if any(np.shape(Sv.data)[1:] != np.shape(first.data)[1:] for Sv in Sv_parts):
+        raise ValueError("Sv parts have different numbers of samples and can't be joined")
+    joined = copy.copy(first)
+    n_pings = len(first.ping_time)
+    ping_attributes = ["ping_time", "data", "transducer_offset", "heave"] + list(getattr(first, "_data_attributes", []))
+    for name in dict.fromkeys(ping_attributes):
+        value = getattr(first, name, None)
+        if isinstance(value, np.ndarray) and value.ndim > 0 and value.shape[0] == n_pings:
+            setattr(joined, name, np.concatenate([getattr(Sv, name) for Sv in Sv_parts]))
+    joined.n_pings = len(joined.ping_time)
+    if hasattr(first, "shape"):
+        joined.shape = joined.data.shape
+    return joined
+
+def decimate_Sv(Sv, block, method = "mean"):
+    '''
+    decimate_Sv: reduces the resolution of an Sv processed data object by combining blocks of pings and samples (i.e. to the pixels
+                 of a plot)
+    Inputs: Sv (processed data object from pyEcholab) - Sv data object (i.e. from raw_to_Sv or crop_Sv)
+            block (integer list) - [pings per block, samples per block] - the last block in each direction can be smaller
+            method (string) - "mean" averages each block in the linear domain (ignoring NaN) so layers keep their energy, "max"
+                              keeps the highest Sv of each block so small strong targets (i.e. fish) don't disappear
+    Outputs: new Sv data object with one ping/sample per block - ping_time (and other per ping attributes) and depth are those of
+             the first ping/sample of each block - Sv itself is not changed
+    '''
+    data = np.asarray(Sv.data)
+    x_starts = np.arange(0, data.shape[0], max(int(block[0]), 1))
+    y_starts = np.arange(0, data.shape[1], max(int(block[1]), 1))
+    if method == "max":
+        reduced = np.fmax.reduceat(np.fmax.reduceat(data, x_starts, axis=0), y_starts, axis=1) # fmax ignores NaN
+    elif method == "mean":
+        linear = 10**(data/10)
+        finite = np.isfinite(linear)
+        sums = np.add.reduceat(np.add.reduceat(np.where(finite, linear, 0), x_starts, axis=0), y_starts, axis=1)
+        counts = np.add.reduceat(np.add.reduceat(finite.astype(np.int32), x_starts, axis=0), y_starts, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            reduced = 10*np.log10(sums/counts) # NaN where a block has no data
+        reduced[(counts != 0) & (sums == 0)] = -999 # -999 is basically 0 in log (i.e. masked by mask_mfi)
+    else:
+        raise ValueError("method must be 'mean' or 'max', not " + str(method))
+
+    decimated = copy.copy(Sv)
+    n_pings = len(Sv.ping_time)
+    for name in dict.fromkeys(["ping_time", "transducer_offset", "heave"] + list(getattr(Sv, "_data_attributes", []))):
+        value = getattr(Sv, name, None)
+        if isinstance(value, np.ndarray) and value.ndim > 0 and value.shape[0] == n_pings:
+            setattr(decimated, name, value[x_starts])
+    decimated.data = reduced
+    for name in ["depth", "range"]: # vertical axis
+        if isinstance(getattr(Sv, name, None), np.ndarray):
+            setattr(decimated, name, getattr(Sv, name)[y_starts])
+    decimated.n_pings = len(decimated.ping_time)
+    if hasattr(Sv, "n_samples"):
+        decimated.n_samples = reduced.shape[1]
+    if hasattr(Sv, "shape"):
+        decimated.shape = reduced.shape
+    return decimated
+
+def Sv_pyramid(Sv, min_size = 256, level_data = None):
+    '''
+    Sv_pyramid: creates lower resolution copies of Sv for plotting - each level averages 2x2 blocks of the level before it in the
+                linear domain, so level k has the same values as decimate_Sv(Sv, [2**k, 2**k]) (ignoring NaN)
+    Inputs: Sv (processed data object from pyEcholab) - full resolution Sv data object (i.e. the whole cast from raw_files_to_Sv)
+            min_size (integer) - levels are added until the pings or samples of a level would be fewer than this
+            level_data (list) - optional data arrays of levels 1, 2, ... that were already calculated (i.e. saved by SvCache) so only
+                                the objects are created
+    Outputs: list of Sv data objects - level 0 is Sv itself, level k has 2**k times fewer pings and samples - ping_time (and other
+             per ping attributes) and depth are those of the first ping/sample of each block, same as decimate_Sv
+    '''
+    data = np.asarray(Sv.data)
+    n_levels = 0
+    while min(data.shape[0], data.shape[1]) // 2**(n_levels+1) >= min_size:
+        n_levels += 1
+    if level_data is not None:
+        n_levels = len(level_data)
+
+    pyramid = [Sv]
+    n_pings = len(Sv.ping_time)
+    if level_data is None and n_levels != 0:
+        linear = 10**(data/10)
+        finite = np.isfinite(linear)
+        sums = np.where(finite, linear, 0)
+        counts = finite.astype(np.int32)
+        level_data = []
+        for level in range(n_levels): # sums and counts are halved each level, so the average is over every cell of the block
+            x_starts = np.arange(0, sums.shape[0], 2)
+            y_starts = np.arange(0, sums.shape[1], 2)
+            sums = np.add.reduceat(np.add.reduceat(sums, x_starts, axis=0), y_starts, axis=1)
+            counts = np.add.reduceat(np.add.reduceat(counts, x_starts, axis=0), y_starts, axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                level_Sv = 10*np.log10(sums/counts)
+            level_Sv[(counts != 0) & (sums == 0)] = -999
+            level_data.append(level_Sv.astype(data.dtype))
+
+    for level, level_Sv in enumerate(level_data if level_data is not None else [], 1):
+        step = 2**level
+        decimated = copy.copy(Sv)
+        for name in dict.fromkeys(["ping_time", "transducer_offset", "heave"] + list(getattr(Sv, "_data_attributes", []))):
+            value = getattr(Sv, name, None)
+            if isinstance(value, np.ndarray) and value.ndim > 0 and value.shape[0] == n_pings:
+                setattr(decimated, name, value[::step])
+        decimated.data = level_Sv
+        for name in ["depth", "range"]: # vertical axis
+            if isinstance(getattr(Sv, name, None), np.ndarray):
+                setattr(decimated, name, getattr(Sv, name)[::step])
+        decimated.n_pings = len(decimated.ping_time)
+        if hasattr(Sv, "n_samples"):
+            decimated.n_samples = level_Sv.shape[1]
+        if hasattr(Sv, "shape"):
+            decimated.shape = level_Sv.shape
+        pyramid.append(decimated)
+    return pyramid
+
+def raw_files_to_pyramid(raw_files, frequencies, transducer_offset, sv_cache = None, min_size = 256):
+    '''
+    raw_files_to_pyramid: Sv pyramid (see Sv_pyramid) of each frequency of a cast - if an SvCache is given the pyramid is saved next
+                          to the Sv in the cache, so it is only calculated once per cast
+    Inputs: raw_files, frequencies, transducer_offset, sv_cache - see raw_files_to_Sv
+            min_size (integer) - see Sv_pyramid
+    Outputs: dictionary with frequencies as keys and (pyramid list, calibration object) tuples as values - can be passed to
+             plotting.plot_echo or plotting.plot_echo_pyramid in place of the output of raw_files_to_Sv
+    '''
+    Sv_dic = raw_files_to_Sv(raw_files, frequencies, transducer_offset, sv_cache)
+    pyramid_dic = {}
+    for fq in frequencies:
+        Sv, cal = Sv_dic[fq]
+        if sv_cache is None:
+            pyramid_dic[fq] = (Sv_pyramid(Sv, min_size), cal)
+        else:
+            with trace.span("sv_pyramid", frequency=fq):
+                pyramid_dic[fq] = (sv_cache.get_pyramid(raw_files, fq, {"transducer_offset_z": transducer_offset}, min_size), cal)
+    return pyramid_dic
+
+def segment_boxes(segment_dic, toffsets, doffsets, usable_only = True):
+    '''
+    segment_boxes: creates a (time window, depth window) box around the water bottle segments of a segment dictionary
+    Inputs: segment_dic (segment dictionary) - segment dictionary after running create_segments_dic or interactive_segment_maker,
+                                               or a segment table (see CTD_EK_segments.py)
+            toffsets (integer list) - two item list with minute offsets from the start of data collection in segments 
+                                      first item for minutes before data collection and second item for minutes after start of collection
+            doffsets (double list) - two item list with meter offsets from mean depth of segment
+                                     first item is meters above mean, second is meters below mean
+            usable_only (boolean) - if True only usable (eDNA) segments get boxes, otherwise every plateau (bottle segment) does
+    Outputs: box dictionary - keys are the rounded mean depth of each segment (as a string, same as subset_segments_Sv) and values are
+             ((start time, end time), (min depth, max depth)) with numpy datetime64 times and float depths
+             Note: if two segments round to the same depth, the segment number is added to the second key (i.e. "42_7") - use
+             segment_box_rows to find the segment of a box rather than parsing the key
+    '''
+    boxes = {}
+    for name, num, y_mean, x_start in segment_box_rows(segment_dic, usable_only):
+        boxes[name] = ((x_start - np.timedelta64(toffsets[0], 'm'), x_start + np.timedelta64(toffsets[1], 'm')),
+                       (y_mean - doffsets[0], y_mean + doffsets[1]))
+    return boxes
 
-def subset_segments_Sv(segment_dic, raw_files, toffsets, doffsets, transducer_offset, frequencies = [18000, 38000, 120000, 200000]):
+def segment_box_rows(segment_dic, usable_only = True):
+    '''
+    segment_box_rows: goes through the segments that get a box in segment_boxes
+    Inputs: segment_dic (segment dictionary or segment table) - see segment_boxes
+            usable_only (boolean) - see segment_boxes
+    Output: generator of (box name, segment number, mean depth, start time) for each box - the box name is its key in
+            segment_boxes, so the segment of a box can be found without parsing the name
+    '''
+    names = set()
+    for num, bottle, usable, y_mean, points_time, points_depth in seg_table.segment_rows(segment_dic):
+        if bottle and (usable or not usable_only):
+            # y_mean is the depth of sample
+            if math.isnan(y_mean): # depth is only calculated by mark_usable_depth
+                y_mean = mean(points_depth.tolist())
+            name = str(round(y_mean))
+            if name in names:
+                name += "_" + str(num)
+            names.add(name)
+            yield name, num, y_mean, points_time.min()
+
+def nearest_index(ref_values, values, tolerance):
+    '''
+    nearest_index: for each reference value, the index of the closest value in values - values can be in any order
+    Inputs: ref_values (numpy array) - values to find matches for (i.e. ping times in ms or depths)
+            values (numpy array) - values to search
+            tolerance (float) - matches further away than this are -1
+    Output: numpy integer array the length of ref_values
+    '''
+    if len(values) == 0:
+        return np.full(len(ref_values), -1)
+    order = np.argsort(values, kind="stable")
+    sorted_values = values[order]
+    right = np.clip(np.searchsorted(sorted_values, ref_values), 0, len(values)-1)
+    left = np.clip(right-1, 0, len(values)-1)
+    closest = np.where(np.abs(sorted_values[left] - ref_values) <= np.abs(sorted_values[right] - ref_values), left, right)
+    return np.where(np.abs(sorted_values[closest] - ref_values) <= tolerance, order[closest], -1)
+
+def ping_alignment(ref_times, times, tolerance = None):
+    '''
+    ping_alignment: maps every ping of a reference channel to the closest ping of another channel, so channels that don't ping
+                    at the same time (or are missing pings) can be stacked ping by ping
+    Inputs: ref_times (numpy datetime64 array) - ping times of the reference channel
+            times (numpy datetime64 array) - ping times of the other channel
+            tolerance (numpy timedelta64) - pings further apart than this are not matched - defaults to half of the median time
+                                            between reference pings
+    Output: numpy integer array with the index of the matched ping in times for each reference ping, -1 if there is no match
+    '''
+    ref_ms = np.asarray(ref_times).astype("datetime64[ms]").astype(np.int64)
+    ms = np.asarray(times).astype("datetime64[ms]").astype(np.int64)
+    if tolerance is None:
+        tolerance = np.median(np.diff(ref_ms))/2 if len(ref_ms) > 1 else 0
+    else:
+        tolerance = np.timedelta64(tolerance, "ms").astype(np.int64)
+    return nearest_index(ref_ms, ms, tolerance)
+
+def sample_alignment(ref_depth, depth):
+    '''
+    sample_alignment: maps the samples of a channel onto the samples (depths) of a reference channel - each reference sample
+                      covers the depths half way to its neighbours - every channel sample inside that range is averaged (in
+                      the linear domain) and if there are none, the closest channel sample is used
+    Inputs: ref_depth (numpy array) - depth of each sample of the reference channel (increasing)
+            depth (numpy array) - depth of each sample of the channel to align (increasing)
+    Output: sample map dictionary - "starts" and "counts" (first channel sample and number of channel samples inside each
+            reference sample) and "nearest" (closest channel sample to each reference sample, -1 if the reference sample is
+            outside the channel's depths) - see apply_alignment
+    '''
+    ref_depth = np.asarray(ref_depth, dtype=float)
+    depth = np.asarray(depth, dtype=float)
+    edges = (ref_depth[1:] + ref_depth[:-1])/2
+    half_first = (ref_depth[1] - ref_depth[0])/2 if len(ref_depth) > 1 else 0
+    half_last = (ref_depth[-1] - ref_depth[-2])/2 if len(ref_depth) > 1 else 0
+    inside = (depth >= ref_depth[0] - half_first) & (depth <= ref_depth[-1] + half_last)
+    bins = np.where(inside, np.searchsorted(edges, depth), -1) # reference sample each channel sample falls in
+    counts = np.bincount(bins[inside], minlength=len(ref_depth))
+    starts = np.searchsorted(np.where(inside, bins, np.where(depth < ref_depth[0], -1, len(ref_depth))), np.arange(len(ref_depth)))
+    spacing = np.median(np.diff(depth)) if len(depth) > 1 else half_first*2
+    return {"starts": starts, "counts": counts, "nearest": nearest_index(ref_depth, depth, spacing)}
+
+def apply_alignment(data, ping_idx, sample_map):
+    '''
+    apply_alignment: puts the Sv data of one channel onto the pings and samples of the reference channel with gathers
+    Inputs: data (numpy array) - Sv data of the channel (pings x samples)
+            ping_idx (numpy integer array) - see ping_alignment - can be a slice of it to align only some reference pings
+            sample_map (dictionary) - see sample_alignment - can be sliced the same way to align only some reference samples
+    Output: numpy array (reference pings x reference samples) - NaN where there is no matching ping or sample (calc_MFI
+            skips NaN when normalizing, so only those cells of the MFI are NaN)
+    '''
+    starts, counts, nearest = sample_map["starts"], sample_map["counts"], sample_map["nearest"]
+    averaged = counts > 1
+    # only the channel samples that are needed are gathered
+    used = np.concatenate([nearest[nearest >= 0], starts[averaged], starts[averaged] + counts[averaged] - 1])
+    first = int(used.min()) if len(used) != 0 else 0
+    last = int(used.max()) if len(used) != 0 else 0
+    rows = data[np.maximum(ping_idx, 0), first:last+1] # gather pings
+    aligned = rows[:, np.maximum(nearest - first, 0)] # gather closest samples
+    if np.any(averaged): # more than one channel sample per reference sample - mean in the linear domain
+        bin_starts = starts[averaged] - first
+        linear = np.concatenate([10**(rows/10), np.zeros((len(rows), 1), dtype=rows.dtype)], axis=1) # extra column so every end is a valid index
+        bounds = np.stack([bin_starts, bin_starts + counts[averaged]], axis=1).ravel()
+        sums = np.add.reduceat(linear, bounds, axis=1)[:, ::2]
+        aligned[:, averaged] = 10*np.log10(sums/counts[averaged])
+    aligned[:, (nearest < 0) & (counts == 0)] = math.nan
+    aligned[ping_idx < 0] = math.nan
+    return aligned
+
+def alignment_maps(Sv_dic, reference_fq, frequencies, ping_tolerance = None):
+    '''
+    alignment_maps: calculates the ping and sample maps from every channel of a cast to the reference channel once, so they
+                    can be used for every crop of the cast
+    Inputs: Sv_dic (dictionary) - frequencies as keys and (Sv object, calibration object) as values - see raw_files_to_Sv
+            reference_fq (integer) - frequency every other frequency is aligned to
+            frequencies (integer list) - frequencies to align
+            ping_tolerance (numpy timedelta64) - see ping_alignment
+    Output: dictionary with frequencies as keys and (ping index array, sample map) as values - None for channels that already
+            have the same pings and samples as the reference
+    '''
+    Sv_ref = Sv_dic[reference_fq][0]
+    ref_times = np.asarray(Sv_ref.ping_time)
+    ref_depth = np.asarray(Sv_ref.depth)
+    maps = {}
+    for fq in frequencies:
+        Sv = Sv_dic[fq][0]
+        times, depth = np.asarray(Sv.ping_time), np.asarray(Sv.depth)
+        if len(times) == len(ref_times) and len(depth) == len(ref_depth) and np.array_equal(times, ref_times) and \
+           np.array_equal(depth, ref_depth):
+            maps[fq] = None
+        else:
+            maps[fq] = (ping_alignment(ref_times, times, ping_tolerance), sample_alignment(ref_depth, depth))
+    return maps
+
+def align_Sv(Sv, Sv_ref, alignment, xlim = None, ylim = None):
+    '''
+    align_Sv: creates a copy of an Sv object on the pings and samples of the reference Sv object
+    Inputs: Sv (Sv processed data object) - Sv of the channel to align
+            Sv_ref (Sv processed data object) - Sv of the reference channel
+            alignment (tuple) - (ping index array, sample map) from alignment_maps - if None, Sv is cropped (see crop_Sv) or
+                                returned as it is
+            xlim, ylim (integer lists) - optional [lower, higher] reference ping and sample index limits (inclusive, same as
+                                         crop_Sv) - only this part is aligned
+    Output: Sv processed data object with data, ping_time, and depth matching Sv_ref (or the crop of it) - Sv is not changed
+    '''
+    n_ref_pings, n_ref_samples = len(Sv_ref.ping_time), len(Sv_ref.depth)
+    x_slice = slice(0, n_ref_pings) if xlim is None else slice(int(xlim[0]), int(xlim[1])+1)
+    y_slice = slice(0, n_ref_samples) if ylim is None else slice(int(ylim[0]), int(ylim[1])+1)
+    if alignment is None:
+        return Sv if xlim is None and ylim is None else crop_Sv(Sv, [x_slice.start, x_slice.stop-1], [y_slice.start, y_slice.stop-1])
+
+    ping_idx = alignment[0][x_slice]
+    sample_map = {name: values[y_slice] for name, values in alignment[1].items()}
+    aligned = copy.copy(Sv)
+    n_pings = len(Sv.ping_time)
+    for name in dict.fromkeys(["transducer_offset", "heave"] + list(getattr(Sv, "_data_attributes", []))):
+        value = getattr(Sv, name, None)
+        if isinstance(value, np.ndarray) and value.ndim > 0 and value.shape[0] == n_pings:
+            setattr(aligned, name, value[np.maximum(ping_idx, 0)])
+    aligned.data = apply_alignment(np.asarray(Sv.data), ping_idx, sample_map)
+    aligned.ping_time = Sv_ref.ping_time[x_slice]
+    aligned.depth = Sv_ref.depth[y_slice]
+    if isinstance(getattr(Sv_ref, "range", None), np.ndarray):
+        aligned.range = Sv_ref.range[y_slice]
+    aligned.n_pings = len(aligned.ping_time)
+    if hasattr(Sv, "n_samples"):
+        aligned.n_samples = aligned.data.shape[1]
+    if hasattr(Sv, "shape"):
+        aligned.shape = aligned.data.shape
+    return aligned
+
+def crop_boxes_Sv(Sv_dic, boxes, frequencies = [18000, 38000, 120000, 200000], reference_fq = 18000, copy_data = False,
+                  ping_tolerance = None):
+    '''
+    crop_boxes_Sv: crops already calculated Sv data of one cast to a set of (time window, depth window) boxes for every frequency
+    Inputs: Sv_dic (dictionary) - frequencies as keys and (Sv object, calibration object) as values - see raw_files_to_Sv
+            boxes (dictionary) - keys are box names and values are ((start time, end time), (min depth, max depth))
+            frequencies (integer list) - frequencies to crop - must be keys of Sv_dic
+            reference_fq (integer) - all frequencies are aligned to the pings and samples of this frequency so the crops line up -
+                                     must be a key of Sv_dic
+            copy_data (boolean) - if True each crop gets its own copy of the data, otherwise crops are views (see crop_Sv)
+            ping_tolerance (numpy timedelta64) - pings of other channels further than this from a reference ping are NaN - see
+                                                 ping_alignment
+    Outputs: nested dictionary with box names as outer keys and frequencies (as strings) as inner keys with cropped Sv objects
+             as values - same format as subset_segments_Sv
+    Note: the maps from channels with different pings or samples than the reference channel are calculated once per call (see
+          alignment_maps) and each box is aligned with gathers (see align_Sv), so every crop of a box has the same shape -
+          Sv objects in Sv_dic are not changed
+    '''
+    Sv_ref = Sv_dic[reference_fq][0]
+
+    # find indices closest to bounds of every box at once
+    # once we align, these should be the same for each frequency
+    names = list(boxes.keys())
+    times = np.array(Sv_ref.ping_time)
+    depths = np.array(Sv_ref.depth)
+    box_times = np.array([boxes[name][0] for name in names], dtype=times.dtype).reshape(-1, 2)
+    box_depths = np.array([boxes[name][1] for name in names], dtype=float).reshape(-1, 2)
+    x_idx = np.argmin(np.abs(times[np.newaxis, np.newaxis, :] - box_times[:, :, np.newaxis]), axis=2)
+    y_idx = np.argmin(np.abs(depths[np.newaxis, np.newaxis, :] - box_depths[:, :, np.newaxis]), axis=2)
+
+    with trace.span("alignment_maps", frequencies=len(frequencies)):
+        maps = alignment_maps(Sv_dic, reference_fq, frequencies, ping_tolerance)
+    box_Sv_dic = {name: {} for name in names}
+    for fq in frequencies:
+        Sv = Sv_dic[fq][0]
+        with trace.span("crop_boxes", frequency=fq, boxes=len(names), aligned=maps[fq] is not None):
+            for i, name in enumerate(names):
+                if maps[fq] is None:
+                    box_Sv_dic[name][str(fq)] = crop_Sv(Sv, x_idx[i], y_idx[i], copy_data) # "crop" Sv to get subset
+                else: # only the pings and samples inside the box are gathered from the channel
+                    box_Sv_dic[name][str(fq)] = align_Sv(Sv, Sv_ref, maps[fq], x_idx[i], y_idx[i])
+    return box_Sv_dic
+
+def extract_boxes_Sv(raw_files, boxes, transducer_offset, frequencies = [18000, 38000, 120000, 200000], reference_fq = 18000,
+                     sv_cache = None, copy_data = False, windowed = False, index_path = ""):
+    '''
+    extract_boxes_Sv: crops the Sv data of one cast to a set of (time window, depth window) boxes for every frequency - Sv for each
+                      frequency is calculated (and its alignment to the reference frequency) only once no matter how many boxes there are
+    Inputs: raw_files (list of string) - list of filenames of raw files for one CTD cast
+            boxes (dictionary) - keys are box names and values are ((start time, end time), (min depth, max depth)) - can be made
+                                 by segment_boxes for the segments of a cast and/or by hand for reference/control regions
+            transducer_offset (double) - offset of transducer from water surface in meters
+            frequencies (integer list) - list of frequnecies within raw data
+            reference_fq (integer) - all frequencies are aligned to the pings and samples of this frequency so the crops line up
+            sv_cache (SvCache object) - optional cache of Sv data so .raw files are not decoded again - see raw_files_to_Sv
+            copy_data (boolean) - if True each crop gets its own copy of the data, otherwise crops are views of the full cast Sv
+                                  (see crop_Sv)
+            windowed (boolean) - if True, only the pings within each box's time window are decoded (using the ping time index of
+                                 the .raw files, see CTD_EK_rawindex.py) instead of the whole cast - faster for a few boxes in
+                                 long .raw files, but overlapping boxes are decoded more than once - boxes with no pings
+                                 are left out
+            index_path (string) - optional folder the .raw file indexes are saved in - see raw_files_to_Sv
+    Outputs: nested dictionary with box names as outer keys and frequencies (as strings) as inner keys with cropped Sv objects
+             as values - same format as subset_segments_Sv
+    '''
+    read_fq = list(dict.fromkeys([reference_fq] + list(frequencies)))
+    if not windowed:
+        Sv_dic = raw_files_to_Sv(raw_files, read_fq, transducer_offset, sv_cache)
+        return crop_boxes_Sv(Sv_dic, boxes, frequencies, reference_fq, copy_data)
+
+    box_Sv_dic = {}
+    for name in boxes:
+        Sv_dic = raw_files_to_Sv(raw_files, read_fq, transducer_offset, sv_cache, boxes[name][0], index_path)
+        if len(Sv_dic) == 0: # no pings in the box
+            continue
+        box_Sv_dic.update(crop_boxes_Sv(Sv_dic, {name: boxes[name]}, frequencies, reference_fq, copy_data))
+    return box_Sv_dic
+
+STREAM_MEMORY_FACTOR = 6 # bytes held while a chunk is decoded per byte of its Sv (raw power/angle/complex samples, Sv, crops)
+STREAM_PROBE_SECONDS = 60 # length of the window decoded to measure how many bytes of Sv a second of the cast is
+STREAM_MIN_SECONDS = 60 # chunks are never shorter than this, however small the memory budget
+
+def stream_windows(boxes, chunk_seconds):
+    '''
+    stream_windows: groups boxes into time windows no longer than chunk_seconds so each window can be decoded on its own - boxes
+                    close together share a window and boxes longer than chunk_seconds are split into pieces with a window each
+    Inputs: boxes (dictionary) - box names as keys and ((start time, end time), (min depth, max depth)) as values
+            chunk_seconds (float) - longest window in seconds
+    Output: list of window dictionaries with "window" ((start time, end time) of its boxes), "pieces" (dictionary with piece
+            names as keys and (box name, piece box, piece number, number of pieces) as values - the piece name is the box name
+            if the box is not split), and "shared" (True if other boxes can still be added)
+    '''
+    chunk = np.timedelta64(int(chunk_seconds*1000), "ms")
+    windows = []
+    for name in sorted(boxes, key=lambda name: np.datetime64(boxes[name][0][0], "ms")):
+        (start, end), depth = boxes[name]
+        start, end = np.datetime64(start, "ms"), np.datetime64(end, "ms")
+        n_pieces = max(1, int(np.ceil((end - start)/chunk)))
+        if n_pieces == 1 and len(windows) != 0 and windows[-1]["shared"]:
+            window_start, window_end = windows[-1]["window"]
+            if max(end, window_end) - window_start <= chunk: # fits in the window of the boxes before it
+                windows[-1]["window"] = (window_start, max(end, window_end))
+                windows[-1]["pieces"][name] = (name, ((start, end), depth), 0, 1)
+                continue
+        edges = start + (end - start)*np.arange(n_pieces + 1)//n_pieces
+        for k in range(n_pieces):
+            piece = name if n_pieces == 1 else (name, k)
+            windows.append({"window": (edges[k], edges[k+1]), "pieces": {piece: (name, ((edges[k], edges[k+1]), depth), k, n_pieces)},
+                            "shared": n_pieces == 1})
+    return windows
+
+def stream_boxes_Sv(raw_files, boxes, transducer_offset, frequencies = [18000, 38000, 120000, 200000], reference_fq = 18000,
+                    memory_mb = 1024, overlap_seconds = 10, index_path = "", ping_tolerance = None, read_frequencies = [],
+                    chunk_function = None, dtype = np.float64):
+    '''
+    stream_boxes_Sv: bounded-memory version of extract_boxes_Sv for long casts - the cast is walked in chunks of pings sized to a
+                     memory budget, only one chunk is decoded at a time, and each box is given back as soon as the chunks it is
+                     in are done, so the memory used depends on memory_mb and the box sizes, not on the length of the cast
+    Inputs: raw_files (list of string) - list of filenames of raw files for one CTD cast
+            boxes (dictionary) - box names as keys and ((start time, end time), (min depth, max depth)) as values
+            transducer_offset (double) - offset of transducer from water surface in meters
+            frequencies (integer list) - frequencies to crop
+            reference_fq (integer) - all frequencies are aligned to the pings and samples of this frequency (see crop_boxes_Sv)
+            memory_mb (float) - memory budget in megabytes for decoding one chunk - the number of pings in a chunk is worked out
+                                from the Sv of the first minute of the boxes (see STREAM_MEMORY_FACTOR) - chunks are
+                                STREAM_MIN_SECONDS long if there are no pings in that minute (i.e. the first box starts
+                                before the recording)
+            overlap_seconds (float) - seconds decoded before and after each chunk so pings at the edges of a chunk are aligned to
+                                      the pings of other channels on both sides, same as when the whole cast is decoded - should
+                                      be more than the time between pings
+            index_path (string) - optional folder the .raw file indexes are saved in - see raw_files_to_Sv
+            ping_tolerance (numpy timedelta64) - see crop_boxes_Sv
+            read_frequencies (integer list) - other frequencies to decode for chunk_function (i.e. the seabed frequency)
+            chunk_function (function) - optional function called with the Sv dictionary (see raw_files_to_Sv) of each chunk before
+                                        it is freed (i.e. to detect the seabed) - chunks only cover the time windows of the boxes
+            dtype (numpy dtype) - type of the Sv data - see raw_to_Sv - float32 chunks are twice as long for the same budget
+    Output: generator of (box name, dictionary with frequencies (as strings) as keys and cropped Sv objects as values) tuples -
+            in order of the end of the boxes, each with its own copy of the data - dict(stream_boxes_Sv(...)) has the same
+            format as extract_boxes_Sv - boxes with no pings (i.e. in a gap between .raw files) are not given back
+    Note: only the pings of the chunks are decoded, using the ping time index of the .raw files (see CTD_EK_rawindex.py) - Sv is
+          not cached. Boxes longer than a chunk are cropped in pieces and joined with concat_Sv - they have the same pings as
+          when the whole cast is decoded
+    '''
+    if len(boxes) == 0:
+        return
+    read_fq = list(dict.fromkeys([reference_fq] + list(frequencies) + list(read_frequencies)))
+    overlap = np.timedelta64(int(overlap_seconds*1000), "ms")
+
+    # bytes of Sv per second of the cast, from a short window at the start of the first box
+    first_start = min(np.datetime64(box[0][0], "ms") for box in boxes.values())
+    with trace.span("stream_probe"):
+        probe = raw_files_to_Sv(raw_files, read_fq, transducer_offset, None,
+                                (first_start, first_start + np.timedelta64(STREAM_PROBE_SECONDS, "s")), index_path, dtype=dtype)
+    chunk_seconds = STREAM_MIN_SECONDS # no pings in the probe to measure, so the smallest chunks are used
+    if len(probe) != 0:
+        ref_times = np.asarray(probe[reference_fq][0].ping_time)
+        seconds = STREAM_PROBE_SECONDS
+        if len(ref_times) > 1: # pings of the probe plus one more ping
+            seconds = (ref_times[-1] - ref_times[0])/np.timedelta64(1, "ms")/1000*len(ref_times)/(len(ref_times) - 1)
+        bytes_per_second = sum(np.asarray(probe[fq][0].data).nbytes for fq in read_fq)/seconds
+        if bytes_per_second > 0:
+            chunk_seconds = max(memory_mb*2**20/(STREAM_MEMORY_FACTOR*bytes_per_second), STREAM_MIN_SECONDS)
+    del probe
+
+    parts = {} # pieces of split boxes waiting for the rest of the box
+    for window in stream_windows(boxes, chunk_seconds):
+        pieces = window["pieces"]
+        with trace.span("stream_chunk", boxes=len(pieces), seconds=round(chunk_seconds)):
+            Sv_dic = raw_files_to_Sv(raw_files, read_fq, transducer_offset, None,
+                                     (window["window"][0] - overlap, window["window"][1] + overlap), index_path, dtype=dtype)
+            crops = {} # boxes (or pieces of boxes) with no pings of their own are skipped, not cropped to the nearest ping
+            if len(Sv_dic) != 0:
+                if chunk_function is not None:
+                    chunk_function(Sv_dic)
+                ref_times = np.asarray(Sv_dic[reference_fq][0].ping_time)
+                has_pings = {piece: pieces[piece][1] for piece in pieces if
+                             np.any((ref_times >= pieces[piece][1][0][0]) & (ref_times <= pieces[piece][1][0][1]))}
+                if len(has_pings) != 0:
+                    crops = crop_boxes_Sv(Sv_dic, has_pings, frequencies, reference_fq, True, ping_tolerance)
+            del Sv_dic # the crops are copies, so the chunk is freed here
+
+        for piece, (name, ((piece_start, piece_end), _), k, n_pieces) in pieces.items():
+            if n_pieces == 1:
+                if piece in crops:
+                    yield name, crops.pop(piece)
+                continue
+            # pieces meet at their edges - each keeps the pings from its start up to (not including) its end, except at the
+            # ends of the box where the nearest ping is used, same as crop_boxes_Sv - pieces with no pings are left out
+            if piece in crops:
+                piece_Sv = crops.pop(piece)
+                times = np.asarray(next(iter(piece_Sv.values())).ping_time)
+                keep = np.ones(len(times), dtype=bool)
+                if k != 0:
+                    keep &= times >= piece_start
+                if k != n_pieces - 1:
+                    keep &= times < piece_end
+                kept = np.flatnonzero(keep)
+                if len(kept) != 0:
+                    parts.setdefault(name, []).append({fq: crop_Sv(Sv, [kept[0], kept[-1]], [0, np.shape(Sv.data)[1] - 1], True)
+                                                       for fq, Sv in piece_Sv.items()})
+            if k == n_pieces - 1 and name in parts:
+                box_parts = parts.pop(name)
+                yield name, {fq: concat_Sv([part[fq] for part in box_parts]) for fq in box_parts[0]}
+
+def subset_segments_Sv(segment_dic, raw_files, toffsets, doffsets, transducer_offset, frequencies = [18000, 38000, 120000, 200000],
+                       sv_cache = None, usable_only = True, reference_boxes = {}, windowed = False):
     '''
     subset_segments_Sv: takes a segment dictionary generated by create_segments_dic - for each usable segment, the matching
                         raw file is subset around the segment using time and depth offsets to create a smaller rectangle of
                         the raw data for each frequency
-    Inputs: segment_dic (segment dictionary) - segment dictionary after running create_segments_dic or interactive_segment_maker
+    Inputs: segment_dic (segment dictionary) - segment dictionary after running create_segments_dic or interactive_segment_maker,
+                                               or a segment table (see CTD_EK_segments.py)
             raw_files (list of string) - list of filenames of raw files that correspond to CTD profile in segment_dic
             toffsets (integer list) - two item list with minute offsets from the start of data collection in segments 
                                       first item for minutes before data collection and second item for minutes after start of collection
@@ -525,6 +1504,10 @@ def subset_segments_Sv(segment_dic, raw_files, toffsets, doffsets, transducer_of
                                      first item is meters above mean, second is meters below mean
             transducer_offset (double) - offset of transducer from water surface in meters
             frequencies (integer list) - list of frequnecies within raw data
+            sv_cache (SvCache object) - optional cache of Sv data so .raw files are not decoded again - see raw_files_to_Sv
+            usable_only (boolean) - if False, every plateau (bottle segment) is subset, not just usable segments
+            reference_boxes (dictionary) - optional extra boxes to subset (i.e. control regions) - see extract_boxes_Sv for format
+            windowed (boolean) - if True only the pings in each box are decoded - see extract_boxes_Sv
     Outputs: (1) nested dictionary for each usable segment with points within defined subset for each frequency
              Format: 
                         {depth 1: {frequency 1: cropped Sv data object for frequency 1 at depth 1
@@ -539,71 +1522,39 @@ def subset_segments_Sv(segment_dic, raw_files, toffsets, doffsets, transducer_of
                         }
     Note: This is for one CTD profile - if you want to do more than one you need to loop
             '''
-    ek80 = EK80.EK80()
-    ek80.read_raw(raw_files) # raw files that will be subset
-    subset_segment_dic = {}
-    for num in segment_dic:
-        seg = segment_dic[num]
-        if seg["usable"]: # we only want to subset depths at which eDNA data was taken
-            y_mean = float(seg["depth"]) # depth of sample
-            fq_dic = {}
-            subset_segment_dic[str(round(y_mean))] = fq_dic # outermost keys are sample depth
-            points_time, points_depth = zip(*seg["points"])
-            points_time = [np.datetime64(x) for x in points_time]
-
-            # bounds of subset
-            y_min = y_mean - doffsets[0]
-            y_max = y_mean + doffsets[1]
-            x_min = min(points_time) - np.timedelta64(toffsets[0], 'm') 
-            x_max = min(points_time) + np.timedelta64(toffsets[1], 'm')
-
-            Sv18, cal18 = raw_to_Sv(ek80, 18000, transducer_offset)
-            # find indices closest to bounds
-            # once we resample, these should be the same for each frequency
-            depths = np.array(Sv18.depth)
-            y_min_idx = np.argmin(np.abs(depths - y_min))
-            y_max_idx = np.argmin(np.abs(depths - y_max))
-
-            times = np.array(Sv18.ping_time)
-            x_min_idx = np.argmin(np.abs(times - x_min))
-            x_max_idx = np.argmin(np.abs(times - x_max))
-
-            for fq in frequencies:
-                Sv, cal =  raw_to_Sv(ek80, fq, transducer_offset) # get Sv data for each frequency
-                if cal.sample_interval != cal18.sample_interval: # resample to match 18kHz
-                    Sv.match_samples(Sv18)
-                subset_Sv = crop_Sv(copy.deepcopy(Sv), (x_min_idx, x_max_idx), (y_min_idx, y_max_idx)) # "crop" Sv to get subset
-                fq_dic[str(fq)] = subset_Sv # Sv object saved
-
-    return subset_segment_dic
+    boxes = segment_boxes(segment_dic, toffsets, doffsets, usable_only) # we only want to subset depths at which eDNA data was taken
+    boxes.update(reference_boxes)
+    return extract_boxes_Sv(raw_files, boxes, transducer_offset, frequencies, sv_cache=sv_cache, windowed=windowed)
 
 def subset_to_json(subset_dic):
     '''
     subset_to_json: takes  a subset dictionary created by subset_segments_Sv and turns it into a format that can be dumped to a .json file
-    Inputs: subset_dic (subset dictionary of Sv objects)
+    Inputs: subset_dic (subset dictionary of Sv objects) - Sv objects can be crops/views made by crop_Sv - subset_dic is not changed
     Outputs: (1) Dictionary with same structure as subset_dic but instead of the innermost values being Sv data objects from pyEcholab,
              they're nested lists of doubles - this is just the Sv data and does not have the ping_time or depth data like the Sv object
              (2) Nested dictionary with depths for outermost keys and "depths" and "ping time" for inner keys with the depth and ping time
                  values for each list stored as 1D arrays 
     '''
+    json_dic = {}
     bounds_dic = {}
     for depth in subset_dic:
         depth_subset = subset_dic[depth]
         frequencies = list(depth_subset.keys())
-        pings_arr = [np.datetime_as_string(x) for x in depth_subset[frequencies[0]].ping_time]
-        depth_arr = depth_subset[frequencies[0]].depth.tolist()
+        pings_arr = np.datetime_as_string(depth_subset[frequencies[0]].ping_time).tolist()
+        depth_arr = np.asarray(depth_subset[frequencies[0]].depth).tolist()
         bounds_dic[depth] = {"depth": depth_arr, "ping_time": pings_arr}
-        for fq in frequencies:
-            depth_subset[fq] = depth_subset[fq].data.tolist() # lists can be "dumped" to .json files
-    return subset_dic, bounds_dic
+        # lists can be "dumped" to .json files
+        json_dic[depth] = {fq: np.asarray(depth_subset[fq].data).tolist() for fq in frequencies}
+    return json_dic, bounds_dic
 
 
 def interactive_subset_maker(segment_dic, raw_files, transducer_offset, toffsets, doffsets,
-                             frequencies = [18000, 38000, 120000, 200000], thresholds = [-90, -20], outfile_path=""):
+                             frequencies = [18000, 38000, 120000, 200000], thresholds = [-90, -20], outfile_path="", sv_cache = None):
     '''
     interactive_subset_maker: interactive check of subset_segments_Sv function - allows user to confirm the bounds of the subsets for each depth
                               and to choose to remove any frequencies with bad data
-    Inputs: segment_dic (segment dictionary) - segment dictionary after running create_segments_dic or interactive_segment_maker
+    Inputs: segment_dic (segment dictionary) - segment dictionary after running create_segments_dic or interactive_segment_maker,
+                                               or a segment table (see CTD_EK_segments.py)
             raw_files (list of string) - list of filenames of raw files that correspond to CTD profile in segment_dic
             toffsets (integer list) - two item list with minute offsets from the start of data collection in segments 
                                       first item for minutes before data collection and second item for minutes after start of collection
@@ -613,17 +1564,20 @@ def interactive_subset_maker(segment_dic, raw_files, transducer_offset, toffsets
             frequencies (integer list) - list of frequnecies within raw data
             thresholds (integer list) - thresholds for echogram plotting with pyEcholab
             outfile_path (string) - if a path and filename is provided, a json file is saved that has Sv data points in an array (not Sv object)
+            sv_cache (SvCache object) - optional cache of Sv data so .raw files are not decoded again when bounds are changed
     Outputs: nested dictionary for each usable segment with points within defined subset for each frequency - see subset_segments_Sv function
              comments for format
-    Note: This is for one CTD profile - if you want to do more than one you need to loop
+    Note: This is for one CTD profile - if you want to do more than one you need to loop - each subset is shown with the cast
+          around it (see plotting.plot_echo_pyramid) and new bounds are cropped from Sv already in memory
     '''
 
 
-    def check_subset_bounds(subset, depth_val):
+    def check_subset_bounds(subset, depth_val, n_segment):
         '''
         check_subset_bounds: checks the bounds of subset for one depth 
         Inputs: subset (dictionary) - dictionary of ONE depth, which has keys that are frequencies and values that are subset Sv objects
                 depth_val (float) - depth of the subset
+                n_segment (string) - number of the segment the subset is around (see segment_box_rows)
         Output: dictionary of specific depth with bounds specified and approved by user
         '''
         def get_offset(message, type):
@@ -644,23 +1598,27 @@ def interactive_subset_maker(segment_dic, raw_files, transducer_offset, toffsets
             return offsets
 
 
-        fig, ax = plt.subplots(constrained_layout = True)
-        ax.set_title("Example Subset at " + str(depth_val) + "m")
-        echogram.Echogram(ax, subset[str(frequencies[0])], threshold = thresholds)
+        box_Sv = subset[str(frequencies[0])]
+        box_time = [box_Sv.ping_time[0], box_Sv.ping_time[-1]]
+        box_depth = [box_Sv.depth[0], box_Sv.depth[-1]]
+        fig, ax = plt.subplots(2, figsize=(10,8), constrained_layout = True)
+        # the cast around the subset, drawn from the Sv pyramid so it can be zoomed and panned without waiting
+        plotting.plot_echo_pyramid(ax[0], context, thresholds, "Cast around subset at " + str(depth_val) + "m",
+                                   [box_time[0] - 3*(box_time[1] - box_time[0]), box_time[1] + 3*(box_time[1] - box_time[0])],
+                                   [max(box_depth[0] - 20, 0), box_depth[1] + 20])
+        ax[0].add_patch(Rectangle((box_time[0].astype('float'), box_depth[0]), (box_time[1] - box_time[0]).astype('float'),
+                                  box_depth[1] - box_depth[0], fill=False, color="red", linewidth=2))
+        ax[1].set_title("Example Subset at " + str(depth_val) + "m")
+        echogram.Echogram(ax[1], box_Sv, threshold = thresholds)
         correct_bounds = input("Are the bounds of the subset postioned well (i.e does not go into the surface, the bottom)? [y/n]")
         plt.close()
         if correct_bounds.lower() != "y":
             new_toffsets = get_offset("Time offsets in minutes (minutes before and after start of data capture; seperate with a comma):", "int")
             new_doffsets = get_offset("Depth offsets in meters (meters above and below CTD sample depth; seperate with a comma):", "float")
-            segment = {}
-            n_segment = ""
-            for seg_num in segment_dic:
-                seg = segment_dic[seg_num]
-                if seg["usable"] and round(seg["depth"]) == int(depth_val):
-                    segment = seg
-                    n_segment = seg_num
-            subset= subset_segments_Sv({n_segment: segment}, raw_files, new_toffsets, new_doffsets, transducer_offset)
-            subset = check_subset_bounds(subset[str(int(depth_val))], depth_val)
+            # the cast's Sv is already calculated, so new bounds are only a crop
+            boxes = segment_boxes({n_segment: segment_dic[n_segment]}, new_toffsets, new_doffsets)
+            subset = next(iter(crop_boxes_Sv(Sv_dic, boxes, frequencies).values())) # the only box
+            subset = check_subset_bounds(subset, depth_val, n_segment)
         return subset
     
     def check_subset_freq(subset, depth_val):
@@ -700,11 +1658,21 @@ def interactive_subset_maker(segment_dic, raw_files, transducer_offset, toffsets
 
     # interactive_subset_maker starts here
     plt.ion()
-    subset_dic = subset_segments_Sv(segment_dic, raw_files, toffsets, doffsets, transducer_offset, frequencies) # starting subsets
+    segment_dic = seg_table.as_segment_dic(segment_dic) # the segment of each box is looked up by its number below
+    # Sv of the cast is calculated once - starting subsets and any new bounds are crops of it (same as subset_segments_Sv)
+    Sv_dic = raw_files_to_Sv(raw_files, list(dict.fromkeys([18000] + list(frequencies))), transducer_offset, sv_cache,
+                             processes = None) # one process per .raw file
+    if sv_cache is not None: # the pyramid is saved next to the Sv in the cache
+        context = sv_cache.get_pyramid(raw_files, frequencies[0], {"transducer_offset_z": transducer_offset})
+    if sv_cache is None or context is None:
+        context = Sv_pyramid(Sv_dic[frequencies[0]][0])
+    subset_dic = crop_boxes_Sv(Sv_dic, segment_boxes(segment_dic, toffsets, doffsets), frequencies) # starting subsets
+    box_segments = {name: (num, float(round(y_mean))) for name, num, y_mean, _ in segment_box_rows(segment_dic)}
     for depth in subset_dic: 
         print("Subsetting at " + depth + "m")
-        subset = check_subset_bounds(subset_dic[depth], float(depth)) # check each depth's subset bounds
-        subset = check_subset_freq(subset, float(depth)) # check if all freqencies have good data
+        n_segment, depth_val = box_segments[depth] # keys like "42_7" are not numbers (see segment_boxes)
+        subset = check_subset_bounds(subset_dic[depth], depth_val, n_segment) # check each depth's subset bounds
+        subset = check_subset_freq(subset, depth_val) # check if all freqencies have good data
         subset_dic[depth] = subset # if subset was updated, replace within the subset dictionary
 
     if len(outfile_path) != 0: # if we have an outfile, save outfile
@@ -715,81 +1683,352 @@ def interactive_subset_maker(segment_dic, raw_files, transducer_offset, toffsets
     return subset_dic
 
 
-def calc_MFI(Sv_data_dic, depth = math.nan, delta = 40, bad_fq = [], global_norm = False):
+def default_subset_policy():
+    '''
+    default_subset_policy: rules used by policy_subset_maker to place subsets and drop bad frequencies without user input
+    Output: policy dictionary - change any of the values before passing it to policy_subset_maker/policy_subset_casts
+                "toffsets", "doffsets" - time (minutes) and depth (meters) offsets of the boxes around each segment (see segment_boxes)
+                "frequencies" (integer list) - frequencies to subset
+                "reference_fq" (integer) - frequency every other frequency is aligned to (see extract_boxes_Sv)
+                "near_field" (float) - meters below the transducer that are too close to use - boxes are clamped to start below it
+                "seabed_fq" (integer) - frequency used to find the seabed - None to skip seabed clamping
+                "seabed_threshold" (float) - Sv (dB) of the first sample counted as seabed
+                "seabed_margin" (float) - meters above the shallowest seabed depth in the time window that the box has to end
+                "min_height" (float) - boxes shorter than this (meters) after clamping are dropped and flagged
+                "quality" (dictionary) - frequencies (or "default") as keys and thresholds as values - a frequency is dropped from
+                                         a subset if it has more than "max_invalid" fraction of non-finite samples, a standard
+                                         deviation over "max_std" dB, or a median Sv outside "Sv_range"
+                "min_frequencies" (integer) - subsets with fewer good frequencies than this are flagged for review
+                "memory_mb" (float) - if not None, the cast is decoded in chunks within this memory budget (megabytes) rather
+                                      than all at once - see stream_boxes_Sv - for casts too long to fit in memory
+                "dtype" (string) - type of the Sv data, "float64" or "float32" (half the memory) - see raw_to_Sv
+    '''
+    return {"toffsets": (5, 5), "doffsets": (2, 2), "frequencies": [18000, 38000, 120000, 200000], "reference_fq": 18000,
+            "near_field": 3, "seabed_fq": 38000, "seabed_threshold": -30, "seabed_margin": 2, "min_height": 1,
+            "quality": {"default": {"max_invalid": 0.1, "max_std": 15, "Sv_range": [-100, -40]},
+                        200000: {"max_invalid": 0.05, "max_std": 10, "Sv_range": [-100, -50]}}, # 200 kHz is often noisy
+            "min_frequencies": 3, "memory_mb": None, "dtype": "float64"}
+
+def detect_seabed(Sv, threshold = -30, min_depth = 0):
+    '''
+    detect_seabed: finds the seabed in each ping as the first sample below min_depth with Sv over the threshold
+    Inputs: Sv (Sv processed data object) - Sv of one frequency with data, ping_time, and depth attributes
+            threshold (float) - Sv (dB) of the first sample counted as seabed
+            min_depth (float) - samples above this depth are not searched (i.e. surface and near-field noise)
+    Output: numpy float array with the seabed depth of each ping - NaN if no sample is over the threshold (or below min_depth)
+    '''
+    depths = np.asarray(Sv.depth)
+    searched = depths >= min_depth
+    if not searched.any(): # nothing to search, argmax can't be taken of no samples
+        return np.full(np.shape(Sv.data)[0], math.nan)
+    over = np.asarray(Sv.data)[:, searched] > threshold # NaN samples are never over the threshold
+    first = np.argmax(over, axis=1)
+    return np.where(over.any(axis=1), depths[searched][first], math.nan)
+
+def subset_quality(Sv_data):
+    '''
+    subset_quality: quality measures of the Sv data of one frequency of one subset - see default_subset_policy "quality"
+    Input: Sv_data (numpy array) - Sv data of the subset
+    Output: dictionary with "invalid" (fraction of samples that are not finite), "std" (standard deviation in dB), and "median"
+    '''
+    Sv_data = np.asarray(Sv_data, dtype=float)
+    finite = Sv_data[np.isfinite(Sv_data)]
+    if len(finite) == 0:
+        return {"invalid": 1.0, "std": math.nan, "median": math.nan}
+    return {"invalid": 1 - len(finite)/Sv_data.size, "std": float(np.std(finite)), "median": float(np.median(finite))}
+
+def policy_subset_maker(segment_dic, raw_files, transducer_offset, policy = None, sv_cache = None, cast = ""):
+    '''
+    policy_subset_maker: non-interactive version of interactive_subset_maker - subsets are placed and frequencies are removed by
+                         the rules in a policy dictionary rather than by a user, and anything the rules could not fix is flagged
+    Inputs: segment_dic (segment dictionary) - segment dictionary after running create_segments_dic or interactive_segment_maker,
+                                               or a segment table (see CTD_EK_segments.py)
+            raw_files (list of string) - list of filenames of raw files that correspond to CTD profile in segment_dic
+            transducer_offset (double) - offset of transducer from water surface in meters
+            policy (dictionary) - see default_subset_policy - default_subset_policy() is used if None
+            sv_cache (SvCache object) - optional cache of Sv data so .raw files are not decoded again - see raw_files_to_Sv
+            cast (integer or string) - cast number, only used to label the manifest entries
+    Outputs: (1) nested dictionary for each usable segment with points within defined subset for each good frequency - see
+                 subset_segments_Sv function comments for format
+             (2) list of manifest dictionaries, one per subset, with keys "cast", "depth", "box" (start/end time and min/max depth),
+                 "clamped" (list of "near_field"/"seabed" if the box was moved), "seabed" (shallowest seabed depth in the time window
+                 or None), "quality" (subset_quality of each frequency), "removed" (frequencies dropped and why), "flags" (reasons
+                 the subset needs to be looked at), and "review" (True if there are any flags)
+    Note: Sv is calculated once per frequency for the cast - unlike interactive_subset_maker, no .raw files are read again. If
+          policy "memory_mb" is set, the cast is decoded in chunks (see stream_boxes_Sv), the seabed is found in each chunk, and
+          boxes are clamped to the seabed after they are cropped - the subsets are the same, but boxes dropped for being
+          too short before the seabed is known (i.e. near-field) have a "seabed" of None as they are not decoded
+    '''
+    if policy is None:
+        policy = default_subset_policy()
+    frequencies = list(policy["frequencies"])
+    reference_fq = policy["reference_fq"]
+    seabed_fq = policy.get("seabed_fq")
+    memory_mb = policy.get("memory_mb")
+    dtype = np.dtype(policy.get("dtype", "float64"))
+    top = transducer_offset + policy["near_field"] # shallowest usable depth
+    seabed_lines = [] # (ping times, seabed depths) of the cast, or of each chunk when streaming
+
+    def find_seabed(Sv_dic):
+        with trace.span("detect_seabed", cast=cast, frequency=seabed_fq):
+            seabed_Sv = Sv_dic[seabed_fq][0]
+            seabed_lines.append((np.asarray(seabed_Sv.ping_time), detect_seabed(seabed_Sv, policy["seabed_threshold"], top)))
+
+    def clamp_seabed(entry, box_time, d1):
+        # moves the bottom of a box above the shallowest seabed in its time window
+        if len(seabed_lines) == 0:
+            return d1
+        seabed_times = np.concatenate([line[0] for line in seabed_lines])
+        seabed = np.concatenate([line[1] for line in seabed_lines])
+        in_window = (seabed_times >= box_time[0]) & (seabed_times <= box_time[1]) & np.isfinite(seabed)
+        if in_window.any():
+            entry["seabed"] = float(np.min(seabed[in_window]))
+            if d1 > entry["seabed"] - policy["seabed_margin"]:
+                d1 = entry["seabed"] - policy["seabed_margin"]
+                entry["clamped"].append("seabed")
+        return d1
+
+    if memory_mb is None:
+        with trace.span("raw_files_to_Sv", cast=cast):
+            Sv_dic = raw_files_to_Sv(raw_files, list(dict.fromkeys([reference_fq] + frequencies + ([seabed_fq] if seabed_fq else []))),
+                                     transducer_offset, sv_cache, dtype=dtype)
+        if seabed_fq:
+            find_seabed(Sv_dic)
+
+    # clamp boxes so they stay below the near-field and above the seabed
+    boxes = {}
+    manifest = {}
+    for name, (box_time, box_depth) in segment_boxes(segment_dic, policy["toffsets"], policy["doffsets"]).items():
+        entry = {"cast": cast, "depth": name, "clamped": [], "seabed": None, "quality": {}, "removed": {}, "flags": []}
+        d0, d1 = box_depth
+        if d0 < top:
+            d0 = top
+            entry["clamped"].append("near_field")
+        if memory_mb is None:
+            d1 = clamp_seabed(entry, box_time, d1)
+        entry["box"] = {"time": np.datetime_as_string(np.array(box_time, dtype="datetime64[ms]")).tolist(), "depth": [d0, d1]}
+        if d1 - d0 < policy["min_height"]:
+            entry["flags"].append("box shorter than " + str(policy["min_height"]) + "m after clamping - not subset")
+        else:
+            boxes[name] = (box_time, (d0, d1))
+        manifest[name] = entry
+
+    if memory_mb is None:
+        with trace.span("crop_boxes_Sv", cast=cast):
+            subset_dic = crop_boxes_Sv(Sv_dic, boxes, frequencies, reference_fq)
+    else:
+        subset_dic = {}
+        streamed = set()
+        with trace.span("stream_boxes_Sv", cast=cast, memory_mb=memory_mb):
+            for name, box_Sv in stream_boxes_Sv(raw_files, boxes, transducer_offset, frequencies, reference_fq, memory_mb,
+                                                read_frequencies=[seabed_fq] if seabed_fq else [],
+                                                chunk_function=find_seabed if seabed_fq else None, dtype=dtype):
+                # every chunk of the box has been searched for the seabed, so the box can be clamped now
+                streamed.add(name)
+                entry = manifest[name]
+                box_time, (d0, d1) = boxes[name]
+                d1 = clamp_seabed(entry, box_time, d1)
+                entry["box"]["depth"] = [d0, d1]
+                if d1 - d0 < policy["min_height"]:
+                    entry["flags"].append("box shorter than " + str(policy["min_height"]) + "m after clamping - not subset")
+                    continue
+                depths = np.asarray(next(iter(box_Sv.values())).depth) # every frequency is on the reference samples
+                bottom = int(np.argmin(np.abs(depths - d1)))
+                subset_dic[name] = {fq: crop_Sv(Sv, [0, len(Sv.ping_time) - 1], [0, bottom]) for fq, Sv in box_Sv.items()}
+        for name in boxes:
+            if name not in streamed: # i.e. the box is in a gap between .raw files
+                manifest[name]["flags"].append("no pings in box - not subset")
+        subset_dic = {name: subset_dic[name] for name in boxes if name in subset_dic} # same order as the boxes
+
+    # remove frequencies that fail their quality thresholds
+    for name in subset_dic:
+        entry = manifest[name]
+        for fq in frequencies:
+            thresholds = policy["quality"].get(fq, policy["quality"]["default"])
+            quality = subset_quality(subset_dic[name][str(fq)].data)
+            reasons = []
+            if quality["invalid"] > thresholds["max_invalid"]:
+                reasons.append("invalid")
+            if not quality["std"] <= thresholds["max_std"]:
+                reasons.append("std")
+            if not thresholds["Sv_range"][0] <= quality["median"] <= thresholds["Sv_range"][1]:
+                reasons.append("median")
+            entry["quality"][str(fq)] = quality
+            if len(reasons) != 0:
+                subset_dic[name].pop(str(fq))
+                entry["removed"][str(fq)] = reasons
+        if len(subset_dic[name]) < policy["min_frequencies"]:
+            entry["flags"].append("only " + str(len(subset_dic[name])) + " good frequencies")
+    subset_dic = {name: subset_dic[name] for name in subset_dic if len(subset_dic[name]) != 0}
+
+    for entry in manifest.values():
+        entry["review"] = len(entry["flags"]) != 0
+    return subset_dic, list(manifest.values())
+
+def policy_subset_casts(segment_dics, raw_files_dic, transducer_offset, policy = None, manifest_file = "", sv_cache = None,
+                        processes = None):
+    '''
+    policy_subset_casts: runs policy_subset_maker for many casts, one cast per worker process, and saves a review manifest so only
+                         flagged subsets need to be looked at
+    Inputs: segment_dics (dictionary) - cast numbers as keys and segment dictionaries as values (see auto_segment_casts)
+            raw_files_dic (dictionary) - cast numbers as keys and lists of .raw filenames (with paths) as values
+            transducer_offset (double) - offset of transducer from water surface in meters
+            policy (dictionary) - see default_subset_policy - default_subset_policy() is used if None
+            manifest_file (string) - optional path and filename to save the .json review manifest to
+            sv_cache (SvCache object) - optional cache of Sv data so .raw files are not decoded again - see raw_files_to_Sv
+            processes (integer) - number of worker processes - defaults to the number of CPUs
+    Outputs: (1) dictionary with cast numbers as keys and subset dictionaries as values (see policy_subset_maker)
+             (2) review manifest dictionary - "policy" (the policy used), "subsets" (every manifest entry of every cast - see
+                 policy_subset_maker), and "review" ([cast, depth] of each flagged subset)
+    Note: if the script calling this is run on macOS or Windows, call it under if __name__ == "__main__":
+    '''
+    if policy is None:
+        policy = default_subset_policy()
+    casts = [cast for cast in segment_dics if cast in raw_files_dic]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        results = list(pool.map(policy_subset_maker, [segment_dics[cast] for cast in casts], [raw_files_dic[cast] for cast in casts],
+                                [transducer_offset]*len(casts), [policy]*len(casts), [sv_cache]*len(casts), casts))
+    subset_dics = {cast: result[0] for cast, result in zip(casts, results)}
+    entries = [entry for result in results for entry in result[1]]
+    manifest = {"policy": {key: (value if key != "quality" else {str(fq): value[fq] for fq in value}) for key, value in policy.items()},
+                "subsets": entries, "review": [[entry["cast"], entry["depth"]] for entry in entries if entry["review"]]}
+    print(str(len(manifest["review"])) + " of " + str(len(entries)) + " subsets flagged for review")
+
+    if len(manifest_file) != 0:
+        with open(manifest_file, 'w') as outfile:
+            json.dump(manifest, outfile, indent=1)
+    return subset_dics, manifest
+
+
+def MFI_weights(f, delta = 40):
+    '''
+    MFI_weights: precomputes the frequency pairs and their weights used in the MFI calculation
+    Inputs: f (integer list) - sorted frequencies in kHz
+            delta (integer) - see calc_MFI
+    Outputs: (1) pair_idx (two integer numpy arrays) - indices into f of the first and second frequency of every pair - pairs
+                 are in the same order as itertools.combinations(f, 2)
+             (2) dist (float numpy array) - distance weight of each pair
+             (3) f_inv (float numpy array) - inverse frequency of each frequency in f
+    '''
+    pair_idx = np.triu_indices(len(f), k=1)
+    dist = np.array([1-math.exp((-1*abs(f[i]-f[j]))/delta) for i, j in zip(*pair_idx)]) # distance calculation
+    f_inv = np.array([1/i for i in f]) # inverse freqency calues
+    return pair_idx, dist, f_inv
+
+def MFI_kernel(linear_stack, sizes, pair_idx, dist, f_inv, global_norm = False):
+    '''
+    MFI_kernel: calculates MFI for many subsets at once
+    Inputs: linear_stack (2D numpy array) - linear Sv values (10**(Sv/10)) with one row per frequency (sorted by frequency) and
+                                            the flattened values of every subset one after the other along the columns - it is
+                                            changed (normalized in place)
+            sizes (integer list) - number of points (columns) in each subset - normalization is done seperately for each subset
+            pair_idx, dist, f_inv - frequency pairs and weights from MFI_weights
+            global_norm (boolean) - see calc_MFI
+    Output: 1D numpy array of MFI values with the same columns (and type, i.e. float32) as linear_stack
+    '''
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(int)
+    dist, f_inv = dist.astype(linear_stack.dtype), f_inv.astype(linear_stack.dtype) # weights don't promote float32 data to float64
+    norms = linear_stack
+
+    # minimum and maximum sv value per each freqencys' sv data in each subset - NaN (i.e. pings with no match in align_Sv) is
+    # skipped so it only makes its own cells NaN, not the whole subset
+    max_vals = np.fmax.reduceat(norms, starts, axis=1)
+    min_vals = np.fmin.reduceat(norms, starts, axis=1)
+    if global_norm:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning) # a frequency that is NaN in every subset stays NaN
+            max_vals = np.broadcast_to(np.nanmax(max_vals, axis=0), max_vals.shape)
+            min_vals = np.broadcast_to(np.nanmin(min_vals, axis=0), min_vals.shape)
+    # (sV(fi)-min(sV(f)))/(max(sV(f)) -min(sV(f) normalization equation as confirmed by Berger and Trenkel
+    for k, (start, size) in enumerate(zip(starts, sizes)):
+        subset_norms = norms[:, start:start+size]
+        subset_norms -= min_vals[:, k:k+1]
+        subset_norms /= (max_vals[:, k:k+1] - min_vals[:, k:k+1])
+
+    # every frequency pair at once - operations are in the same order as the pair by pair calculation so results match exactly
+    i, j = pair_idx
+    x = norms[i]
+    x *= norms[j]
+    x *= f_inv[i][:, np.newaxis]
+    x *= f_inv[j][:, np.newaxis]
+    b = np.sum(x, axis=0)
+    x *= dist[:, np.newaxis]
+    a = np.sum(x, axis=0)
+    a /= b
+    a -= 0.4
+    a /= 0.6
+    return a
+
+def calc_MFI_batch(Sv_data_dics, delta = 40, bad_fq = [], global_norm = False, dtype = np.float64):
+    '''
+    calc_MFI_batch: calculates MFI for many subsets (i.e. every cast and depth of a cruise) in one call - subsets using the same
+                    frequencies are stacked together and calculated with one call to MFI_kernel
+    Inputs: Sv_data_dics (dictionary) - any keys (i.e. (cast, depth) tuples) with Sv data object dictionaries as values (see calc_MFI)
+                                        - subsets can all be different sizes
+            delta, bad_fq, global_norm, dtype - see calc_MFI
+    Output: dictionary with the same keys as Sv_data_dics and MFI processed data objects as values (see calc_MFI)
+    '''
+    MFI_dic = {}
+    groups = {} # subsets grouped by the frequencies used
+    for key in Sv_data_dics:
+        MFI_obj = processed_data.processed_data("None", math.nan, "MFI")
+        MFI_dic[key] = MFI_obj
+
+        f=list(Sv_data_dics[key].keys()) # freqencies of Sv data availible
+        for b in bad_fq:
+            try: f.remove(str(b))
+            except: print(str(b) + " was not in frequency list and can't be removed")
+        f = [int(int(i)/1000) for i in f]
+        f.sort()
+
+        if len(f) < 3:
+            print("MFI determination is not possible at " + str(key) + ", too few frequencies.")
+            MFI_obj.data = None # set data object to None
+            MFI_obj.ping_time = None
+            MFI_obj.n_pings = math.nan
+        else:
+            groups.setdefault(tuple(f), []).append(key)
+            # MFI has the same pings and depths as the lowest frequency Sv data
+            sv_data = Sv_data_dics[key][str(f[0]*1000)]
+            MFI_obj.n_pings = sv_data.n_pings
+            MFI_obj.ping_time = sv_data.ping_time
+            MFI_obj.depth = sv_data.depth
+
+    for f, keys in groups.items():
+        pair_idx, dist, f_inv = MFI_weights(f, delta)
+        shapes = [np.shape(Sv_data_dics[key][str(f[0]*1000)].data) for key in keys]
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        # linear values of every subset are put straight into the stack - DualSv subsets copy their cached values in
+        linear_stack = np.empty((len(f), sum(sizes)), dtype=dtype)
+        for row, i in enumerate(f):
+            for key, start, size in zip(keys, np.cumsum([0] + sizes[:-1]), sizes):
+                dual_sv.linear_values(Sv_data_dics[key][str(i*1000)], dtype, linear_stack[row, start:start+size])
+        with trace.span("MFI_kernel", subsets=len(keys), cells=sum(sizes)):
+            MFI_data = MFI_kernel(linear_stack, sizes, pair_idx, dist, f_inv, global_norm)
+        for key, shape, start, size in zip(keys, shapes, np.cumsum([0] + sizes[:-1]), sizes):
+            MFI_dic[key].data = MFI_data[start:start+size].reshape(shape)
+    return MFI_dic
+
+def calc_MFI(Sv_data_dic, depth = math.nan, delta = 40, bad_fq = [], global_norm = False, dtype = np.float64):
     '''
     calc_MFI: creates processed data object with MFI classification from a dictionary of Sv data with frequencies as keys
     Inputs: Sv_data_dic (Sv data object dictionary) - dictionary with freqencies as keys and Sv processed data objects as values
-                                                    - can be created with subset_segments_Sv()
+                                                    - can be created with subset_segments_Sv() - wrap the Sv objects in DualSv
+                                                    (see CTD_EK_sv.dual_subset) if MFI is calculated more than once, so they are
+                                                    only linearized once
             depth (string) - depth of sample
             delta (integer) - parameter needed for MFI calculation - see Trenkel, Verena M., and Laurent Berger. "A fisheries acoustic 
                               multi-frequency indicator to inform on large scale spatial patterns of aquatic pelagic ecosystems."
             local_norm (boolean) - calculating MFI requires normalizing the Sv data by maximum value - if True each frequency is maximized
                                    by individual maximum rather than global (between all frequencies) maximum
             bad_fq (integer list) - list of freqencies to NOT use in MFI calculation (i.e. 200000)
+            dtype (numpy dtype) - type Sv, the linear and normalized values, and MFI are calculated in - np.float32 halves the
+                                  memory and is within about 1E-6 of float64 MFI (see tests/precision_test.py)
     Output: MFI processed data object where the data attribute is the MFI calculation, while the ping_time, n_pings, and depth are the same
             as in input Sv objects
+    Note: to calculate MFI for many subsets at once use calc_MFI_batch
     '''
-    MFI_obj = processed_data.processed_data("None", math.nan, "MFI")
-
-    f=list(Sv_data_dic.keys()) # freqencies of Sv data availible
-    for b in bad_fq:
-        try: f.remove(str(b))
-        except: print(str(b) + " was not in frequency list and can't be removed")
-    
-    f = [int(int(i)/1000) for i in f]
-    f.sort()
-    f_inv = {i: 1/i for i in f} # inverse freqency calues
-    nf = len(f)
-
-    if nf < 3:
-        print("MFI determination is not possible at " + depth + "m, too few frequencies.")
-        MFI_obj.data = None # set data object to None
-        MFI_obj.ping_time = None
-        MFI_obj.n_pings = math.nan
-    else: 
-        f_comb = list(combinations(f, 2)) # combinations of frequencies
-        dist_dic = {}
-        for comb in f_comb:
-            dist_dic[comb] = 1-math.exp((-1*abs(comb[0]-comb[1]))/delta) # distance calculation
-
-        sv_data_dic={i: None for i in f} # linearize Sv data
-        for i in f:
-            if Sv_data_dic[str(i*1000)] is not None:
-                sv_data_dic[i] = copy.deepcopy(Sv_data_dic[str(i*1000)])
-                sv_data_dic[i].data = 10**(sv_data_dic[i].data/10)
-    
-        max_vals = np.array([np.amax(sv.data) for sv in sv_data_dic.values()]) # maximum sv value per each freqencys' sv data
-        min_vals = np.array([np.amin(sv.data) for sv in sv_data_dic.values()]) # minimum sv value per each freqencys' sv data
-        if global_norm: 
-            max_vals = np.full(max_vals.shape, np.max(max_vals))
-            min_vals = np.full(min_vals.shape, np.min(min_vals))
-        
-        Norms={i: None for i in f} # normalized sv data for each frequency
-        for i in range(len(f)):
-            norm_sv = copy.deepcopy(sv_data_dic[f[i]])
-            # (sV(fi)-min(sV(f)))/(max(sV(f)) -min(sV(f) normalization equation as confirmed by Berger and Trenkel
-            norm_sv.data = ((sv_data_dic[f[i]].data - min_vals[i])/(max_vals[i] - min_vals[i])).astype(float)
-            Norms[f[i]] = norm_sv
-
-        # MFI calculatin
-        a=[]
-        b=[]
-        for fq_pair in dist_dic:
-            f0 = fq_pair[0]
-            f1 = fq_pair[1]
-            if Norms[f0] is not None and Norms[f1] is not None:
-                x = Norms[f0].data * Norms[f1].data * f_inv[f0] * f_inv[f1]
-                a.append(dist_dic[fq_pair] * x)
-                b.append(x)
-        MFI_data = ((sum(a)/sum(b))-0.4)/0.6 
-
-        # Fill in MFI proccessed data object since MFI can be determined
-        MFI_obj.data = MFI_data
-        sv_data = sv_data_dic[f[0]]
-        MFI_obj.n_pings = sv_data.n_pings
-        MFI_obj.ping_time = sv_data.ping_time
-        MFI_obj.depth = sv_data.depth
-    return MFI_obj
+    return calc_MFI_batch({str(depth) + "m": Sv_data_dic}, delta, bad_fq, global_norm, dtype)[str(depth) + "m"]
 
 def processed_data_from_dic(data, bounds_dic, type = "Sv"):
     '''
@@ -803,40 +2042,135 @@ def processed_data_from_dic(data, bounds_dic, type = "Sv"):
     obj = processed_data.processed_data("None", math.nan, type) # pyEcholab processed data object
     obj.data = np.array(data)
     pings = bounds_dic["ping_time"]
-    obj.ping_time = np.array([np.datetime64(x) for x in pings])
+    obj.ping_time = np.array(pings, dtype="datetime64") # parses all ping time strings at once
     obj.n_pings = len(pings)
     obj.depth = np.array(bounds_dic["depth"])
     return obj
 
-def mask_mfi(mfi, Sv, ranges):
+def mask_mfi(mfi, Sv, ranges, dtype = np.float64):
     '''
     mask_mfi: takes a MFI data array, and a Sv data array and applys a mask where the MFI data is in the range
               and applies the mask to the Sv data
     Inputs: mfi (2D float array) - MFI data array
-            Sv (2D floar array) - Sv data array of the same size as mfi
+            Sv (2D floar array or DualSv) - Sv data array of the same size as mfi - or a DualSv (see CTD_EK_sv.py), in which case
+                                            a DualSv is returned with the linear values of the mask taken from the linear values
+                                            of Sv, ready for calc_ABC
             range (float list) - two item list specifying the upper and lower limits of the range of values that
                                  denote desirable areas of the Sv data
-    Outputs: outputs a 2D float array of the Sv data with a mfi mask applied
+            dtype (numpy dtype) - type of the masked Sv array
+    Outputs: outputs a 2D float array of the Sv data with a mfi mask applied (a DualSv copy of Sv with this data if Sv is a DualSv)
     '''
-    mfi = np.array(mfi)
+    Sv_obj = Sv if isinstance(Sv, dual_sv.DualSv) else None
+    if Sv_obj is not None:
+        Sv = Sv_obj.data
+    mfi = np.asarray(mfi)
     mask = np.full(mfi.shape, False)
     for r in ranges:
         r_mask = np.where((r[0] < mfi) & (mfi < r[1]), True, False) # creates boolean mask within range
         mask = mask | r_mask # combine boolean masks - using logical OR means True if anything within any of the ranges is True overall
-    mask = np.array(mask, dtype=int) # force boolean mask into binary mask
-    mask_Sv = np.multiply(mask, np.array(Sv)) # applies mask
+    mask_Sv = np.multiply(mask, np.asarray(Sv, dtype=dtype)) # applies mask - a boolean mask keeps the type of Sv
     mask_Sv[mask_Sv == 0] = -999 # -999 is basically 0 in log
-    return mask_Sv
-
-def calc_ABC(Sv_obj):
+    if Sv_obj is None:
+        return mask_Sv
+    masked = copy.copy(Sv_obj)
+    masked.data = mask_Sv
+    removed = dual_sv.linear_values(np.array([-999], dtype=mask_Sv.dtype), mask_Sv.dtype)[0] # same as linearizing mask_Sv
+    masked.set_linear(np.where(mask_Sv == -999, removed, Sv_obj.linear(mask_Sv.dtype)))
+    return masked
+
+def calc_ABC(Sv_obj, dtype = np.float64):
     '''
     calc_ABC: Calculates the Area Backscattering Coefficent (ABC) for a Sv data object
-    Inputs: Sv_obj (pyEcholab processed data object) - Sv processed data object with data and depth attributes
+    Inputs: Sv_obj (pyEcholab processed data object) - Sv processed data object with data and depth attributes - if it is a
+                                                       DualSv (i.e. from mask_mfi) its cached linear values are used
+            dtype (numpy dtype) - type Sv is linearized in - the sum is always float64
     Outputs: returns ABC value (float) for the Sv data provided 
     '''
-    Sv_data = np.array(Sv_obj.data)
-    n_points = Sv_data.size
-    sv_mean = np.sum(10**(Sv_data/10))/n_points # using all data points
+    linear = dual_sv.linear_values(Sv_obj, dtype)
+    n_points = linear.size
+    sv_mean = np.sum(linear, dtype=np.float64)/n_points # using all data points
     depths = np.array(Sv_obj.depth)
     bin_thickness = (np.max(depths) - np.min(depths))/len(depths) # does not allow for variable ping depths
     return sv_mean * bin_thickness # return ABC value
+
+# MFI ranges of each class (see README) - values on the edge of a range are not in the class, same as mask_mfi
+MFI_CLASSES = {"swimbladder_fish": [[0, 0.4]], "small_bubbles": [[0.4, 0.6]], "zooplankton": [[0.6, 0.8]],
+               "non_swimbladder_fish": [[0.8, 1]], "all_fish": [[0, 0.4], [0.8, 1]]}
+
+def class_ABC_table(subsets, classes = MFI_CLASSES, dtype = np.float64):
+    '''
+    class_ABC_table: calculates ABC, number of cells, and mean Sv of every MFI class for many subsets in one pass - Sv is
+                     linearized once and MFI is binned once for all classes, instead of running mask_mfi and calc_ABC per class
+    Inputs: subsets (dictionary) - (cast, depth) tuples as keys and (MFI, Sv) tuples as values - MFI can be an MFI processed data
+                                   object or array (see calc_MFI) and Sv is an Sv processed data object of the same shape (i.e.
+                                   38 kHz) - subsets with MFI of None are skipped
+            classes (dictionary) - class names as keys and lists of [lower, upper] MFI ranges as values - see MFI_CLASSES
+            dtype (numpy dtype) - type Sv is linearized in - sums are always float64 (see calc_ABC)
+    Output: table dictionary - one row per subset and class with columns (lists) "cast", "depth", "class", "abc", "n_cells",
+            and "mean_Sv" (mean Sv of the class cells in dB, NaN if there are none)
+    Note: "abc" is the same value as calc_ABC(Sv with data = mask_mfi(MFI, Sv, class ranges)) - the mean is over every cell of
+          the subset and, like calc_ABC, it is NaN if any Sv value of the subset is NaN
+    '''
+    class_names = list(classes.keys())
+    edges = np.unique(np.array([r for name in class_names for r in classes[name]], dtype=float).ravel())
+    n_edges = len(edges)
+    # bins are below the edges (0), each edge (odd), between and above the edges (even), plus one bin for NaN MFI - an edge of
+    # one class can be inside a range of another, so MFI equal to an edge has its own bin
+    n_bins = 2*n_edges + 2
+    membership = np.zeros((n_bins, len(class_names)))
+    for j, name in enumerate(class_names):
+        for lower, upper in classes[name]: # ranges leave out their limits, same as mask_mfi
+            membership[2:2*n_edges:2, j] += (edges[:-1] >= lower) & (edges[1:] <= upper)
+            membership[1:2*n_edges:2, j] += (edges > lower) & (edges < upper)
+    membership = np.minimum(membership, 1) # overlapping ranges of one class count each cell once
+
+    table = {"cast": [], "depth": [], "class": [], "abc": [], "n_cells": [], "mean_Sv": []}
+    keys = [key for key in subsets if getattr(subsets[key][0], "data", subsets[key][0]) is not None]
+    if len(keys) == 0:
+        return table
+    bins, linear, finite, n_points, thickness = [], [], [], [], []
+    for i, key in enumerate(keys):
+        mfi, Sv_obj = subsets[key]
+        mfi = np.ravel(np.asarray(getattr(mfi, "data", mfi), dtype=float))
+        Sv_linear = np.ravel(dual_sv.linear_values(Sv_obj, dtype)) # cached values if Sv_obj is a DualSv
+        mfi_bins = 2*np.searchsorted(edges, mfi) + np.isin(mfi, edges) # searchsorted is the number of edges below the value
+        mfi_bins[np.isnan(mfi)] = n_bins - 1
+        bins.append(i*n_bins + mfi_bins)
+        is_finite = ~np.isnan(Sv_linear)
+        linear.append(np.where(is_finite, Sv_linear, 0)) # Sv is linearized once for every class
+        finite.append(is_finite)
+        n_points.append(Sv_linear.size)
+        depths = np.array(Sv_obj.depth)
+        thickness.append((np.max(depths) - np.min(depths))/len(depths)) # same as calc_ABC
+
+    # one bincount per measure for every subset and MFI bin, then bins are summed into classes
+    with trace.span("class_ABC_bincount", subsets=len(keys), classes=len(class_names)):
+        bins, finite = np.concatenate(bins), np.concatenate(finite)
+        n_all = len(keys)*n_bins
+        sums = np.bincount(bins, weights=np.concatenate(linear), minlength=n_all).reshape(len(keys), n_bins) @ membership
+        counts = np.bincount(bins, minlength=n_all).reshape(len(keys), n_bins) @ membership
+        finite_counts = np.bincount(bins, weights=finite, minlength=n_all).reshape(len(keys), n_bins) @ membership
+        all_finite = np.bincount(bins // n_bins, weights=~finite, minlength=len(keys)) == 0
+    abc = sums / np.array(n_points)[:, np.newaxis] * np.array(thickness)[:, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_Sv = 10*np.log10(sums/finite_counts)
+
+    for i, key in enumerate(keys):
+        for j, name in enumerate(class_names):
+            table["cast"].append(key[0])
+            table["depth"].append(key[1])
+            table["class"].append(name)
+            table["abc"].append(float(abc[i, j]) if all_finite[i] else math.nan)
+            table["n_cells"].append(int(counts[i, j]))
+            table["mean_Sv"].append(float(mean_Sv[i, j]) if finite_counts[i, j] != 0 else math.nan)
+    return table
+
+def table_to_csv(table, outfile_path):
+    '''
+    table_to_csv: saves a table dictionary (i.e. from class_ABC_table) as a .csv file with a header line of the column names
+    '''
+    columns = list(table.keys())
+    with open(outfile_path, 'w') as outfile:
+        outfile.write(",".join(columns) + "\n")
+        for row in zip(*[table[column] for column in columns]):
+            outfile.write(",".join(str(value) for value in row) + "\n")
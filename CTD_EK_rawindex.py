@@ -0,0 +1,176 @@
+'''
+Ping time index for .raw files so only the part of a .raw file that is needed has to be decoded by pyEcholab. A .raw file
+is a list of datagrams, each with its length, type (i.e. RAW3 for EK80 pings), and time. index_raw reads only the headers of
+the datagrams (not the pings) and saves one row per datagram in a sidecar file next to the .raw file (file.raw.index.npz):
+
+    offset (int64) - byte offset of the datagram in the .raw file
+    length (int32) - length of the datagram in bytes (not counting the length fields on either side of it)
+    kind (4 bytes) - datagram type, except XML0 datagrams are marked by their contents (Conf, Envi, Para, ...)
+    time (int64) - time of the datagram as milliseconds since 1970-01-01
+    channel (int16) - index of the channel in the "channels" array for ping datagrams, -1 for everything else
+
+read_raw_window uses the index to write a smaller .raw file for each file with the datagrams describing the echosounder
+(configuration, environment, filters) and only the datagrams between a start and end time, and reads those with EK80, so
+reading a 10 minute window costs about the same no matter how many hours of data are in the .raw files.
+
+Hollings Scholarship Research Project
+'''
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from echolab2.instruments import EK80
+
+INDEX_VERSION = 1 # bump if the index format changes so old sidecar files are rebuilt
+INDEX_DTYPE = np.dtype([("offset", np.int64), ("length", np.int32), ("kind", "S4"), ("time", np.int64), ("channel", np.int16)])
+# datagrams that belong to one ping - every other datagram (configuration, environment, filters...) is needed to decode any ping
+PING_KINDS = [b"RAW0", b"RAW3", b"RAW4", b"Para", b"NME0", b"TAG0", b"MRU0", b"MRU1", b"BOT0", b"DEP0"]
+NT_EPOCH_MS = 11644473600000 # milliseconds between 1601-01-01 (start of .raw file times) and 1970-01-01
+
+
+def index_file_name(raw_file, index_path = ""):
+    '''
+    index_file_name: path and filename of the sidecar index of a .raw file - next to the .raw file unless index_path is given
+    '''
+    if len(index_path) != 0:
+        return os.path.normpath(index_path + "/" + os.path.basename(raw_file) + ".index.npz")
+    return raw_file + ".index.npz"
+
+def index_raw(raw_file, index_path = ""):
+    '''
+    index_raw: reads the header of every datagram in a .raw file and saves the index as a sidecar file
+    Inputs: raw_file (string) - path and filename of the .raw file
+            index_path (string) - optional folder to save the index in - saved next to the .raw file if not given
+    Output: index dictionary with "datagrams" (structured numpy array, see top of file) and "channels" (array of channel names)
+    '''
+    stat = os.stat(raw_file)
+    rows = []
+    channels = []
+    with open(raw_file, 'rb') as raw:
+        offset = 0
+        while offset + 16 <= stat.st_size:
+            raw.seek(offset)
+            header = raw.read(16) # length, type, low and high parts of the time
+            length = int(np.frombuffer(header, "<i4", 1, 0)[0])
+            if length < 12 or offset + length + 8 > stat.st_size: # last datagram was cut off (i.e. recording stopped)
+                break
+            kind = header[4:8]
+            ticks = int(np.frombuffer(header, "<u8", 1, 8)[0]) # 100 nanosecond steps since 1601-01-01
+            channel = -1
+            if kind == b"XML0":
+                kind = xml_kind(raw.read(256))
+            elif kind in [b"RAW3", b"RAW4"]:
+                name = raw.read(128).split(b"\x00")[0].decode(errors="replace")
+                channel = channels.index(name) if name in channels else len(channels)
+                if channel == len(channels):
+                    channels.append(name)
+            elif kind == b"RAW0":
+                name = "channel " + str(int(np.frombuffer(raw.read(2), "<i2")[0]))
+                channel = channels.index(name) if name in channels else len(channels)
+                if channel == len(channels):
+                    channels.append(name)
+            rows.append((offset, length, kind, ticks // 10000 - NT_EPOCH_MS, channel))
+            offset += length + 8 # length fields before and after the datagram
+
+    index = {"datagrams": np.array(rows, dtype=INDEX_DTYPE), "channels": np.array(channels, dtype=str)}
+    np.savez(index_file_name(raw_file, index_path), version=INDEX_VERSION, size=stat.st_size, mtime=stat.st_mtime_ns, **index)
+    return index
+
+def xml_kind(xml_start):
+    '''
+    xml_kind: first 4 letters of the root element of an XML0 datagram (i.e. b"Conf" for Configuration) from its first bytes
+    '''
+    for tag in xml_start.split(b"<")[1:]:
+        if not tag.startswith((b"?", b"!")):
+            return tag[:4]
+    return b"XML0"
+
+def load_raw_index(raw_file, index_path = ""):
+    '''
+    load_raw_index: loads the sidecar index of a .raw file - the index is (re)built if it does not exist or the .raw file changed
+    Inputs: raw_file (string) - path and filename of the .raw file
+            index_path (string) - optional folder the index is saved in (see index_raw)
+    Output: index dictionary (see index_raw)
+    '''
+    stat = os.stat(raw_file)
+    try:
+        with np.load(index_file_name(raw_file, index_path)) as saved:
+            if int(saved["version"]) == INDEX_VERSION and int(saved["size"]) == stat.st_size and int(saved["mtime"]) == stat.st_mtime_ns:
+                return {"datagrams": saved["datagrams"], "channels": saved["channels"]}
+    except (OSError, KeyError, ValueError):
+        pass
+    return index_raw(raw_file, index_path)
+
+def raw_ping_times(raw_files, index_path = ""):
+    '''
+    raw_ping_times: times of the first and last ping of each .raw file from the index
+    Inputs: raw_files (string list) - paths and filenames of .raw files
+            index_path (string) - optional folder the indexes are saved in (see index_raw)
+    Output: list of (start time, end time) numpy datetime64 tuples - (NaT, NaT) for files without pings
+    '''
+    bounds = []
+    for raw_file in raw_files:
+        datagrams = load_raw_index(raw_file, index_path)["datagrams"]
+        ping_times = datagrams["time"][datagrams["channel"] >= 0].astype("datetime64[ms]")
+        if len(ping_times) == 0:
+            bounds.append((np.datetime64("NaT", "ms"), np.datetime64("NaT", "ms")))
+        else:
+            bounds.append((ping_times.min(), ping_times.max()))
+    return bounds
+
+def window_raw_files(raw_files, start_time, end_time, out_path, index_path = ""):
+    '''
+    window_raw_files: writes a smaller copy of each .raw file that overlaps a time window - each copy has the datagrams that
+                      describe the echosounder (everything that is not part of a ping) from before the end of the window and
+                      every datagram within the window
+    Inputs: raw_files (string list) - paths and filenames of .raw files, in time order
+            start_time, end_time (numpy datetime64) - time window to keep (inclusive)
+            out_path (string) - folder to write the smaller .raw files to - they keep the names of the original files
+            index_path (string) - optional folder the indexes are saved in (see index_raw)
+    Output: list of the paths and filenames of the smaller .raw files - files with no pings within the window are left out
+    '''
+    start_ms = np.datetime64(start_time, "ms").astype(np.int64)
+    end_ms = np.datetime64(end_time, "ms").astype(np.int64)
+    window_files = []
+    for raw_file in raw_files:
+        datagrams = load_raw_index(raw_file, index_path)["datagrams"]
+        in_window = (datagrams["time"] >= start_ms) & (datagrams["time"] <= end_ms)
+        if not np.any(in_window & (datagrams["channel"] >= 0)):
+            continue
+        describes = ~np.isin(datagrams["kind"], PING_KINDS) & (datagrams["time"] <= end_ms)
+        keep = datagrams[in_window | describes] # still in file order
+
+        window_file = os.path.join(out_path, os.path.basename(raw_file))
+        with open(raw_file, 'rb') as raw, open(window_file, 'wb') as window:
+            # neighbouring datagrams are copied with one read
+            breaks = np.flatnonzero(keep["offset"][1:] != keep["offset"][:-1] + keep["length"][:-1] + 8) + 1
+            for block in np.split(keep, breaks):
+                raw.seek(int(block["offset"][0]))
+                window.write(raw.read(int(block["offset"][-1] - block["offset"][0] + block["length"][-1] + 8)))
+        window_files.append(window_file)
+    return window_files
+
+def read_raw_window(raw_files, start_time, end_time, index_path = "", frequencies = None):
+    '''
+    read_raw_window: reads only the pings between start_time and end_time from a list of .raw files with pyEcholab
+    Inputs: raw_files (string list) - paths and filenames of .raw files, in time order
+            start_time, end_time (numpy datetime64) - time window to read (inclusive)
+            index_path (string) - optional folder the indexes are saved in (see index_raw)
+            frequencies (integer list) - optional list of frequencies to read - all are read if None
+    Output: EK80 object with the pings of the window read in - same as EK80.read_raw on the whole files, but only the window -
+            None if none of the .raw files have pings in the window (i.e. a window in a gap between files)
+    '''
+    tmp_path = tempfile.mkdtemp(prefix="raw_window_")
+    try:
+        window_files = window_raw_files(raw_files, start_time, end_time, tmp_path, index_path)
+        if len(window_files) == 0:
+            return None
+        ek80 = EK80.EK80()
+        if frequencies is None:
+            ek80.read_raw(window_files)
+        else:
+            ek80.read_raw(window_files, frequencies=frequencies)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return ek80
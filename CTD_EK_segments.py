@@ -0,0 +1,139 @@
+'''
+Compact segment files - a segment table holds the CTD trace of a cast once, as arrays, and each segment as indices into it
+instead of the (time string, depth) points of a segment dictionary (see create_segments_dic). Segment tables are saved as
+.npz files holding:
+
+    time (int64) - time of each point of the CTD trace as milliseconds since 1970-01-01
+    depth (float32) - depth of each point of the CTD trace in meters
+    start, stop (int64) - index of the first point and one past the last point of each segment
+    bottle, usable (boolean) - same as the "bottle" and "usable" keys of a segment dictionary
+    mean_depth (float64) - same as the "depth" key of a segment dictionary (NaN until mark_usable_depth is run)
+
+so saving, loading, and making subsets from segments never parses a time string. load_segments also reads the .json segment
+files of interactive_segment_maker, and segment_boxes, mark_usable_depth, and plot_segments take either format.
+
+Hollings Scholarship Research Project
+'''
+
+import json
+import math
+import numpy as np
+
+TIME_UNIT = "ms" # unit of the int64 trace times
+TABLE_KEYS = ["time", "depth", "start", "stop", "bottle", "usable", "mean_depth"]
+
+
+def is_segment_table(segments):
+    '''
+    is_segment_table: True if segments is a segment table, False if it is a segment dictionary
+    '''
+    return isinstance(segments, dict) and "start" in segments and "time" in segments
+
+def segment_table(x, y, segment_arrays):
+    '''
+    segment_table: turns the segment arrays from segment_slopes into a segment table (see segments_to_dic for a segment dictionary)
+    Inputs: x (list or array of numpy64 datetime objects) - times in the CTD trace
+            y (list or array of floats) - depths of the CTD trace over time
+            segment_arrays (dictionary) - segment arrays created by segment_slopes
+    Outputs: segment table - dictionary of numpy arrays with the keys in TABLE_KEYS - "time" is datetime64[ms] and "usable" is
+             all False (see mark_usable_depth)
+    '''
+    n_segments = len(segment_arrays["start"])
+    return {"time": np.asarray(x).astype("datetime64[" + TIME_UNIT + "]"), "depth": np.asarray(y, dtype=float),
+            "start": np.asarray(segment_arrays["start"], dtype=np.int64), "stop": np.asarray(segment_arrays["stop"], dtype=np.int64),
+            "bottle": np.asarray(segment_arrays["bottle"], dtype=bool), "usable": np.zeros(n_segments, dtype=bool),
+            "mean_depth": np.full(n_segments, math.nan)}
+
+def segments_to_table(segment_dic):
+    '''
+    segments_to_table: turns a segment dictionary (i.e. from create_segments_dic or an old .json segment file) into a segment
+                       table - the time strings are parsed once, all together
+    Inputs: segment_dic (segment dictionary) - segments are taken in the order of its keys
+    Outputs: segment table with the points of every segment one after the other
+    '''
+    times, depths, lengths = [], [], []
+    for num in segment_dic:
+        points = segment_dic[num]["points"]
+        times.extend(point[0] for point in points)
+        depths.extend(point[1] for point in points)
+        lengths.append(len(points))
+    stop = np.cumsum(np.asarray(lengths, dtype=np.int64))
+    segs = list(segment_dic.values())
+    return {"time": np.array(times, dtype="datetime64[" + TIME_UNIT + "]"), "depth": np.array(depths, dtype=float),
+            "start": stop - np.asarray(lengths, dtype=np.int64), "stop": stop,
+            "bottle": np.array([bool(seg["bottle"]) for seg in segs], dtype=bool),
+            "usable": np.array([bool(seg["usable"]) for seg in segs], dtype=bool),
+            "mean_depth": np.array([seg["depth"] for seg in segs], dtype=float)}
+
+def table_to_segments(table):
+    '''
+    table_to_segments: turns a segment table into a segment dictionary - same format as create_segments_dic, for code (and .json
+                       files) that need the points of each segment
+    '''
+    x_str = np.datetime_as_string(table["time"]).tolist()
+    y_float = np.asarray(table["depth"], dtype=float).tolist()
+    segments = {}
+    for num, (start, stop) in enumerate(zip(table["start"].tolist(), table["stop"].tolist())):
+        segments[str(num)] = {"bottle": bool(table["bottle"][num]), "depth": float(table["mean_depth"][num]),
+                              "usable": bool(table["usable"][num]), "points": list(zip(x_str[start:stop], y_float[start:stop]))}
+    return segments
+
+def as_segment_dic(segments):
+    '''
+    as_segment_dic: segment dictionary of segments, which can be a segment table or a segment dictionary (returned as is)
+    '''
+    return table_to_segments(segments) if is_segment_table(segments) else segments
+
+def segment_rows(segments):
+    '''
+    segment_rows: goes through the segments of a segment table or segment dictionary in order
+    Input: segments (segment table or segment dictionary)
+    Output: generator of (segment number, bottle, usable, mean depth, times, depths) for each segment - times are a numpy
+            datetime64 array and depths a numpy float array - for a segment table they are views of its trace arrays, for a
+            segment dictionary the points are parsed (only for segments that are looked at)
+    '''
+    if is_segment_table(segments):
+        for num, (start, stop) in enumerate(zip(segments["start"].tolist(), segments["stop"].tolist())):
+            yield (str(num), bool(segments["bottle"][num]), bool(segments["usable"][num]), float(segments["mean_depth"][num]),
+                   segments["time"][start:stop], segments["depth"][start:stop])
+    else:
+        for num in segments:
+            seg = segments[num]
+            points_time, points_depth = zip(*seg["points"])
+            yield (num, seg["bottle"], seg["usable"], float(seg["depth"]), np.array(points_time, dtype="datetime64"),
+                   np.array(points_depth, dtype=float))
+
+def save_segments(outfile_path, segments, compress = True):
+    '''
+    save_segments: saves segments to a file - a .json file is saved as a segment dictionary (same as interactive_segment_maker),
+                   anything else as a segment table .npz file
+    Inputs: outfile_path (string) - path and filename to save to (numpy adds .npz if it has another extension)
+            segments (segment table or segment dictionary)
+            compress (boolean) - if True the .npz file is compressed
+    '''
+    if outfile_path.lower().endswith(".json"):
+        with open(outfile_path, 'w') as outfile:
+            json.dump(as_segment_dic(segments), outfile)
+        return
+    table = segments if is_segment_table(segments) else segments_to_table(segments)
+    save = np.savez_compressed if compress else np.savez
+    save(outfile_path, time=np.asarray(table["time"]).astype("datetime64[" + TIME_UNIT + "]").astype(np.int64),
+         depth=np.asarray(table["depth"], dtype=np.float32), start=np.asarray(table["start"], dtype=np.int64),
+         stop=np.asarray(table["stop"], dtype=np.int64), bottle=np.asarray(table["bottle"], dtype=bool),
+         usable=np.asarray(table["usable"], dtype=bool), mean_depth=np.asarray(table["mean_depth"], dtype=float))
+
+def load_segments(infile_path, as_table = True):
+    '''
+    load_segments: loads a segment file saved by save_segments or interactive_segment_maker
+    Inputs: infile_path (string) - path and filename of a .npz segment table or a .json segment dictionary
+            as_table (boolean) - if True a segment table is returned, otherwise a segment dictionary
+    Outputs: segment table or segment dictionary - "depth" of a table loaded from .npz is float32
+    '''
+    if infile_path.lower().endswith(".json"):
+        with open(infile_path, 'r') as infile:
+            segments = json.load(infile)
+        return segments_to_table(segments) if as_table else segments
+    with np.load(infile_path) as arrays:
+        table = {key: arrays[key] for key in TABLE_KEYS}
+    table["time"] = table["time"].view("datetime64[" + TIME_UNIT + "]")
+    return table if as_table else table_to_segments(table)
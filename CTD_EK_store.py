@@ -0,0 +1,201 @@
+'''
+Binary store for Sv subsets and MFI arrays - replaces the subsets.json, subset_bounds.json, and mfi.json files. Each
+cast and depth subset is saved in its own compressed .npz file at store_path/cast/depth.npz holding:
+
+    ping_time (int64) - ping times as milliseconds since 1970-01-01
+    depth (float64) - depth of each sample in meters
+    Sv_frequency (float32) - one Sv array (pings x samples) per frequency, i.e. Sv_38000
+    mfi (float32) - MFI array of the same shape, only if MFI could be calculated
+
+Arrays are only read from disk when they are accessed, so one subset (or one frequency of a subset) can be loaded
+without reading the rest of the cruise. store_to_json writes the old .json files so the R code can still be used.
+
+Hollings Scholarship Research Project
+'''
+
+import json
+import math
+import os
+import numpy as np
+from echolab2.processing import processed_data
+
+TIME_UNIT = "ms" # unit of the int64 ping times
+
+
+def store_key(value):
+    '''
+    store_key: sorting key so casts and depths (saved as strings) are ordered as numbers where possible
+    '''
+    try:
+        return (0, float(value), str(value))
+    except ValueError:
+        return (1, math.nan, str(value))
+
+def save_cast_subsets(store_path, cast, subset_dic, mfi_dic = {}, compress = True):
+    '''
+    save_cast_subsets: saves the subsets (and MFI) of one cast to the store
+    Inputs: store_path (string) - folder of the store - created if it does not exist
+            cast (integer or string) - cast number
+            subset_dic (nested dictionary) - depths as outer keys, frequencies as inner keys, and Sv objects as values - created
+                                             by subset_segments_Sv or interactive_subset_maker
+            mfi_dic (dictionary) - optional dictionary with depths as keys and MFI processed data objects (see calc_MFI), MFI
+                                   arrays, or None as values
+            compress (boolean) - if True the .npz files are compressed
+    Outputs: one .npz file per depth saved at store_path/cast/ and a depths.json file that keeps the order of the depths
+    '''
+    cast_path = os.path.join(store_path, str(cast))
+    os.makedirs(cast_path, exist_ok=True)
+    save = np.savez_compressed if compress else np.savez
+    for depth in subset_dic:
+        depth_subset = subset_dic[depth]
+        frequencies = list(depth_subset.keys())
+        first_Sv = depth_subset[frequencies[0]]
+        arrays = {"ping_time": np.asarray(first_Sv.ping_time).astype("datetime64[" + TIME_UNIT + "]").astype(np.int64),
+                  "depth": np.asarray(first_Sv.depth, dtype=float)}
+        for fq in frequencies:
+            arrays["Sv_" + str(fq)] = np.asarray(depth_subset[fq].data, dtype=np.float32)
+        mfi = mfi_dic.get(depth)
+        if mfi is not None:
+            mfi = getattr(mfi, "data", mfi) # MFI processed data object or array
+            if mfi is not None:
+                arrays["mfi"] = np.asarray(mfi, dtype=np.float32)
+        save(os.path.join(cast_path, str(depth) + ".npz"), **arrays)
+    with open(os.path.join(cast_path, "depths.json"), 'w') as outfile:
+        json.dump([str(depth) for depth in subset_dic], outfile)
+
+def store_casts(store_path):
+    '''
+    store_casts: lists what is in the store
+    Input: store_path (string) - folder of the store
+    Output: dictionary with casts (strings) as keys and lists of depths (strings) as values, in the order they were saved
+    '''
+    casts = {}
+    for cast in sorted(os.listdir(store_path), key=store_key):
+        cast_path = os.path.join(store_path, cast)
+        if not os.path.isdir(cast_path):
+            continue
+        saved = [fn[:-len(".npz")] for fn in os.listdir(cast_path) if fn.endswith(".npz")]
+        try:
+            with open(os.path.join(cast_path, "depths.json"), 'r') as infile:
+                order = [depth for depth in json.load(infile) if depth in saved]
+        except OSError:
+            order = []
+        casts[cast] = order + sorted([depth for depth in saved if depth not in order], key=store_key)
+    return casts
+
+def load_subset_arrays(store_path, cast, depth):
+    '''
+    load_subset_arrays: opens the .npz file of one subset without reading any arrays
+    Inputs: store_path (string) - folder of the store
+            cast, depth (integer or string) - cast number and depth key of the subset
+    Output: numpy NpzFile - acts like a dictionary (see top of file for keys) and reads each array when it is accessed - close it
+            when done (i.e. with load_subset_arrays(...) as arrays:)
+    '''
+    return np.load(os.path.join(store_path, str(cast), str(depth) + ".npz"))
+
+def store_frequencies(arrays):
+    '''
+    store_frequencies: list of frequencies (strings) with Sv saved in an opened subset (see load_subset_arrays)
+    '''
+    return [name[len("Sv_"):] for name in arrays.files if name.startswith("Sv_")]
+
+def arrays_to_processed_data(arrays, data, data_type, frequency = math.nan, dtype = np.float64):
+    '''
+    arrays_to_processed_data: creates a processed data object from the arrays of one subset
+    Inputs: arrays (NpzFile) - opened subset (see load_subset_arrays)
+            data (numpy array) - data for the processed data object (Sv or MFI)
+            data_type (string) - name for type of data
+            frequency (float) - frequency of the data
+            dtype (numpy dtype) - type the data is converted to (it is saved as float32)
+    Output: processed data object with attributes data, ping_time, n_pings, and depth
+    '''
+    obj = processed_data.processed_data("None", frequency, data_type) # pyEcholab processed data object
+    obj.data = np.asarray(data, dtype=dtype)
+    obj.ping_time = arrays["ping_time"].astype("datetime64[" + TIME_UNIT + "]")
+    obj.n_pings = len(obj.ping_time)
+    obj.depth = arrays["depth"]
+    return obj
+
+def load_subset(store_path, cast, depth, frequencies = None, dtype = np.float64):
+    '''
+    load_subset: loads the Sv of one subset from the store as processed data objects - only the frequencies asked for are read
+    Inputs: store_path (string) - folder of the store
+            cast, depth (integer or string) - cast number and depth key of the subset
+            frequencies (list) - optional list of frequencies to load - all saved frequencies are loaded if None
+            dtype (numpy dtype) - type the Sv data is converted to (it is saved as float32)
+    Output: dictionary with frequencies (strings) as keys and Sv processed data objects as values - same format as one depth of
+            subset_segments_Sv, so it can be passed into calc_MFI
+    '''
+    with load_subset_arrays(store_path, cast, depth) as arrays:
+        if frequencies is None:
+            frequencies = store_frequencies(arrays)
+        return {str(fq): arrays_to_processed_data(arrays, arrays["Sv_" + str(fq)], "Sv", float(fq), dtype) for fq in frequencies}
+
+def load_mfi(store_path, cast, depth, dtype = np.float64):
+    '''
+    load_mfi: loads the MFI of one subset from the store
+    Inputs: store_path (string) - folder of the store
+            cast, depth (integer or string) - cast number and depth key of the subset
+            dtype (numpy dtype) - type the MFI data is converted to (it is saved as float32)
+    Output: MFI processed data object (see calc_MFI) or None if MFI was not saved for this subset
+    '''
+    with load_subset_arrays(store_path, cast, depth) as arrays:
+        if "mfi" not in arrays.files:
+            return None
+        return arrays_to_processed_data(arrays, arrays["mfi"], "MFI", dtype=dtype)
+
+def store_to_json(store_path, outfile_path, subset_fn = "subsets.json", bounds_fn = "subset_bounds.json", mfi_fn = "mfi.json"):
+    '''
+    store_to_json: exports the store to the subsets.json, subset_bounds.json, and mfi.json files used by the R code
+    Inputs: store_path (string) - folder of the store
+            outfile_path (string) - folder to save the .json files to
+            subset_fn, bounds_fn, mfi_fn (string) - optional names of the .json files
+    Outputs: .json files saved at outfile_path with the same format as the ones written by segment_subsets_mfi.py
+    '''
+    subset_dic = {}
+    bounds_dic = {}
+    mfi_dic = {}
+    casts = store_casts(store_path)
+    for cast in casts:
+        subset_dic[cast], bounds_dic[cast], mfi_dic[cast] = {}, {}, {}
+        for depth in casts[cast]:
+            with load_subset_arrays(store_path, cast, depth) as arrays:
+                ping_time = arrays["ping_time"].astype("datetime64[" + TIME_UNIT + "]")
+                bounds_dic[cast][depth] = {"depth": arrays["depth"].tolist(), "ping_time": np.datetime_as_string(ping_time).tolist()}
+                subset_dic[cast][depth] = {fq: arrays["Sv_" + fq].astype(float).tolist() for fq in store_frequencies(arrays)}
+                mfi_dic[cast][depth] = arrays["mfi"].astype(float).tolist() if "mfi" in arrays.files else None
+
+    for fn, values in [(subset_fn, subset_dic), (bounds_fn, bounds_dic), (mfi_fn, mfi_dic)]:
+        with open(os.path.join(outfile_path, fn), 'w') as outfile:
+            json.dump(values, outfile)
+
+def store_from_json(store_path, subset_file, bounds_file, mfi_file = "", compress = True):
+    '''
+    store_from_json: converts subset (and MFI) .json files made by segment_subsets_mfi.py into the store
+    Inputs: store_path (string) - folder of the store
+            subset_file, bounds_file (string) - path and filename of the subsets.json and subset_bounds.json files
+            mfi_file (string) - optional path and filename of the mfi.json file
+            compress (boolean) - if True the .npz files are compressed
+    '''
+    with open(subset_file, 'r') as infile:
+        subset_json = json.load(infile)
+    with open(bounds_file, 'r') as infile:
+        bounds_json = json.load(infile)
+    mfi_json = {}
+    if len(mfi_file) != 0:
+        with open(mfi_file, 'r') as infile:
+            mfi_json = json.load(infile)
+
+    for cast in subset_json:
+        subset_dic = {}
+        for depth in subset_json[cast]:
+            bounds = bounds_json[cast][depth]
+            ping_time = np.array(bounds["ping_time"], dtype="datetime64") # one vectorized parse of all the ping times
+            subset_dic[depth] = {}
+            for fq in subset_json[cast][depth]:
+                Sv = processed_data.processed_data("None", float(fq), "Sv")
+                Sv.data = np.array(subset_json[cast][depth][fq])
+                Sv.ping_time = ping_time
+                Sv.depth = np.array(bounds["depth"])
+                subset_dic[depth][fq] = Sv
+        save_cast_subsets(store_path, cast, subset_dic, mfi_json.get(cast, {}), compress)
@@ -0,0 +1,148 @@
+'''
+Sv in both domains - DualSv wraps an Sv processed data object (see CTD_EK_processing.raw_to_Sv) and keeps the linear values
+of its data (sv = 10**(Sv/10)) once they have been calculated, so calc_MFI, mask_mfi, calc_ABC, and class_ABC_table don't
+calculate the same exponentials again every time they are called on the same subset:
+
+    subset = dual_subset(store.load_subset(store_path, "15", "42"))
+    mfi_local = process.calc_MFI(subset)                     # linear values calculated here
+    mfi_global = process.calc_MFI(subset, global_norm=True)  # and reused here
+
+The linear values are thrown away when the data is replaced (Sv.data = new_data). While they are kept, the data of the DualSv
+is a read-only view, so changing it in place raises an error instead of leaving the linear values out of date - call
+invalidate() first. The DualSv keeps its own copy of the Sv object, so the Sv object and array it was given are never made
+read-only - changing that array (or a crop of the DualSv after its invalidate()) still leaves the linear values out of date.
+
+Hollings Scholarship Research Project
+'''
+
+import copy
+import numpy as np
+
+
+class DualSv:
+    '''
+    DualSv: Sv processed data object with its linear values cached - every attribute of the Sv object (data, ping_time, depth...)
+            can be used as usual, and linear() gives the linear values
+    '''
+
+    def __init__(self, Sv, parent_lock = None):
+        '''
+        Inputs: Sv (Sv processed data object or DualSv) - shallow copied, so its arrays are shared but it is never changed
+                parent_lock (numpy array) - read-only view locked by the DualSv this is a copy of (see __copy__) - taken
+                                            from Sv if it is a DualSv
+        '''
+        if isinstance(Sv, DualSv):
+            parent_lock = Sv.locked
+            Sv = Sv.Sv
+        self.__dict__["Sv"] = copy.copy(Sv) # own Sv object, so its data can be swapped for a locked view
+        self.__dict__["cache"] = {} # numpy dtype as keys and linear values as values
+        self.__dict__["source"] = None # data array the cached linear values were calculated from
+        self.__dict__["locked"] = None # read-only view of the data owned by this object - made writeable by invalidate()
+        self.__dict__["parent_lock"] = parent_lock
+        if self.is_parent_view(getattr(self.Sv, "data", None)): # own view, so unlocking it does not unlock the parent
+            self.Sv.data = self.Sv.data.view()
+            self.__dict__["locked"] = self.Sv.data
+
+    def __getattr__(self, name):
+        if name in ["Sv", "cache", "source", "locked", "parent_lock"]: # not set yet (i.e. while unpickling)
+            raise AttributeError(name)
+        return getattr(self.Sv, name)
+
+    def __setattr__(self, name, value):
+        if name == "data":
+            self.invalidate()
+            if self.is_parent_view(value): # i.e. crop_Sv slicing the locked data of the DualSv this was copied from
+                self.__dict__["locked"] = value
+        setattr(self.Sv, name, value)
+
+    def __copy__(self):
+        # copies (i.e. made by crop_Sv) get their own Sv object so setting their attributes does not change this one, and
+        # know this object's locked view so they can unlock their own slices of it
+        return DualSv(self.Sv, self.locked)
+
+    def is_parent_view(self, data):
+        '''
+        is_parent_view: True if data is a read-only view of the same memory as the view locked by the parent of this copy
+        '''
+        parent = self.parent_lock
+        return isinstance(data, np.ndarray) and parent is not None and not data.flags.writeable and \
+               data.base is not None and data.base is (parent if parent.base is None else parent.base)
+
+    def linear(self, dtype = None):
+        '''
+        linear: linear values of the data (10**(Sv/10)) - calculated the first time and kept until the data changes
+        Input: dtype (numpy dtype) - type the data is converted to before it is linearized - the type of the data if None
+        Output: read-only numpy array with the same shape as the data
+        '''
+        data = self.Sv.data
+        if data is not self.source: # data was replaced through the Sv object itself
+            self.invalidate()
+        dtype = np.asarray(data).dtype if dtype is None else np.dtype(dtype)
+        if dtype not in self.cache:
+            linear = np.array(data, dtype=dtype)
+            linear /= 10
+            np.power(10, linear, out=linear) # same operations as linear_values, so results match exactly
+            linear.flags.writeable = False
+            self.cache[dtype] = linear
+            if isinstance(data, np.ndarray) and data.flags.writeable:
+                data = data.view() # the array itself is left writeable for whoever else holds it
+                data.flags.writeable = False # changing data in place would leave the linear values out of date
+                self.Sv.data = data
+                self.__dict__["locked"] = data
+            self.__dict__["source"] = data
+        return self.cache[dtype]
+
+    def set_linear(self, linear):
+        '''
+        set_linear: keeps linear values that were calculated some other way (i.e. by mask_mfi from the linear values of the
+                    unmasked Sv) - they have to be 10**(data/10) of the current data
+        '''
+        data = self.Sv.data
+        if data is not self.source:
+            self.invalidate()
+        linear = np.asarray(linear)
+        linear.flags.writeable = False
+        self.cache[linear.dtype] = linear
+        self.__dict__["source"] = data
+
+    def invalidate(self):
+        '''
+        invalidate: throws away the linear values and makes the data writeable again - call before changing data in place
+        '''
+        self.cache.clear()
+        self.__dict__["source"] = None
+        if self.locked is not None:
+            try:
+                self.locked.flags.writeable = True
+            except ValueError: # a view of a read-only array
+                pass
+            self.__dict__["locked"] = None
+
+def dual_subset(subset):
+    '''
+    dual_subset: wraps every Sv object of a subset (frequencies as keys, i.e. from subset_segments_Sv or load_subset) in a DualSv
+    '''
+    return {fq: DualSv(Sv) for fq, Sv in subset.items()}
+
+def linear_values(Sv, dtype = np.float64, out = None):
+    '''
+    linear_values: linear values (10**(Sv/10)) of Sv data - taken from the cache of a DualSv, otherwise calculated
+    Inputs: Sv (DualSv, Sv processed data object, or numpy array) - Sv data
+            dtype (numpy dtype) - type the data is converted to before it is linearized
+            out (numpy array) - optional array to put the values in (flattened) instead of returning a new array
+    Output: numpy array of linear values - read-only if it is from the cache of a DualSv and out is None
+    '''
+    if isinstance(Sv, DualSv):
+        linear = Sv.linear(dtype)
+        if out is None:
+            return linear
+        out[...] = np.ravel(linear)
+        return out
+    data = np.asarray(getattr(Sv, "data", Sv))
+    if out is None:
+        out = np.array(data, dtype=dtype)
+    else:
+        np.copyto(out, np.ravel(data), casting="unsafe")
+    out /= 10
+    np.power(10, out, out=out)
+    return out
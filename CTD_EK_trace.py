@@ -0,0 +1,194 @@
+'''
+Opt-in timing and memory instrumentation for finding out which part of a long run (decoding .raw files, get_Sv, aligning
+channels, MFI, plotting...) is slow. The processing, plotting, and pipeline code wrap each stage in a span:
+
+    with trace.span("get_Sv", frequency=fq):
+        ...
+
+Spans do nothing until enable_trace is called. After that, every span that finishes adds one line to a JSON-lines trace file
+with its name, labels (i.e. cast and frequency), wall time, CPU time, peak resident memory of the process, and the bytes
+allocated while it ran (numpy arrays included, measured with tracemalloc). Spans can be nested - each line has the name of the
+span it was inside. Worker processes (i.e. of run_survey) write to the same trace file. Use trace_summary to total a trace by
+span name and print_summary to print it as a table.
+
+Hollings Scholarship Research Project
+'''
+
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+try:
+    import resource # not on Windows - peak memory is not recorded there
+except ImportError:
+    resource = None
+
+TRACE_ENV = "CTD_EK_TRACE" # set by enable_trace so worker processes started afterwards also trace
+trace_state = {"file": "", "memory": False, "stack": []}
+NO_SPAN = contextlib.nullcontext() # returned by span when tracing is off so spans cost one check
+
+
+def enable_trace(trace_file, memory = True):
+    '''
+    enable_trace: turns on tracing - spans from now on (in this process and worker processes started after this) are added
+                  to trace_file
+    Inputs: trace_file (string) - path and filename of the JSON-lines trace - lines are added to the end if it exists
+            memory (boolean) - if True the bytes allocated in each span are measured with tracemalloc, which makes Python code
+                               (not numpy) slower while tracing
+    '''
+    trace_file = os.path.abspath(trace_file)
+    os.makedirs(os.path.dirname(trace_file), exist_ok=True)
+    trace_state["file"] = trace_file
+    trace_state["memory"] = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    os.environ[TRACE_ENV] = json.dumps({"file": trace_file, "memory": memory})
+
+def disable_trace():
+    '''
+    disable_trace: turns off tracing in this process (and worker processes started after this)
+    '''
+    if trace_state["memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    trace_state["file"] = ""
+    trace_state["memory"] = False
+    trace_state["stack"] = []
+    os.environ.pop(TRACE_ENV, None)
+
+def peak_rss_mb():
+    '''
+    peak_rss_mb: peak resident memory of this process so far in megabytes (None if it can't be measured)
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024**2 if sys.platform == "darwin" else peak/1024 # bytes on macOS, kilobytes on Linux
+
+class Span:
+    '''
+    Span: context manager that times one stage and writes it to the trace when it finishes - create with span()
+    '''
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        stack = trace_state["stack"]
+        self.parent = stack[-1].name if len(stack) != 0 else None
+        self.child_peak = 0 # tracemalloc peak reached inside spans within this one (their reset_peak hides it from this span)
+        if tracemalloc.is_tracing():
+            self.start_bytes, peak = tracemalloc.get_traced_memory()
+            if len(stack) != 0:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.start_rss = peak_rss_mb()
+        self.start_time = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        record = {"name": self.name, "labels": self.labels, "parent": self.parent, "pid": os.getpid(), "start": self.start_time,
+                  "wall_s": wall, "cpu_s": cpu, "peak_rss_mb": peak_rss_mb(), "rss_growth_mb": None, "alloc_peak_mb": None,
+                  "alloc_net_mb": None, "error": None if exc_type is None else exc_type.__name__}
+        if record["peak_rss_mb"] is not None:
+            record["rss_growth_mb"] = record["peak_rss_mb"] - self.start_rss
+        stack = trace_state["stack"]
+        if len(stack) != 0 and stack[-1] is self:
+            stack.pop()
+        if tracemalloc.is_tracing() and hasattr(self, "start_bytes"):
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, self.child_peak)
+            record["alloc_peak_mb"] = (peak - self.start_bytes)/1024**2 # most memory held at once above the start
+            record["alloc_net_mb"] = (current - self.start_bytes)/1024**2 # memory still held at the end (i.e. returned arrays)
+            if len(stack) != 0:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+        if len(trace_state["file"]) != 0:
+            with open(trace_state["file"], 'a') as outfile: # one write per line so processes don't mix up lines
+                outfile.write(json.dumps(record, default=str) + "\n")
+        return False # errors are not caught
+
+def span(name, **labels):
+    '''
+    span: context manager around one stage of processing - records the stage if tracing is on (see enable_trace)
+    Inputs: name (string) - name of the stage (i.e. "get_Sv") - spans are totaled by name in trace_summary
+            labels - any keyword arguments to tell spans with the same name apart (i.e. cast=14, frequency=38000)
+    Output: Span object, or a context manager that does nothing if tracing is off
+    '''
+    if len(trace_state["file"]) == 0:
+        return NO_SPAN
+    return Span(name, labels)
+
+def read_trace(trace_file):
+    '''
+    read_trace: reads a JSON-lines trace file into a list of span records (dictionaries, see Span) - unfinished lines are skipped
+    '''
+    records = []
+    with open(trace_file, 'r') as infile:
+        for trace_line in infile:
+            try:
+                records.append(json.loads(trace_line))
+            except ValueError: # a process was stopped while writing
+                continue
+    return records
+
+def trace_summary(trace_file, by = []):
+    '''
+    trace_summary: totals a trace by span name (and optionally labels) - slowest total wall time first
+    Inputs: trace_file (string) - path and filename of the trace (see enable_trace)
+            by (string list) - labels to also group by (i.e. ["frequency"] to split get_Sv by frequency)
+    Output: table dictionary with columns (lists) "name", one per label in by, "count", "wall_s" (total), "mean_wall_s", "cpu_s"
+            (total), "max_alloc_peak_mb", "max_rss_mb", and "errors" - can be saved with CTD_EK_processing.table_to_csv
+    Note: nested spans are included in the totals of the spans they are in
+    '''
+    groups = {}
+    for record in read_trace(trace_file):
+        key = (record["name"],) + tuple(str(record["labels"].get(label, "")) for label in by)
+        group = groups.setdefault(key, {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "max_alloc_peak_mb": None, "max_rss_mb": None,
+                                        "errors": 0})
+        group["count"] += 1
+        group["wall_s"] += record["wall_s"]
+        group["cpu_s"] += record["cpu_s"]
+        group["errors"] += record["error"] is not None
+        for column, value in [("max_alloc_peak_mb", record["alloc_peak_mb"]), ("max_rss_mb", record["peak_rss_mb"])]:
+            if value is not None and (group[column] is None or value > group[column]):
+                group[column] = value
+
+    table = {"name": []}
+    for label in by:
+        table[label] = []
+    for column in ["count", "wall_s", "mean_wall_s", "cpu_s", "max_alloc_peak_mb", "max_rss_mb", "errors"]:
+        table[column] = []
+    for key in sorted(groups, key=lambda key: groups[key]["wall_s"], reverse=True):
+        group = groups[key]
+        for column, value in zip(["name"] + by, key):
+            table[column].append(value)
+        for column in ["count", "wall_s", "cpu_s", "max_alloc_peak_mb", "max_rss_mb", "errors"]:
+            table[column].append(group[column])
+        table["mean_wall_s"].append(group["wall_s"]/group["count"])
+    return table
+
+def print_summary(table):
+    '''
+    print_summary: prints a table from trace_summary with aligned columns
+    '''
+    columns = list(table.keys())
+    rows = [[column for column in columns]]
+    for row in zip(*[table[column] for column in columns]):
+        rows.append([str(round(value, 3)) if isinstance(value, float) else ("-" if value is None else str(value)) for value in row])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+# worker processes that were started after enable_trace (i.e. by a process pool) pick up the trace file when this is imported
+if TRACE_ENV in os.environ and len(trace_state["file"]) == 0:
+    try:
+        enable_trace(**json.loads(os.environ[TRACE_ENV]))
+    except (ValueError, TypeError):
+        pass
@@ -0,0 +1,20 @@
+'''
+Runs raw_overlay_ctd.py, segment_subsets_mfi.py, and mfi_masks_ABC.py as one pipeline for every cast of every leg listed below,
+without user input (see CTD_EK_pipeline.py). Casts are run in parallel and only the stages of a cast whose inputs or settings
+changed since the last run are re-run. Check pipeline/summary.json for casts that failed and subset_manifest.json for subsets
+flagged for review - the interactive functions can be used on just those.
+
+Hollings Scholarship Research Project
+'''
+
+import CTD_EK_pipeline as pipeline
+
+# one config per leg of the survey - change any settings in the config dictionaries (see default_pipeline_config)
+legs = [pipeline.default_pipeline_config(raw_path = "/Volumes/GeringSSD/GU1905_Acoustic/EK60/",
+                                         ctd_path = "/Volumes/GeringSSD/GU201905_CTD/",
+                                         edna_file = "/Volumes/GeringSSD/GU1905_eDNA/eDNA_cast.txt",
+                                         output_path = "/Volumes/GeringSSD/GU201905_output/",
+                                         name = "GU1905")]
+
+if __name__ == "__main__": # needed so worker processes don't re-run this script
+    pipeline.run_survey(legs)
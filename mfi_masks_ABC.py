@@ -1,6 +1,7 @@
 '''
-Load MFI, subset, and bounds files to create a mask for fish using MFI calcualtions.
-This mask is then applied to the 38kHz Sv data to calculate the ABC value.
+Load MFI and subsets from the subset store (see CTD_EK_store.py) to create a mask for fish using MFI calcualtions.
+This mask is then applied to the 38kHz Sv data to calculate the ABC value. ABC, number of cells, and mean Sv of every MFI class are
+also calculated for all subsets at once and saved to abc_classes.csv.
 
 Skylar Gering July 2021
 '''
@@ -12,33 +13,31 @@ import math
 from echolab2.plotting.matplotlib import echogram
 import matplotlib.pyplot as plt
 import CTD_EK_processing as process
+import CTD_EK_store as store
+import copy
 
 output_path = "/Volumes/GeringSSD/GU201905_output/"
-mfi_file = "mfi.json"
-bounds_file = "subset_bounds.json"
-subset_file = "subsets.json"
-
-mfi_dic = json.load(open(output_path + mfi_file))
-subset_dic = json.load(open(output_path + subset_file))
-bounds_dic = json.load(open(output_path + bounds_file))
+store_path = output_path + "subset_store"
 
 ABC_dic = {}
-for cast in mfi_dic:
+class_subsets = {} # (MFI, Sv) of every subset for the table of all MFI classes
+casts = store.store_casts(store_path)
+for cast in casts:
     abc_depth_dic = {}
     ABC_dic[cast] = abc_depth_dic
-    for depth in mfi_dic[cast]:
-        mfi = mfi_dic[cast][depth]
+    for depth in casts[cast]:
+        mfi = store.load_mfi(store_path, cast, depth)
         if mfi is not None:
-            bounds = bounds_dic[cast][depth]
-            sub38 = subset_dic[cast][depth]["38000"] # using 38kHz for ABC calculation
-            masked_Sv = process.mask_mfi(mfi, sub38, [[0, 0.4], [0.8, 1]]) # mask for all fish (with and without swimbladder)
+            Sv38_obj = store.load_subset(store_path, cast, depth, ["38000"])["38000"] # using 38kHz for ABC calculation
+            class_subsets[(cast, depth)] = (mfi, Sv38_obj)
+            masked_Sv = process.mask_mfi(mfi.data, Sv38_obj.data, [[0, 0.4], [0.8, 1]]) # mask for all fish (with and without swimbladder)
             # create processed data objects for ease of plotting
-            mask_Sv_obj = process.processed_data_from_dic(masked_Sv, bounds)
-            Sv18_obj =process.processed_data_from_dic(sub38, bounds)
+            mask_Sv_obj = copy.copy(Sv38_obj)
+            mask_Sv_obj.data = masked_Sv
             # plot comparison of Sv data and masked Sv data
             fig, ax = plt.subplots(2, figsize = (11, 4), constrained_layout = True)
             fig.suptitle("Cast " + cast + ", Depth " + depth)
-            echogram.Echogram(ax[0], Sv18_obj, threshold=[-90, -20])
+            echogram.Echogram(ax[0], Sv38_obj, threshold=[-90, -20])
             ax[0].set_title("Unmasked 38kHz Sv Data")
             echogram.Echogram(ax[1], mask_Sv_obj, threshold=[-90, -20])
             ax[1].set_title("Masked 38kHz Sv Data")
@@ -51,8 +50,5 @@ for cast in mfi_dic:
 with open(output_path + "abc.json", 'w') as outfile: # save subset dictionary to .json file
         json.dump(ABC_dic, outfile)
 
-
-
-
-
-
+# ABC of every MFI class (see MFI_CLASSES) for every subset in one pass
+process.table_to_csv(process.class_ABC_table(class_subsets), output_path + "abc_classes.csv")
@@ -3,14 +3,15 @@ Start with .asc files from CTD data and .raw files from echosounder (EK80 softwa
 into .evl files and saves them at output_path. CTD traces are plotted and saved as well. Additionally, the .evl files are
 matched to corresponding .raw files by time. Then, the CTD profile is overplayed on the .raw data, plotting an echogram with
 the CTD profile in the foreground. Images with all 4 availible freqencies (18kHz, 38kHz, 120kHz, and 200kHz) are plotted in
-a grid and saved as well. If you have more than 4 frequencies you will need to change the subplot layout.
+a grid and saved as well. If you have more than 4 frequencies you will need to change the subplot layout. Figures are drawn by
+worker processes (see plotting.render_figures) while Sv is calculated for the next cast.
 
 Skylar Gering - July 2021
 '''
 
 import CTD_EK_processing as process
 import CTD_EK_plotting as plotting
-from echolab2.instruments import EK80
+from CTD_EK_cache import SvCache
 import matplotlib.pyplot as plt
 import os
 
@@ -26,43 +27,46 @@ raw_path = "/Volumes/GeringSSD/GU1905_Acoustic/EK60/"
 ctd_path = '/Volumes/GeringSSD/GU201905_CTD/'
 ctd_list = '/CTDtoEVL.list'
 output_path = "/Volumes/GeringSSD/GU201905_output/"
+sv_cache = SvCache(output_path + "Sv_cache") # Sv saved here is reused by later runs and segment_subsets_mfi.py
 
-# creates a list of the .asc CTD files names
-asc_files = process.asc_from_list(ctd_path + ctd_list)
+def cast_figures():
+    '''
+    cast_figures: calculates what is needed for the figures of each cast and yields figure jobs for plotting.render_figures - the
+                  figures of one cast are drawn by worker processes while Sv is calculated for the next cast
+    '''
+    # creates a list of the .asc CTD files names
+    asc_files = process.asc_from_list(ctd_path + ctd_list)
 
-# creates .evl files for each cast in CTDtoEVL.list and saves them in ctd_path
-process.asc_to_evl(ctd_list, ctd_path, output_path)
+    # creates .evl files for each cast in CTDtoEVL.list and saves them in ctd_path
+    process.asc_to_evl(ctd_list, ctd_path, output_path)
 
-# create a list of the .evl file names, which were created in the above call
-evl_files = process.cast_new_extension(asc_files, ".asc", ".evl")
+    # create a list of the .evl file names, which were created in the above call
+    evl_files = process.cast_new_extension(asc_files, ".asc", ".evl")
 
-# gets a list of the .raw files by giving a location and then finding all the .raw files in that directory
-raw_files = process.glob.glob(os.path.normpath(raw_path + "/*.raw")) # filepath in the filenames
+    # gets a list of the .raw files by giving a location and then finding all the .raw files in that directory
+    raw_files = process.glob.glob(os.path.normpath(raw_path + "/*.raw")) # filepath in the filenames
 
-# finds overlapping .evl and .raw files and saves the list to a dictionary (also saves to file if given outfile_path)
-evl_raw_dic = process.match_raw_evl(evl_files, raw_files, evl_inpath=output_path, outfile_path=output_path)
+    # finds overlapping .evl and .raw files and saves the list to a dictionary (also saves to file if given outfile_path)
+    evl_raw_dic = process.match_raw_evl(evl_files, raw_files, evl_inpath=output_path, outfile_path=output_path)
 
-# loop through all of the evl files
-for evl in evl_raw_dic:
-    # plot CTD profile
-    cast_num = int(evl.replace("ctd", "").replace(".evl", ""))
-    fig, ax = plt.subplots(figsize = (10,8))
-    plotting.plot_evl(ax, evl, output_path, "CTD Profile: Cast " + str(cast_num))
-    plt.savefig(output_path + evl.replace(".evl", ".png"))
-    plt.close()
-    
-    # plot echograms with CTD profile overlayed
-    ek80 = EK80.EK80()
-    raw_infiles = [os.path.normpath(raw_path + "/"+ raw) for raw in evl_raw_dic[evl]]
-    ek80.read_raw(raw_infiles)
-    fig, axs = plt.subplots(2,2, figsize=(12,10), constrained_layout = True)
-    fig.suptitle("Echogram with CTD Profile: Cast " + str(cast_num))
-    # plot each frequency on a seperate subplot
-    fq_ax = [(18000, axs[0,0]), (38000, axs[0,1]), (120000, axs[1,0]), (200000, axs[1,1])]
-    for fq in fq_ax:
-        echo_plot = plotting.plot_echo(fq[1], ek80, fq[0], transducer_offset= 5)
-        plotting.plot_evl_trace(fq[1], echo_plot, evl, output_path)
-    plt.savefig(output_path + evl.replace(".evl", "_echograms.png"))
-    plt.close()
+    # loop through all of the evl files
+    for evl in evl_raw_dic:
+        # plot CTD profile
+        cast_num = int(evl.replace("ctd", "").replace(".evl", ""))
+        yield {"kind": "profile", "outfile": output_path + evl.replace(".evl", ".png"), "evl_file": output_path + evl,
+               "title": "CTD Profile: Cast " + str(cast_num)}
 
+        # plot echograms with CTD profile overlayed - each frequency on a seperate subplot of a 2x2 grid
+        raw_infiles = [os.path.normpath(raw_path + "/"+ raw) for raw in evl_raw_dic[evl]]
+        frequencies = [18000, 38000, 120000, 200000]
+        cast_window = process.evl_time_bounds(output_path + evl) # only the pings during the cast are decoded (see CTD_EK_rawindex.py)
+        Sv_dic = process.raw_files_to_Sv(raw_infiles, frequencies, 5, sv_cache, cast_window) # only decodes .raw files not in the cache
+        if len(Sv_dic) == 0: # no pings during the cast
+            continue
+        yield {"kind": "echograms", "outfile": output_path + evl.replace(".evl", "_echograms.png"), "evl_file": output_path + evl,
+               "Sv": {fq: Sv_dic[fq][0] for fq in frequencies}, "title": "Echogram with CTD Profile: Cast " + str(cast_num),
+               "grid": (2, 2), "figsize": (12,10)}
 
+# figures are drawn in parallel with a non-interactive backend - the guard is needed so worker processes don't re-run this script
+if __name__ == "__main__":
+    plotting.render_figures(cast_figures())
@@ -1,19 +1,18 @@
 '''
-Load .evl/.raw file dictionary (see example in raw_overlay_ctd.py) and segment each CTD profile and take a 10 minute and 4m subset of the Sv
-data around each segment where an eDNA sample was taken. Save all subsets into a nested .json file where outerlayer is cast number, the nest key is
-the depth, then the frequencies, and finally the innermost layer is the Sv data points in a nested list. For each subset, calculate MFI and save image
-of classification as well as a .json file with array of MFI files for each depth for each cast.
+Load .evl/.raw file dictionary (see example in raw_overlay_ctd.py) and segment each CTD profile (automatically, see auto_segment_casts) and
+take a 10 minute and 4m subset of the Sv data around each segment where an eDNA sample was taken. For each subset, calculate MFI and save image
+of classification. All subsets and MFI arrays are saved into a binary store (one file per cast and depth, see CTD_EK_store.py), which is then
+exported to the nested .json files used by the R code, where outerlayer is cast number, the nest key is the depth, then the frequencies, and
+finally the innermost layer is the Sv data points in a nested list.
 
 Skylar Gering - July 2021
 '''
 
 import CTD_EK_processing as process
 import CTD_EK_plotting as plotting
-from echolab2.instruments import EK80
-import matplotlib.pyplot as plt
+import CTD_EK_store as store
+from CTD_EK_cache import SvCache
 import os
-import json
-import copy
 
 # needed paths and files
 raw_path = "/Volumes/GeringSSD/GU1905_Acoustic/EK60/"
@@ -22,6 +21,8 @@ output_path = "/Volumes/GeringSSD/GU201905_output/"
 ctd_path = '/Volumes/GeringSSD/GU201905_CTD/'
 ctd_list = '/CTDtoEVL.list'
 evl_raw_list = output_path + "/evl_raw_matches.list"
+sv_cache = SvCache(output_path + "Sv_cache") # same cache as raw_overlay_ctd.py so Sv is not recalculated
+store_path = output_path + "subset_store" # binary store of subsets and MFI - see CTD_EK_store.py
 
 # needed values
 transducer_offset = 5
@@ -37,41 +38,34 @@ evl_raw_dic=process.evl_raw_dic_from_file(evl_raw_list)
 # read in depths of eDNA samples for each cast
 eDNA_cast_dic = process.read_casts(edna_path + "eDNA_cast.txt")
 
-ctd_subset_dic = {}
-bounds_dic = {}
-mfi_dic = {}
-
-casts =  range(len(eDNA_cast_dic.keys()))
-for i in casts:
-    cast = list(eDNA_cast_dic.keys())[i]
-    mfi_depth_dic = {}
-    mfi_dic[cast] = mfi_depth_dic
-    file_idx = cast-1 # python counts from 0, but cast numbers start at 1y
-    seg_dic = process.interactive_segment_maker(eDNA_cast_dic[cast], output_path + evl_files[file_idx], transducer_offset) # make segments
-    raw_files = [os.path.normpath(raw_path + "/"+ raw) for raw in evl_raw_dic[evl_files[file_idx]]]
-    subset_Sv_dic = process.interactive_subset_maker(seg_dic, raw_files, transducer_offset, toffsets = (5, 5), doffsets = (2,2)) # make subsets
-    ctd_subset_dic[cast], bounds_dic[cast]  = process.subset_to_json(copy.deepcopy(subset_Sv_dic)) # save subsets in nested dictionary
-    for j in range(len(subset_Sv_dic.keys())):
-        sample = list(subset_Sv_dic.keys())[j]
-        mfi = process.calc_MFI(subset_Sv_dic[sample], sample, bad_fq = [200000])
-        if mfi.data is not None:
-                mfi_depth_dic[sample] = mfi.data.tolist()
-                fig, ax = plt.subplots(figsize=(18,4))
-                mfi_image = plotting.plot_MFI(ax, mfi, "Cast " + str(i+1) + ", Depth " + str(sample) + " : MFI Predictions")
-                plt.savefig(output_path + "ctd_" +  str(i+1) + "_" + str(sample) + "_mfi.png")
-                plt.close()
-        else: mfi_depth_dic[sample] = None
-
-with open(output_path + "subsets.json", 'w') as outfile: # save subset dictionary to .json file
-        json.dump(ctd_subset_dic, outfile)
-
-with open(output_path + "subset_bounds.json", 'w') as outfile: # save subset dictionary to .json file
-        json.dump(bounds_dic, outfile)
-
-with open(output_path + "mfi.json", 'w') as outfile: # save subset dictionary to .json file
-        json.dump(mfi_dic, outfile)
-
-
-
-
-
+# make segments for every cast without user input, one cast per process - casts that can't be segmented automatically
+# are checked with interactive_segment_maker - the guard is needed so worker processes don't re-run this script
+if __name__ == "__main__":
+    cast_evl_files = {cast: output_path + evl_files[cast-1] for cast in eDNA_cast_dic} # cast numbers start at 1
+    seg_dics, seg_reports = process.auto_segment_casts(eDNA_cast_dic, cast_evl_files, transducer_offset,
+                                                       report_file = output_path + "segment_report.json")
+
+    # make subsets for every cast with the rules in subset_policy (no prompts), one cast per process - subsets listed under
+    # "review" in subset_manifest.json should be looked at (i.e. with plotting.plot_echo or interactive_subset_maker)
+    subset_policy = process.default_subset_policy() # 10 minute and 4m boxes, clamped to the near-field and seabed
+    raw_files_dic = {cast: [os.path.normpath(raw_path + "/"+ raw) for raw in evl_raw_dic[evl_files[cast-1]]] for cast in eDNA_cast_dic}
+    subset_dics, manifest = process.policy_subset_casts(seg_dics, raw_files_dic, transducer_offset, subset_policy,
+                                                        manifest_file = output_path + "subset_manifest.json", sv_cache = sv_cache)
+
+    mfi_figures = [] # MFI images are drawn after all the calculations, in parallel (see plotting.render_figures)
+    casts =  range(len(eDNA_cast_dic.keys()))
+    for i in casts:
+        cast = list(eDNA_cast_dic.keys())[i]
+        subset_Sv_dic = subset_dics[cast]
+        mfi_depth_dic = process.calc_MFI_batch(subset_Sv_dic, bad_fq = [200000]) # MFI for every depth of the cast at once
+        for j in range(len(subset_Sv_dic.keys())):
+            sample = list(subset_Sv_dic.keys())[j]
+            mfi = mfi_depth_dic[sample]
+            if mfi.data is not None:
+                mfi_figures.append({"kind": "mfi", "mfi": mfi, "outfile": output_path + "ctd_" +  str(i+1) + "_" + str(sample) + "_mfi.png",
+                                    "title": "Cast " + str(i+1) + ", Depth " + str(sample) + " : MFI Predictions"})
+        store.save_cast_subsets(store_path, cast, subset_Sv_dic, mfi_depth_dic) # save subsets and MFI of this cast
+    plotting.render_figures(mfi_figures)
+
+    # subsets.json, subset_bounds.json, and mfi.json for the R code
+    store.store_to_json(store_path, output_path)
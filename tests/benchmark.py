@@ -0,0 +1,182 @@
+'''
+Benchmarks of the processing functions on synthetic data (see synthetic_data.py), so no cruise data or internet is needed.
+Each function is timed at three sizes (small, medium, large) and compared with the times saved in benchmark_baselines.json.
+A function is a regression if it is slower than its baseline by more than the threshold (25% by default).
+
+    python tests/benchmark.py                          # run every size and compare with the baselines
+    python tests/benchmark.py --tiers small medium     # only some sizes
+    python tests/benchmark.py --only calc_MFI mask_mfi # only some functions
+    python tests/benchmark.py --update                 # save these times as the new baselines
+
+Baselines are only meaningful on the computer they were made on, so run --update once on a new computer before comparing.
+Returns an exit code of 1 if there is a regression.
+
+Hollings Scholarship Research Project
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository folder, for CTD_EK_processing
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import CTD_EK_processing as process
+import synthetic_data as synthetic
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baselines.json")
+
+# casts: number of CTD casts, pings/samples: size of a whole cast of Sv, box: size of one subset, subsets: number of subsets
+TIERS = {"small": {"casts": 2, "pings": 1000, "samples": 200, "box": (300, 40), "subsets": 10},
+         "medium": {"casts": 10, "pings": 4000, "samples": 500, "box": (600, 80), "subsets": 40},
+         "large": {"casts": 40, "pings": 12000, "samples": 1000, "box": (600, 160), "subsets": 120}}
+
+
+def cast_traces(n_casts):
+    '''
+    cast_traces: (times, depths) of n_casts synthetic CTD traces sampled every second, with the eDNA depths of each cast
+    '''
+    bottle_depths = [80, 43, 10]
+    return [synthetic.ctd_trace(bottle_depths, seed=cast) for cast in range(n_casts)], bottle_depths
+
+def benchmarks(size, tmp_path):
+    '''
+    benchmarks: creates the synthetic data for one size and returns a dictionary with function names as keys and functions
+                with no arguments that run them as values - creating the data is not timed
+    Inputs: size (dictionary) - one of the TIERS
+            tmp_path (string) - folder for the synthetic files
+    '''
+    cruise = synthetic.write_cruise(tmp_path, size["casts"])
+    process.asc_to_evl(cruise["ctd_list"], tmp_path, tmp_path)
+    evl_files = process.cast_new_extension(cruise["asc_files"], ".asc", ".evl")
+    traces, bottle_depths = cast_traces(size["casts"])
+
+    Sv_dic = synthetic.make_Sv_dic(size["pings"], size["samples"])
+    Sv_ref = Sv_dic[18000][0]
+    box_pings = size["box"][0]
+    boxes = {str(i): ((Sv_ref.ping_time[start], Sv_ref.ping_time[start + box_pings - 1]), (20 + i % 5 * 20, 24 + i % 5 * 20))
+             for i, start in enumerate(np.linspace(0, size["pings"] - box_pings, 10).astype(int))}
+
+    subsets = {(str(i // 3 + 1), str(10*(i % 3 + 1))): synthetic.make_subset(size["box"][0], size["box"][1], seed=i)
+               for i in range(size["subsets"])}
+    subset = subsets[("1", "10")]
+    mfi_dic = process.calc_MFI_batch(subsets)
+    mfi, Sv_38 = mfi_dic[("1", "10")], subset["38000"]
+    abc_subsets = {key: (mfi_dic[key], subsets[key]["38000"]) for key in subsets}
+
+    def segment_all():
+        for x, y in traces:
+            process.create_segments_dic(x, y, 2E-5)
+
+    def atol_all():
+        for x, y in traces:
+            process.auto_atol_zero(x, y, bottle_depths, 5)
+
+    return {"asc_to_evl": lambda: process.asc_to_evl(cruise["ctd_list"], tmp_path, tmp_path),
+            "match_raw_evl": lambda: process.match_raw_evl(evl_files, cruise["raw_files"], evl_inpath=tmp_path),
+            "create_segments_dic": segment_all,
+            "auto_atol_zero": atol_all,
+            "crop_boxes_Sv": lambda: process.crop_boxes_Sv(Sv_dic, boxes),
+            "calc_MFI": lambda: process.calc_MFI(subset),
+            "calc_MFI_batch": lambda: process.calc_MFI_batch(subsets),
+            "mask_mfi": lambda: process.mask_mfi(mfi.data, Sv_38.data, process.MFI_CLASSES["all_fish"]),
+            "calc_ABC": lambda: process.calc_ABC(Sv_38),
+            "class_ABC_table": lambda: process.class_ABC_table(abc_subsets)}
+
+def time_function(function, repeats = 5, min_seconds = 0.2):
+    '''
+    time_function: best time (seconds) of a function over repeats runs - fast functions are run in loops of several calls
+                   so each timing is at least min_seconds/repeats long
+    '''
+    function() # first run warms up caches and is not counted
+    loops = 1
+    start = time.perf_counter()
+    function()
+    once = time.perf_counter() - start
+    if once > 0:
+        loops = max(1, int(min_seconds/repeats/once))
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        best = min(best, (time.perf_counter() - start)/loops)
+    return best
+
+def run_benchmarks(tiers = list(TIERS.keys()), only = [], repeats = 5):
+    '''
+    run_benchmarks: times every benchmark at every size
+    Inputs: tiers (string list) - sizes to run (keys of TIERS)
+            only (string list) - function names to run - all are run if empty
+            repeats (integer) - number of timings of each function (the best is kept)
+    Output: dictionary with sizes as keys and dictionaries of function names and seconds as values
+    '''
+    results = {}
+    for tier in tiers:
+        tmp_path = tempfile.mkdtemp(prefix="benchmark_")
+        try:
+            results[tier] = {}
+            for name, function in benchmarks(TIERS[tier], tmp_path).items():
+                if len(only) == 0 or name in only:
+                    results[tier][name] = time_function(function, repeats)
+                    print(tier.ljust(8) + name.ljust(22) + str(round(results[tier][name]*1000, 3)) + " ms")
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return results
+
+def compare_baselines(results, baselines, threshold = 0.25):
+    '''
+    compare_baselines: compares benchmark times with the baseline times
+    Inputs: results (dictionary) - output of run_benchmarks
+            baselines (dictionary) - results saved by a previous run (same format)
+            threshold (float) - a function is a regression if its time / baseline time is more than 1 + threshold
+    Output: list of (size, function name, time / baseline time) for each regression
+    '''
+    regressions = []
+    for tier in results:
+        for name, seconds in results[tier].items():
+            baseline = baselines.get(tier, {}).get(name)
+            if baseline is None:
+                print(tier.ljust(8) + name.ljust(22) + "no baseline")
+                continue
+            ratio = seconds/baseline
+            print(tier.ljust(8) + name.ljust(22) + str(round(ratio, 2)) + "x baseline" + ("  REGRESSION" if ratio > 1 + threshold else ""))
+            if ratio > 1 + threshold:
+                regressions.append((tier, name, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of CTD_EK_processing on synthetic data")
+    parser.add_argument("--tiers", nargs="+", default=list(TIERS.keys()), choices=list(TIERS.keys()))
+    parser.add_argument("--only", nargs="+", default=[], help="function names to run")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown before a regression (0.25 is 25%%)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline .json file")
+    parser.add_argument("--update", action="store_true", help="save these times as the baselines")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.tiers, args.only, args.repeats)
+
+    saved = {"machine": "", "results": {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as infile:
+            saved = json.load(infile)
+    if args.update:
+        for tier in results: # only the sizes and functions that were run are replaced
+            saved["results"].setdefault(tier, {}).update(results[tier])
+        saved["machine"] = platform.platform() + " " + platform.processor() + " Python " + platform.python_version()
+        with open(args.baseline, 'w') as outfile:
+            json.dump(saved, outfile, indent=2)
+        print("Baselines saved to " + args.baseline)
+    else:
+        if saved["machine"] != "" and not saved["machine"].startswith(platform.platform()):
+            print("Baselines were made on " + saved["machine"] + " - times may not be comparable")
+        regressions = compare_baselines(results, saved["results"], args.threshold)
+        if len(regressions) != 0:
+            print(str(len(regressions)) + " regression(s) over " + str(round(args.threshold*100)) + "%")
+            sys.exit(1)
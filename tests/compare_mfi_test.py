@@ -7,26 +7,22 @@
 ################################################################
 
 
-import json
 import CTD_EK_processing as process
 import CTD_EK_plotting as plotting
+import CTD_EK_store as store
+import CTD_EK_sv as dual_sv
 import matplotlib.pyplot as plt
 output_path = "/Volumes/GeringSSD/GU201905_output/"
-bounds_file = "cast14_15_subset_bounds.json"
-subset_file = "cast14_15_subsets.json"
+store_path = output_path + "subset_store" # subsets saved by segment_subsets_mfi.py
+compare_casts = ["14", "15"]
 
 
-subset_dic = json.load(open(output_path + subset_file)) # load subsets
-bounds_dic = json.load(open(output_path + bounds_file)) # load subset bounds
-
-for cast in subset_dic: # for all casts
-    for depth in subset_dic[cast]: # for all depths in a cast
+store_dic = store.store_casts(store_path)
+for cast in compare_casts: # for all casts
+    for depth in store_dic[cast]: # for all depths in a cast
         fig, ax = plt.subplots(4, figsize = (12, 8), constrained_layout = True)
         fig.suptitle("MFI: Cast " + cast + ", Depth " + depth)
-        Sv = subset_dic[cast][depth] # Sv data from subset
-        bounds = bounds_dic[cast][depth]
-        for fq in Sv:
-            Sv[fq] = process.processed_data_from_dic(Sv[fq], bounds) # create pyEcholab processed data object
+        Sv = dual_sv.dual_subset(store.load_subset(store_path, cast, depth)) # Sv object for each frequency - linearized once for all 4 MFIs
         mfi_local = process.calc_MFI(Sv) # calculate MFI with local normalization with all frequencies
         plotting.plot_MFI(ax[0], mfi_local, "Local Norm, All Frequencies")
         mfi_local_3f = process.calc_MFI(Sv, bad_fq=[200000]) # calculate MFI with local normalization excluding 200kHz
@@ -0,0 +1,67 @@
+'''
+Checks crops of DualSv objects (see CTD_EK_sv.py) on synthetic Sv (see synthetic_data.py) - crop_Sv with copy_data=True
+shares no memory with the DualSv or the Sv it wraps, the wrapped Sv object is not changed, and crops of a DualSv with cached
+linear values can be changed after invalidate().
+
+    python tests/dual_sv_test.py
+
+Returns an exit code of 1 if any check fails.
+
+Hollings Scholarship Research Project
+'''
+
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository folder, for CTD_EK_processing
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import CTD_EK_processing as process
+import CTD_EK_sv as dual_sv
+import synthetic_data as synthetic
+
+ARRAYS = ["data", "ping_time", "depth", "transducer_offset", "heave"] # arrays of synthetic Sv objects
+
+
+def shares_memory(a, b):
+    '''
+    shares_memory: names of the arrays of Sv object a that share memory with the same array of b
+    '''
+    return [name for name in ARRAYS if np.shares_memory(getattr(a, name), getattr(b, name))]
+
+def check_dual_crops():
+    '''
+    check_dual_crops: crops a plain Sv object and a DualSv (before and after its linear values are cached) with and without
+                      copy_data
+    Output: list of (name, passed) for each check
+    '''
+    results = []
+    Sv = synthetic.make_Sv(200, 50)
+    dual = dual_sv.DualSv(Sv)
+    inner_names = set(vars(dual.Sv))
+    for cached in [False, True]:
+        if cached:
+            dual.linear() # data of the DualSv is now a read-only view
+        label = " - linear values cached" if cached else ""
+        copied = process.crop_Sv(dual, [10, 99], [5, 44], True)
+        results.append(("copy_data crop of DualSv shares no memory" + label, len(shares_memory(copied, Sv)) == 0))
+        results.append(("copy_data crop of DualSv is writeable" + label, copied.data.flags.writeable))
+        results.append(("copy_data crop has the same values" + label,
+                        np.array_equal(copied.data, Sv.data[10:100, 5:45]) and np.array_equal(copied.ping_time, Sv.ping_time[10:100])))
+        results.append(("wrapped Sv object has no new attributes" + label, set(vars(dual.Sv)) == inner_names))
+        results.append(("copy's Sv object has no new attributes" + label, set(vars(copied.Sv)) <= inner_names))
+        view = process.crop_Sv(dual, [10, 99], [5, 44])
+        results.append(("default crop of DualSv shares memory" + label, "data" in shares_memory(view, Sv)))
+        view.invalidate()
+        view.data[0, 0] = 1 # crop of a locked DualSv can be changed once it is invalidated
+        results.append(("crop can be changed after invalidate()" + label, Sv.data[10, 5] == 1))
+    results.append(("copy_data crop of Sv shares no memory", len(shares_memory(process.crop_Sv(Sv, [0, 9], [0, 9], True), Sv)) == 0))
+    results.append(("caller's Sv array stays writeable", Sv.data.flags.writeable))
+    return results
+
+
+if __name__ == "__main__":
+    results = check_dual_crops()
+    for name, passed in results:
+        print(name.ljust(72) + ("ok" if passed else "FAILED"))
+    if not all(passed for _, passed in results):
+        sys.exit(1)
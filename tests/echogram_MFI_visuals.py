@@ -6,12 +6,13 @@ Skylar Gering July 2021
 
 import CTD_EK_processing as process
 import CTD_EK_plotting as plotting
+import CTD_EK_store as store
 import os
 import matplotlib.pyplot as plt
-from echolab2.instruments import EK80
-from echolab2.processing import line, processed_data
+import CTD_EK_rawindex as rawindex
+import CTD_EK_evl as evl_traces
+from echolab2.processing import processed_data
 from echolab2.plotting.matplotlib import echogram
-import json
 
 plt.rcParams['axes.labelsize'] = 18
 plt.rcParams['axes.titlesize'] = 20
@@ -37,9 +38,7 @@ evl_raw_dic=process.evl_raw_dic_from_file(evl_raw_list)
 
 
 # Cast 14 Data
-depth_data = line.read_evl(output_path + evl_list[13])
-x=depth_data.ping_time
-y=depth_data.data
+x, y = evl_traces.evl_trace(output_path + evl_list[13]) # plot_evl and plot_evl_trace below use the same parsed trace
 
 # CTD Profile
 fig, ax = plt.subplots(figsize=(10, 8),  constrained_layout = True)
@@ -50,9 +49,8 @@ plt.close()
 
 # 4 Frequencies Echogram
 fig, ax = plt.subplots(2, 2, figsize=(10, 8), constrained_layout=True)
-ek80 = EK80.EK80()
 raw_infiles = [os.path.normpath(raw_path + "/"+ raw) for raw in evl_raw_dic[evl_list[13]]]
-ek80.read_raw(raw_infiles)
+ek80 = rawindex.read_raw_window(raw_infiles, x[0], x[-1]) # only the pings during the cast
 
 fig.suptitle("Cast 14 Echograms")
 plotting.plot_echo(ax[0,0], ek80, 18000, title = "18 kHz", fq_thresholds = echo_threshold, transducer_offset= 5)
@@ -103,28 +101,22 @@ plt.savefig(outfile_path + "cast14_38000_subset.png")
 plt.close() 
 
 output_path = "/Volumes/GeringSSD/GU201905_output/"
-mfi_file = "mfi.json"
-bounds_file = "subset_bounds.json"
-subset_file = "subsets.json"
-mfi_dic = json.load(open(output_path + mfi_file))
-subset_dic = json.load(open(output_path + subset_file))
-bounds_dic = json.load(open(output_path + bounds_file))
+store_path = output_path + "subset_store"
 
 # mfi and subset data
-mfi_data = mfi_dic["14"]["56"]
-bounds = bounds_dic["14"]["56"]
-sub38 = subset_dic["14"]["56"]["38000"]
-mfi_obj = process.processed_data_from_dic(mfi_data, bounds)
+subset_56 = store.load_subset(store_path, "14", "56")
+mfi_obj = store.load_mfi(store_path, "14", "56")
+bounds = {"ping_time": mfi_obj.ping_time, "depth": mfi_obj.depth}
 
 # all cast 14 depth 56 subsets
 fig, ax = plt.subplots(4, figsize=(10, 8), constrained_layout=True)
-echogram.Echogram(ax[0], process.processed_data_from_dic(subset_dic["14"]["56"]["18000"], bounds), threshold=echo_threshold)
+echogram.Echogram(ax[0], subset_56["18000"], threshold=echo_threshold)
 ax[0].set_title("18 kHz")
-echogram.Echogram(ax[1], process.processed_data_from_dic(subset_dic["14"]["56"]["38000"], bounds), threshold=echo_threshold)
+echogram.Echogram(ax[1], subset_56["38000"], threshold=echo_threshold)
 ax[1].set_title("38 kHz")
-echogram.Echogram(ax[2], process.processed_data_from_dic(subset_dic["14"]["56"]["120000"], bounds), threshold=echo_threshold)
+echogram.Echogram(ax[2], subset_56["120000"], threshold=echo_threshold)
 ax[2].set_title("120 kHz")
-echogram.Echogram(ax[3], process.processed_data_from_dic(subset_dic["14"]["56"]["200000"], bounds), threshold=echo_threshold)
+echogram.Echogram(ax[3], subset_56["200000"], threshold=echo_threshold)
 ax[3].set_title("200 kHz")
 fig.suptitle("Cast 14 Echograms Subset at 56m")
 plt.savefig(outfile_path + "cast14_56_subsets.png")
@@ -144,7 +136,7 @@ plt.savefig(outfile_path + "cast14_56_mfi_mask.png")
 plt.close()
 
 fig, ax = plt.subplots(figsize=(15, 3), constrained_layout = True)
-sv_mask = process.mask_mfi(mfi_obj.data, process.processed_data_from_dic(subset_dic["14"]["56"]["38000"], bounds).data, [[0, 0.4], [0.8, 1]])
+sv_mask = process.mask_mfi(mfi_obj.data, subset_56["38000"].data, [[0, 0.4], [0.8, 1]])
 echo_plot = echogram.Echogram(ax, process.processed_data_from_dic(sv_mask, bounds), threshold=echo_threshold)
 ax.tick_params(axis='x', labelrotation=15)
 echo_plot.add_colorbar(fig)
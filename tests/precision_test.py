@@ -0,0 +1,91 @@
+'''
+Checks that the float32 path of the Sv/MFI/ABC calculations (dtype=np.float32) gives the same results as the float64 path
+within a tolerance, on synthetic subsets (see synthetic_data.py). MFI, mask_mfi, calc_ABC, and class_ABC_table are compared,
+and the memory of the MFI arrays of both is printed.
+
+    python tests/precision_test.py
+
+Returns an exit code of 1 if any difference is over its tolerance.
+
+Hollings Scholarship Research Project
+'''
+
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository folder, for CTD_EK_processing
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import CTD_EK_processing as process
+import synthetic_data as synthetic
+
+# largest allowed difference between the float32 and float64 results
+MFI_ATOL = 1E-5 # MFI is between about -0.7 and 1.7
+SV_ATOL = 1E-4 # dB
+ABC_RTOL = 1E-5 # relative, ABC sums are float64 in both
+
+
+def max_difference(a, b):
+    '''
+    max_difference: largest absolute difference between two arrays where both are finite, and whether they are NaN in the same places
+    '''
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    finite = np.isfinite(a) & np.isfinite(b)
+    same_nan = np.array_equal(np.isnan(a), np.isnan(b))
+    return (float(np.max(np.abs(a[finite] - b[finite]))) if finite.any() else 0.0), same_nan
+
+def compare_precision(n_subsets = 20, box = (600, 80), seed = 0):
+    '''
+    compare_precision: runs MFI, mask_mfi, calc_ABC, and class_ABC_table in float64 and float32 on the same synthetic subsets
+    Output: list of (name, difference, tolerance, passed) for each comparison
+    '''
+    subsets = {("1", str(i)): synthetic.make_subset(box[0], box[1], seed=seed + i) for i in range(n_subsets)}
+    subsets[("1", "0")]["38000"].data[:5, :5] = np.nan # NaN Sv has to stay NaN
+    results = []
+
+    for global_norm in [False, True]:
+        mfi_64 = process.calc_MFI_batch(subsets, global_norm=global_norm)
+        mfi_32 = process.calc_MFI_batch(subsets, global_norm=global_norm, dtype=np.float32)
+        worst, same_nan = 0.0, True
+        for key in subsets:
+            difference, nan_match = max_difference(mfi_64[key].data, mfi_32[key].data)
+            worst, same_nan = max(worst, difference), same_nan and nan_match
+        if global_norm:
+            bytes_64 = sum(mfi.data.nbytes for mfi in mfi_64.values())
+            bytes_32 = sum(mfi.data.nbytes for mfi in mfi_32.values())
+            print("MFI arrays: " + str(round(bytes_64/2**20, 1)) + " MB float64, " + str(round(bytes_32/2**20, 1)) + " MB float32")
+        results.append(("calc_MFI_batch" + (" global_norm" if global_norm else ""), worst, MFI_ATOL, worst <= MFI_ATOL and same_nan))
+
+    worst, same_nan = 0.0, True
+    for key in subsets:
+        masked_64 = process.mask_mfi(mfi_64[key].data, subsets[key]["38000"].data, process.MFI_CLASSES["all_fish"])
+        masked_32 = process.mask_mfi(mfi_32[key].data, subsets[key]["38000"].data, process.MFI_CLASSES["all_fish"], np.float32)
+        # cells right on a range edge can be in or out of the mask depending on rounding, so only cells masked the same are compared
+        same_mask = (masked_64 == -999) == (masked_32 == -999)
+        difference, nan_match = max_difference(masked_64[same_mask], masked_32[same_mask])
+        worst, same_nan = max(worst, difference), same_nan and nan_match and same_mask.mean() > 0.999
+    results.append(("mask_mfi", worst, SV_ATOL, worst <= SV_ATOL and same_nan))
+
+    worst = 0.0
+    for key in subsets:
+        Sv = subsets[key]["38000"]
+        Sv.data = np.where(np.isnan(Sv.data), -999, Sv.data) if key == ("1", "0") else Sv.data # calc_ABC is NaN with any NaN
+        abc_64, abc_32 = process.calc_ABC(Sv), process.calc_ABC(Sv, np.float32)
+        worst = max(worst, abs(abc_32 - abc_64)/abs(abc_64))
+    results.append(("calc_ABC", worst, ABC_RTOL, worst <= ABC_RTOL))
+
+    table_64 = process.class_ABC_table({key: (mfi_64[key], subsets[key]["38000"]) for key in subsets})
+    table_32 = process.class_ABC_table({key: (mfi_32[key], subsets[key]["38000"]) for key in subsets}, dtype=np.float32)
+    abc_64, abc_32 = np.array(table_64["abc"]), np.array(table_32["abc"])
+    has_cells = abc_64 != 0
+    worst = float(np.max(np.abs(abc_32[has_cells] - abc_64[has_cells])/np.abs(abc_64[has_cells])))
+    results.append(("class_ABC_table", worst, ABC_RTOL, worst <= ABC_RTOL))
+    return results
+
+
+if __name__ == "__main__":
+    results = compare_precision()
+    for name, difference, tolerance, passed in results:
+        print(name.ljust(28) + "max difference " + format(difference, ".2e") + " (tolerance " + format(tolerance, ".0e") + ")" +
+              ("" if passed else "  FAILED"))
+    if not all(passed for _, _, _, passed in results):
+        sys.exit(1)
@@ -0,0 +1,113 @@
+'''
+Checks that stream_boxes_Sv gives the same boxes as crop_boxes_Sv on the whole cast, on a synthetic cast (see
+synthetic_data.py) with a gap between two recordings - including a first box that starts before the recording (so the
+probe window has no pings) and boxes in and across the gap. The windowed decoding of raw_files_to_Sv is replaced by
+windows of the synthetic cast, so no .raw files are needed.
+
+    python tests/stream_test.py
+
+Returns an exit code of 1 if any check fails.
+
+Hollings Scholarship Research Project
+'''
+
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository folder, for CTD_EK_processing
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import CTD_EK_processing as process
+import synthetic_data as synthetic
+
+START = np.datetime64("2019-10-18T11:40:00", "ms")
+GAP_START = START + np.timedelta64(1500, "s") # no pings from here until GAP_END (i.e. between two .raw files)
+GAP_END = START + np.timedelta64(2500, "s")
+
+
+def gap_cast(frequencies = [18000, 38000, 120000, 200000], n_samples = 100):
+    '''
+    gap_cast: synthetic Sv of a cast in the format of raw_files_to_Sv - 1 ping a second from START to GAP_START and from
+              GAP_END for 1500 seconds
+    '''
+    before = synthetic.make_Sv_dic(1500, n_samples, frequencies, start=START)
+    after = synthetic.make_Sv_dic(1500, n_samples, frequencies, start=GAP_END, seed=1)
+    return {fq: (process.concat_Sv([before[fq][0], after[fq][0]]), before[fq][1]) for fq in frequencies}
+
+def windowed_reader(cast_dic, windows):
+    '''
+    windowed_reader: stands in for raw_files_to_Sv with a time_window - returns a copy of the pings of cast_dic in the window,
+                     or an empty dictionary if there are none (same as raw_files_to_Sv) - each window is added to windows
+    '''
+    def raw_files_to_Sv(raw_files, frequencies, transducer_offset, sv_cache = None, time_window = None, index_path = "",
+                        processes = 1, dtype = np.float64):
+        windows.append(time_window)
+        Sv_dic = {}
+        for fq in frequencies:
+            Sv, cal = cast_dic[fq]
+            times = np.asarray(Sv.ping_time)
+            pings = np.flatnonzero((times >= np.datetime64(time_window[0], "ms")) & (times <= np.datetime64(time_window[1], "ms")))
+            if len(pings) == 0:
+                return {}
+            Sv_dic[fq] = (process.crop_Sv(Sv, [pings[0], pings[-1]], [0, np.shape(Sv.data)[1] - 1], True), cal)
+        return Sv_dic
+    return raw_files_to_Sv
+
+def same_boxes(expected, streamed):
+    '''
+    same_boxes: True if every box of streamed has the same data, ping times, and depths as in expected
+    '''
+    for name in streamed:
+        for fq in expected[name]:
+            a, b = expected[name][fq], streamed[name][fq]
+            if not (np.array_equal(a.data, b.data, equal_nan=True) and np.array_equal(a.ping_time, b.ping_time) and
+                    np.array_equal(a.depth, b.depth)):
+                return False
+    return True
+
+def check_streaming():
+    '''
+    check_streaming: streams boxes of the synthetic cast - with a first box before the recording (empty probe, so chunks are
+                     STREAM_MIN_SECONDS long) and without it, with one chunk for every box and with the shortest chunks
+    Output: list of (name, passed) for each check
+    '''
+    cast_dic = gap_cast()
+    second = np.timedelta64(1, "s")
+    boxes = {"early": ((START - 120*second, START + 300*second), (20, 60)), # starts before the recording - empty probe
+             "middle": ((START + 700*second, START + 900*second), (10, 80)),
+             "gap": ((GAP_START + 200*second, GAP_END - 200*second), (20, 60)), # no pings at all
+             "across": ((GAP_START - 100*second, GAP_END + 100*second), (30, 50)), # pings on both sides of the gap
+             "late": ((GAP_END + 600*second, GAP_END + 1000*second), (0, 90))}
+    expected = process.crop_boxes_Sv(cast_dic, {name: boxes[name] for name in boxes if name != "gap"})
+
+    windows = []
+    read_Sv = process.raw_files_to_Sv
+    process.raw_files_to_Sv = windowed_reader(cast_dic, windows)
+    results = []
+    try:
+        for empty_probe in [True, False]:
+            run_boxes = {name: boxes[name] for name in boxes if empty_probe or name != "early"}
+            for memory_mb in [1024, 0.01]:
+                del windows[:]
+                try:
+                    streamed = dict(process.stream_boxes_Sv([], run_boxes, 5, memory_mb=memory_mb))
+                    error = ""
+                except Exception as e:
+                    streamed, error = {}, " (" + type(e).__name__ + ": " + str(e) + ")"
+                label = (" - empty probe" if empty_probe else "") + " - memory_mb=" + str(memory_mb)
+                results.append(("stream runs" + label + error, error == ""))
+                results.append(("box with no pings skipped" + label, "gap" not in streamed))
+                results.append(("other boxes given back" + label, set(streamed) == set(run_boxes) - {"gap"}))
+                results.append(("boxes same as crop_boxes_Sv" + label, same_boxes(expected, streamed)))
+                if empty_probe: # the shortest chunks are used - the probe plus one read per window
+                    n_windows = len(process.stream_windows(run_boxes, process.STREAM_MIN_SECONDS))
+                    results.append(("STREAM_MIN_SECONDS chunks" + label, len(windows) == n_windows + 1))
+    finally:
+        process.raw_files_to_Sv = read_Sv
+    return results
+
+if __name__ == "__main__":
+    results = check_streaming()
+    for name, passed in results:
+        print(name.ljust(72) + ("ok" if passed else "FAILED"))
+    if not all(passed for _, passed in results):
+        sys.exit(1)
@@ -1,7 +1,8 @@
-import json
 from echolab2.instruments import EK80
 import CTD_EK_processing as process
+import CTD_EK_store as store
 import os
+import copy
 import matplotlib.pyplot as plt
 import numpy as np
 from echolab2.plotting.matplotlib import echogram
@@ -10,28 +11,21 @@ raw_path = "/Volumes/GeringSSD/GU1905_Acoustic/EK60/"
 ctd_path = '/Volumes/GeringSSD/GU201905_CTD/'
 output_path = "/Volumes/GeringSSD/GU201905_output/"
 ctd_list = '/CTDtoEVL.list'
-mfi_file = "mfi.json"
-bounds_file = "subset_bounds.json"
-subset_file = "subsets.json"
+store_path = output_path + "subset_store"
 evl_raw_list = output_path + "/evl_raw_matches.list"
 
-mfi_dic = json.load(open(output_path + mfi_file))
-subset_dic = json.load(open(output_path + subset_file))
-bounds_dic = json.load(open(output_path + bounds_file))
-
 evl_raw_dic = process.evl_raw_dic_from_file(evl_raw_list)
 asc_files = process.asc_from_list(ctd_path + ctd_list)
 evl_list = process.cast_new_extension(asc_files, ".asc", ".evl")
 raw_list = process.glob.glob(os.path.normpath(raw_path + "/*.raw"))
 
-mfi = mfi_dic["15"]["42"]
-subset = subset_dic["15"]["42"]["38000"]
-bounds = bounds_dic["15"]["42"]
-
-subset_obj = process.processed_data_from_dic(subset, bounds)
+mfi = store.load_mfi(store_path, "15", "42").data # only reads the one subset needed
+subset_obj = store.load_subset(store_path, "15", "42", ["38000"])["38000"]
+subset = subset_obj.data
 
 masked_Sv = process.mask_mfi(mfi, subset, [[0, 0.4], [0.8, 1]])
-mask_Sv_obj = process.processed_data_from_dic(masked_Sv, bounds)
+mask_Sv_obj = copy.copy(subset_obj) # same ping times and depths, only the data is replaced
+mask_Sv_obj.data = masked_Sv
 abc_val = process.calc_ABC(mask_Sv_obj)
 
 print(abc_val)
@@ -0,0 +1,150 @@
+'''
+Generators for synthetic CTD casts and Sv data so the processing code can be run and timed without the cruise data (see
+benchmark.py). CTD casts are written as .asc files in the same format as the ship's CTD files, with a descent, a plateau
+at each bottle depth, and an ascent. Sv data are pyEcholab processed data objects with a noisy background, a scattering
+layer, and a seabed, for any number of pings and samples.
+
+Hollings Scholarship Research Project
+'''
+
+import os
+import numpy as np
+from datetime import datetime, timedelta
+from echolab2.processing import processed_data
+
+ASC_HEADER = "Scan Date Time Lat Lon PrDM DepSM T090C Sal00 Flag" # depth (DepSM) is the 7th column, as in the ship's files
+
+
+def ctd_trace(bottle_depths, start = datetime(2019, 10, 18, 11, 45), speed = 1.0, plateau_seconds = 90, noise = 0.02, seed = 0):
+    '''
+    ctd_trace: depth of a CTD cast for each second - descent to the deepest bottle depth, then a plateau at each bottle depth
+               on the way up, then an ascent to the surface
+    Inputs: bottle_depths (float list) - depths (meters) the CTD stops at to take water samples
+            start (datetime) - time the cast starts
+            speed (float) - speed of the CTD in meters per second between plateaus
+            plateau_seconds (integer) - how long the CTD stays at each bottle depth
+            noise (float) - standard deviation (meters) of the depth while stopped
+            seed (integer) - random seed
+    Outputs: (1) numpy datetime64[ms] array of times, (2) numpy float array of depths
+    '''
+    rng = np.random.default_rng(seed)
+    stops = sorted(bottle_depths, reverse=True)
+    pieces = []
+    depth = 0.0
+    for stop in stops + [0.0]:
+        n = max(int(abs(stop - depth)/speed), 2)
+        pieces.append(np.linspace(depth, stop, n, endpoint=False))
+        depth = stop
+        if stop != 0:
+            pieces.append(stop + rng.normal(0, noise, plateau_seconds))
+    depths = np.concatenate(pieces + [np.zeros(1)])
+    times = np.datetime64(start, "ms") + np.arange(len(depths))*np.timedelta64(1, "s")
+    return times, depths
+
+def write_asc(asc_file, bottle_depths, start = datetime(2019, 10, 18, 11, 45), scans_per_second = 24, seed = 0, **trace_args):
+    '''
+    write_asc: writes a synthetic .asc CTD file with scans_per_second scans for each second of ctd_trace
+    Inputs: asc_file (string) - path and filename of the .asc file to write
+            bottle_depths (float list), start (datetime) - see ctd_trace
+            scans_per_second (integer) - number of lines per second (the ship's CTD records 24)
+            seed (integer) - random seed
+            trace_args - any other arguments of ctd_trace
+    Output: number of lines written (not counting the header)
+    '''
+    rng = np.random.default_rng(seed)
+    times, depths = ctd_trace(bottle_depths, start, seed=seed, **trace_args)
+    stamps = [(start + timedelta(seconds=i)).strftime("%m/%d/%Y %H:%M:%S") for i in range(len(times))]
+    scan_depths = np.repeat(depths, scans_per_second) + rng.normal(0, 0.01, len(depths)*scans_per_second)
+    lines = [ASC_HEADER]
+    for scan, depth in enumerate(scan_depths.tolist()):
+        lines.append(str(scan) + " " + stamps[scan // scans_per_second] + " 40.1 -70.2 " + str(round(depth + 0.1, 3)) + " " +
+                     str(round(depth, 3)) + " 12.3 33.1 0.000e+00")
+    with open(asc_file, 'w') as outfile:
+        outfile.write("\n".join(lines) + "\n")
+    return len(scan_depths)
+
+def write_cruise(path, n_casts, bottle_depths = [80, 43, 10], start = datetime(2019, 10, 18, 11, 45), cast_hours = 3,
+                 raw_minutes = 30, **asc_args):
+    '''
+    write_cruise: writes synthetic .asc files, a CTDtoEVL.list file, an eDNA cast file, and empty .raw files named by time
+                  (enough for match_raw_evl, which only reads .raw file names) for a cruise
+    Inputs: path (string) - folder to write everything to - created if it does not exist
+            n_casts (integer) - number of casts
+            bottle_depths (float list) - bottle depths of every cast
+            start (datetime) - start of the first cast
+            cast_hours (float) - hours between the starts of casts
+            raw_minutes (integer) - length of each .raw file
+            asc_args - any other arguments of write_asc
+    Output: dictionary with "asc_files", "raw_files" (paths), "ctd_list" (name of list file), and "edna_file" (path)
+    '''
+    os.makedirs(path, exist_ok=True)
+    asc_files = []
+    for cast in range(1, n_casts+1):
+        asc_file = "ctd" + str(cast).zfill(3) + ".asc"
+        write_asc(os.path.join(path, asc_file), bottle_depths, start + timedelta(hours=cast_hours*(cast-1)), seed=cast, **asc_args)
+        asc_files.append(asc_file)
+    with open(os.path.join(path, "CTDtoEVL.list"), 'w') as outfile:
+        outfile.write("".join(asc_file + ", 0\n" for asc_file in asc_files))
+    edna_file = os.path.join(path, "eDNA_cast.txt")
+    with open(edna_file, 'w') as outfile:
+        outfile.write("".join(str(cast) + " " + " ".join(str(d) for d in bottle_depths) + "\n" for cast in range(1, n_casts+1)))
+
+    raw_files = []
+    n_raw = int(n_casts*cast_hours*60/raw_minutes)
+    for i in range(n_raw):
+        raw_start = start - timedelta(minutes=5) + timedelta(minutes=raw_minutes*i)
+        raw_file = os.path.join(path, "GU19_05-D" + raw_start.strftime("%Y%m%d") + "-T" + raw_start.strftime("%H%M%S") + ".raw")
+        open(raw_file, 'w').close()
+        raw_files.append(raw_file)
+    return {"asc_files": asc_files, "raw_files": raw_files, "ctd_list": "CTDtoEVL.list", "edna_file": edna_file}
+
+def make_Sv(n_pings, n_samples, frequency = 38000, start = np.datetime64("2019-10-18T11:40:00", "ms"), ping_seconds = 1.0,
+            max_depth = 200, layer_depth = 40, seabed_depth = 150, seed = 0):
+    '''
+    make_Sv: creates a synthetic Sv processed data object - background noise around -85 dB, a scattering layer around -65 dB
+             that gets stronger with frequency, and a seabed echo around -20 dB
+    Inputs: n_pings, n_samples (integer) - size of the data
+            frequency (integer) - frequency of the channel
+            start (numpy datetime64) - time of the first ping
+            ping_seconds (float) - time between pings
+            max_depth (float) - depth of the last sample in meters
+            layer_depth, seabed_depth (float) - depths of the scattering layer and seabed in meters
+            seed (integer) - random seed
+    Output: Sv processed data object with data, ping_time, depth, n_pings, transducer_offset, and heave attributes
+    '''
+    rng = np.random.default_rng(seed + frequency)
+    Sv = processed_data.processed_data("synthetic " + str(frequency), frequency, "Sv")
+    Sv.ping_time = start + (np.arange(n_pings)*ping_seconds*1000).astype("timedelta64[ms]")
+    Sv.depth = np.linspace(0, max_depth, n_samples)
+    layer = 10**((-65 + 3*np.log10(frequency/18000))/10) * np.exp(-((Sv.depth - layer_depth)/5)**2) # linear sv of the layer
+    data = 10*np.log10(10**(rng.normal(-85, 4, (n_pings, n_samples))/10) + layer) # layer is added in the linear domain
+    data[:, Sv.depth >= seabed_depth] = rng.normal(-20, 2, (n_pings, int(np.sum(Sv.depth >= seabed_depth))))
+    Sv.data = data
+    Sv.n_pings = n_pings
+    Sv.transducer_offset = np.zeros(n_pings)
+    Sv.heave = np.zeros(n_pings)
+    return Sv
+
+class SyntheticCal:
+    '''
+    SyntheticCal: stands in for the calibration object returned with Sv (see raw_to_Sv) - only sample_interval is used
+    '''
+    def __init__(self, sample_interval):
+        self.sample_interval = sample_interval
+
+def make_Sv_dic(n_pings, n_samples, frequencies = [18000, 38000, 120000, 200000], seed = 0, **Sv_args):
+    '''
+    make_Sv_dic: creates synthetic Sv for several frequencies in the format returned by raw_files_to_Sv
+    Inputs: n_pings, n_samples (integer) - size of the data of every frequency
+            frequencies (integer list) - frequencies to create
+            seed (integer) - random seed
+            Sv_args - any other arguments of make_Sv
+    Output: dictionary with frequencies as keys and (Sv object, calibration object) tuples as values
+    '''
+    return {fq: (make_Sv(n_pings, n_samples, fq, seed=seed, **Sv_args), SyntheticCal(1)) for fq in frequencies}
+
+def make_subset(n_pings, n_samples, frequencies = [18000, 38000, 120000, 200000], seed = 0, **Sv_args):
+    '''
+    make_subset: creates one synthetic subset in the format of one depth of subset_segments_Sv (frequencies as string keys)
+    '''
+    return {str(fq): Sv for fq, (Sv, _) in make_Sv_dic(n_pings, n_samples, frequencies, seed, **Sv_args).items()}